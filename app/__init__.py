@@ -1,16 +1,19 @@
+import os
 from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_pagedown import PageDown
+from jinja2 import FileSystemBytecodeCache
 from config import config
+from .routing import RoutingSQLAlchemy
+from . import assets, compression
 
 bootstrap = Bootstrap()
 mail = Mail()
 moment = Moment()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 pagedown = PageDown()
 
 login_manager = LoginManager()
@@ -21,6 +24,12 @@ def create_app(config_name):
     app = Flask(__name__)
     app.config.from_object(config[config_name])
     config[config_name].init_app(app)
+    if app.config['FLASKY_TEMPLATE_CACHE']:
+        # compiled templates survive restarts; `flask precompile` fills the
+        # cache at deploy time so that no worker compiles on its first hits
+        os.makedirs(app.config['FLASKY_TEMPLATE_CACHE'], exist_ok=True)
+        app.jinja_options = dict(app.jinja_options, bytecode_cache=FileSystemBytecodeCache(
+            app.config['FLASKY_TEMPLATE_CACHE']))
 
     bootstrap.init_app(app)
     mail.init_app(app)
@@ -28,6 +37,8 @@ def create_app(config_name):
     db.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
+    assets.init_app(app)
+    compression.init_app(app)
 
     from .main import main as main_blueprint
     app.register_blueprint(main_blueprint)
@@ -35,4 +46,7 @@ def create_app(config_name):
     from .auth import auth as auth_blueprint
     app.register_blueprint(auth_blueprint, url_prefix='/auth')
 
+    from . import jobs
+    jobs.init_app(app)
+
     return app
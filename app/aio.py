@@ -0,0 +1,168 @@
+import asyncio
+import json
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+import aiosqlite
+from asgiref.wsgi import WsgiToAsgi
+from itsdangerous import BadSignature
+from sqlalchemy.engine.url import make_url
+from . import lists, live
+from .routing import REPLICA
+
+
+def _database(app):
+    """The SQLite file the read path reads: the replica bind if there is one,
+    else the primary database.  None if it is not a SQLite file."""
+    url = make_url((app.config.get('SQLALCHEMY_BINDS') or {}).get(REPLICA) or
+                   app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+
+class _Pool:
+    """A fixed number of aiosqlite connections in query_only mode.  Each
+    connection runs its queries on a thread of its own, so up to `size`
+    reads run at once while the event loop keeps serving other clients."""
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.idle = None
+        self.connections = []
+        self.lock = asyncio.Lock()
+
+    async def _open(self):
+        async with self.lock:
+            if self.idle is None:
+                idle = asyncio.Queue()
+                for _ in range(self.size):
+                    connection = await aiosqlite.connect(self.path)
+                    await connection.execute('PRAGMA query_only = ON')
+                    self.connections.append(connection)
+                    idle.put_nowait(connection)
+                self.idle = idle
+
+    async def fetch(self, sql, params):
+        if self.idle is None:
+            await self._open()
+        connection = await self.idle.get()
+        try:
+            async with connection.execute(sql, params) as cursor:
+                return await cursor.fetchall(), [column[0] for column in cursor.description]
+        finally:
+            self.idle.put_nowait(connection)
+
+    async def close(self):
+        for connection in self.connections:
+            await connection.close()
+        self.connections = []
+        self.idle = None
+
+
+class ReadPath:
+    """ASGI application serving GET /api/<list> (see app.lists) with
+    aiosqlite, the live inventory stream on the event loop, and everything
+    else with the Flask app run in a thread pool.
+
+    A poller is authenticated from the Flask session cookie, the same way
+    login_required would, and gets 401 instead of a redirect to the login
+    page.  Unlike the Flask views it does not update last_seen."""
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        path = _database(app)
+        self.pool = _Pool(path, app.config['FLASKY_ASYNC_CONNECTIONS']) if path else None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'GET' and self.pool is not None \
+                and scope['path'].startswith('/api/') and scope['path'][5:] in lists.QUERIES:
+            await self.list(scope, send, scope['path'][5:])
+        elif scope['type'] == 'http' and scope['method'] == 'GET' and self.pool is not None \
+                and scope['path'] == '/inventory/stream':
+            await self.stream(scope, receive, send)
+        else:
+            await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.pool is not None:
+                    await self.pool.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def user_id(self, scope):
+        if self.serializer is None:
+            return None
+        cookies = SimpleCookie()
+        for name, value in scope['headers']:
+            if name == b'cookie':
+                cookies.load(value.decode('latin-1'))
+        morsel = cookies.get(self.app.session_cookie_name)
+        if morsel is None:
+            return None
+        try:
+            session = self.serializer.loads(morsel.value,
+                                            max_age=self.app.permanent_session_lifetime.total_seconds())
+        except BadSignature:
+            return None
+        user_id = session.get('_user_id')
+        if user_id is None:
+            return None
+        rows, _ = await self.pool.fetch('SELECT confirmed FROM users WHERE id = :id', {'id': user_id})
+        return user_id if rows and rows[0][0] else None
+
+    async def list(self, scope, send, name):
+        if await self.user_id(scope) is None:
+            return await self.respond(send, 401, {'error': 'unauthorized'})
+        try:
+            page = int(parse_qs(scope['query_string'].decode('latin-1')).get('page', ['1'])[0])
+        except ValueError:
+            page = 1
+        per_page = self.app.config['FLASKY_POSTS_PER_PAGE']
+        rows, columns = await self.pool.fetch(lists.QUERIES[name], lists.params(page, per_page))
+        await self.respond(send, 200, lists.result(rows, columns, page, per_page))
+
+    async def stream(self, scope, receive, send):
+        """The server-sent events of main.inventory_stream, until the client
+        disconnects or its stream is dropped."""
+        if await self.user_id(scope) is None:
+            return await self.respond(send, 401, {'error': 'unauthorized'})
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+                                (b'x-accel-buffering', b'no')]})
+        events = live.stream_async(self.app.config['FLASKY_LIVE_HEARTBEAT'], self.app.config['FLASKY_LIVE_QUEUE'])
+
+        async def forward():
+            async for line in events:
+                await send({'type': 'http.response.body', 'body': line.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def disconnect():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(forward()), asyncio.ensure_future(disconnect())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await events.aclose()
+
+    @staticmethod
+    async def respond(send, status, body):
+        body = json.dumps(body).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(body)).encode('ascii'))]})
+        await send({'type': 'http.response.body', 'body': body})
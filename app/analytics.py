@@ -0,0 +1,163 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from flask import current_app
+from . import db
+from .models import Purchase, Refund, Storage, Allocate, Medicine, User, PurchaseArchive, RefundArchive, \
+    StorageArchive, AllocateArchive
+from .archive import reaches_archive
+
+KINDS = ["purchase", "storage", "refund", "allocate"]
+COLUMNS = ["day", "kind", "medicine_id", "count", "user_id"]
+
+# (database url, day) -> DataFrame of that day's movements.  Only days before
+# today are kept: movements are always stamped with the current time, so a
+# past day never changes, and archiving only moves its rows elsewhere.
+_partitions = OrderedDict()
+_lock = threading.Lock()
+
+
+def _movements(purchase, refund, storage, allocate, start, end):
+    """One UNION ALL over the four ledger tables, a row per movement with the
+    day it happened on and the kind coded as its index in KINDS."""
+
+    def between(timestamp):
+        return db.and_(timestamp >= start, timestamp < end)
+
+    return db.union_all(
+        db.select(db.func.date(purchase.c.timestamp), db.literal(0), purchase.c.medicine_id,
+                  purchase.c.count, purchase.c.user_id)
+        .where(between(purchase.c.timestamp)),
+        db.select(db.func.date(storage.c.timestamp), db.literal(1), purchase.c.medicine_id,
+                  purchase.c.count, storage.c.user_id)
+        .select_from(storage.join(purchase, purchase.c.id == storage.c.purchase_id))
+        .where(between(storage.c.timestamp)),
+        db.select(db.func.date(refund.c.timestamp), db.literal(2), purchase.c.medicine_id,
+                  purchase.c.count, refund.c.user_id)
+        .select_from(refund.join(purchase, purchase.c.id == refund.c.purchase_id))
+        .where(between(refund.c.timestamp)),
+        db.select(db.func.date(allocate.c.timestamp), db.literal(3), allocate.c.medicine_id,
+                  allocate.c.count, allocate.c.user_id)
+        .where(between(allocate.c.timestamp)),
+    )
+
+
+def _empty():
+    return _columnar(pd.DataFrame(columns=COLUMNS))
+
+
+def _columnar(frame):
+    return pd.DataFrame({
+        "day": pd.to_datetime(frame["day"], format="%Y-%m-%d"),
+        "kind": pd.Categorical.from_codes(frame["kind"].astype(np.int8), categories=KINDS),
+        "medicine_id": frame["medicine_id"].fillna(0).astype(np.int64),
+        "count": frame["count"].fillna(0).astype(np.int64),
+        "user_id": frame["user_id"].fillna(0).astype(np.int64),
+    })
+
+
+def _read(statement, engine):
+    """Stream the statement in chunks of FLASKY_ANALYTICS_CHUNK_SIZE rows,
+    turning each chunk into a frame as it arrives."""
+    chunk_size = current_app.config["FLASKY_ANALYTICS_CHUNK_SIZE"]
+    frames = []
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True).execute(statement)
+        for chunk in result.partitions(chunk_size):
+            frames.append(_columnar(pd.DataFrame.from_records(chunk, columns=COLUMNS)))
+    return frames
+
+
+def _load(start, end):
+    """Movements from `start` up to but excluding `end`, hot and cold."""
+    tables = [model.__table__ for model in (Purchase, Refund, Storage, Allocate)]
+    # the session's bind, so that read-only views read the replica
+    frames = _read(_movements(*tables, start, end), db.session.get_bind())
+    if reaches_archive(Purchase, start) or reaches_archive(Allocate, start):
+        tables = [model.__table__ for model in (PurchaseArchive, RefundArchive, StorageArchive, AllocateArchive)]
+        frames += _read(_movements(*tables, start, end), db.get_engine(bind="archive"))
+    return pd.concat(frames, ignore_index=True) if frames else _empty()
+
+
+def frame(start, end):
+    """All movements from day `start` to day `end` inclusive as one columnar
+    DataFrame.  Days that are already cached are not read again; the others
+    are read in one query per run of consecutive days."""
+    key = str(db.engine.url)
+    today = datetime.utcnow().date()
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    parts = {}
+    with _lock:
+        for day in days:
+            if (key, day) in _partitions:
+                _partitions.move_to_end((key, day))
+                parts[day] = _partitions[(key, day)]
+    missing = [day for day in days if day not in parts]
+    empty = _empty()
+    while missing:
+        run = [missing.pop(0)]
+        while missing and missing[0] == run[-1] + timedelta(days=1):
+            run.append(missing.pop(0))
+        loaded = _load(run[0], run[-1] + timedelta(days=1))
+        by_day = dict(tuple(loaded.groupby("day", sort=False)))
+        for day in run:
+            parts[day] = by_day.get(pd.Timestamp(day), empty)
+            if day < today:
+                _remember(key, day, parts[day])
+    frames = [parts[day] for day in days if len(parts[day])]
+    if not frames:
+        return empty
+    return pd.concat(frames, ignore_index=True)
+
+
+def _remember(key, day, part):
+    with _lock:
+        _partitions[(key, day)] = part
+        while len(_partitions) > current_app.config["FLASKY_ANALYTICS_CACHE_DAYS"]:
+            _partitions.popitem(last=False)
+
+
+def _totals(movements, by):
+    """Counts per `by` value and kind, one column per kind."""
+    return movements.groupby([by, "kind"], observed=False)["count"].sum() \
+        .unstack("kind", fill_value=0).reindex(columns=KINDS, fill_value=0)
+
+
+def _rows(table):
+    table = table[table.sum(axis=1) > 0].copy()
+    purchased = table["purchase"].to_numpy(dtype=float)
+    table["refund_rate"] = np.divide(table["refund"].to_numpy(dtype=float), purchased,
+                                     out=np.zeros_like(purchased), where=purchased > 0)
+    return list(table.itertuples(name=None))
+
+
+def summary(start, end):
+    """Totals of purchased, stored, refunded and allocated counts plus the
+    refund rate, by medicine, type, factory, user and day, for the days from
+    `start` to `end` inclusive.
+
+    Only the integer keys are grouped over the full movement frame; type and
+    factory are rolled up from the per-medicine totals and user names are
+    attached to the per-user totals."""
+    movements = frame(start, end)
+    medicines = pd.DataFrame.from_records(
+        Medicine.query.with_entities(Medicine.medicine_id, Medicine.medicine_type, Medicine.medicine_factory).all(),
+        columns=["medicine_id", "medicine_type", "medicine_factory"]).set_index("medicine_id")
+    users = dict(User.query.with_entities(User.id, User.username).all())
+
+    by_medicine = _totals(movements, "medicine_id")
+    by_user = _totals(movements, "user_id")
+    by_user.index = [users.get(user_id, "-") for user_id in by_user.index]
+    by_day = _totals(movements, "day")
+    by_day.index = by_day.index.strftime("%Y-%m-%d")
+    return OrderedDict([
+        ("Medicine", _rows(by_medicine)),
+        ("Type", _rows(by_medicine.groupby(
+            medicines["medicine_type"].reindex(by_medicine.index).fillna("-").to_numpy()).sum())),
+        ("Factory", _rows(by_medicine.groupby(
+            medicines["medicine_factory"].reindex(by_medicine.index).fillna("-").to_numpy()).sum())),
+        ("User", _rows(by_user)),
+        ("Day", _rows(by_day)),
+    ])
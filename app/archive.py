@@ -0,0 +1,133 @@
+from datetime import datetime, time, timedelta
+from flask import current_app
+from . import db
+from .models import Purchase, Refund, Storage, AllocateOrder, Allocate, PurchaseArchive, RefundArchive, \
+    StorageArchive, AllocateOrderArchive, AllocateArchive
+
+# hot model -> cold model, used by both archival and reporting
+ARCHIVES = {
+    Purchase: PurchaseArchive,
+    Refund: RefundArchive,
+    Storage: StorageArchive,
+    AllocateOrder: AllocateOrderArchive,
+    Allocate: AllocateArchive,
+}
+
+
+def _move(model, ids):
+    """Copy the rows with the given ids into the archive, then delete them from
+    the hot table.  The copy is committed first, so a run interrupted between
+    the two commits can simply be repeated: rows already archived unchanged
+    are skipped.  An archived row with the same id but other content means
+    the hot table handed an archived id out again (a ledger table without
+    AUTOINCREMENT, see scripts.md); that raises ValueError rather than
+    overwrite the archived row."""
+    if not ids:
+        return 0
+    table = model.__table__
+    cold = ARCHIVES[model].__table__
+    rows = [dict(row) for row in db.session.execute(table.select().where(table.c.id.in_(ids))).mappings()]
+    archived = {row["id"]: dict(row) for row in
+                db.session.execute(cold.select().where(cold.c.id.in_(ids))).mappings()}
+    for row in rows:
+        if row["id"] in archived and archived[row["id"]] != row:
+            raise ValueError("%s %d is already archived with other content; rebuild the ledger tables "
+                             "with AUTOINCREMENT before archiving" % (table.name, row["id"]))
+    fresh = [row for row in rows if row["id"] not in archived]
+    if fresh:
+        db.session.execute(cold.insert(), fresh)
+    db.session.commit()
+    db.session.execute(table.delete().where(table.c.id.in_(ids)))
+    db.session.commit()
+    return len(rows)
+
+
+def archive(days=None, batch_size=None):
+    """Move closed ledger rows older than `days` to the archive bind in
+    batches, so that each write transaction on the hot database stays short.
+
+    A purchase is closed once it has been refunded: goods that were only put
+    in storage can still be refunded, which needs the hot row.  It moves
+    together with its storage and refund rows, and only when all of them are
+    older than the cutoff.  Allocate orders move together with their lines.
+    Returns the number of rows moved per table."""
+    days = current_app.config['FLASKY_ARCHIVE_DAYS'] if days is None else days
+    batch_size = batch_size or current_app.config['FLASKY_ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    moved = dict.fromkeys((model.__tablename__ for model in ARCHIVES), 0)
+
+    recent_storage = db.session.query(Storage.purchase_id).filter(Storage.timestamp >= cutoff)
+    recent_refund = db.session.query(Refund.purchase_id).filter(Refund.timestamp >= cutoff)
+    closed_purchases = db.session.query(Purchase.id) \
+        .filter(Purchase.timestamp < cutoff) \
+        .filter(Purchase.return_goods == True) \
+        .filter(~Purchase.id.in_(recent_storage)) \
+        .filter(~Purchase.id.in_(recent_refund)) \
+        .order_by(Purchase.id).limit(batch_size)
+    while True:
+        ids = [purchase_id for purchase_id, in closed_purchases]
+        if not ids:
+            break
+        storage_ids = [row.id for row in Storage.query.with_entities(Storage.id)
+                       .filter(Storage.purchase_id.in_(ids))]
+        refund_ids = [row.id for row in Refund.query.with_entities(Refund.id)
+                      .filter(Refund.purchase_id.in_(ids))]
+        moved["Storage"] += _move(Storage, storage_ids)
+        moved["Refund"] += _move(Refund, refund_ids)
+        moved["Purchase"] += _move(Purchase, ids)
+
+    old_orders = db.session.query(AllocateOrder.id) \
+        .filter(AllocateOrder.timestamp < cutoff) \
+        .order_by(AllocateOrder.id).limit(batch_size)
+    while True:
+        ids = [order_id for order_id, in old_orders]
+        if not ids:
+            break
+        item_ids = [row.id for row in Allocate.query.with_entities(Allocate.id)
+                    .filter(Allocate.order_id.in_(ids))]
+        moved["Allocate"] += _move(Allocate, item_ids)
+        moved["AllocateOrder"] += _move(AllocateOrder, ids)
+
+    # allocations made before allocate orders existed
+    old_items = db.session.query(Allocate.id) \
+        .filter(Allocate.order_id == None) \
+        .filter(Allocate.timestamp < cutoff) \
+        .order_by(Allocate.id).limit(batch_size)
+    while True:
+        ids = [item_id for item_id, in old_items]
+        if not ids:
+            break
+        moved["Allocate"] += _move(Allocate, ids)
+    return moved
+
+
+def reaches_archive(model, start_time):
+    """True if rows of `model` at or after `start_time` may have been
+    archived, i.e. the range starts before the newest archived row."""
+    newest = db.session.query(db.func.max(ARCHIVES[model].timestamp)).scalar()
+    return newest is not None and datetime.combine(start_time, time.min) <= newest
+
+
+def ledger(model, start_time, end_time):
+    """Rows of `model` from day `start_time` to day `end_time` inclusive in
+    time order, reading the archive as well when the range reaches into it."""
+    models = [model]
+    if reaches_archive(model, start_time):
+        models.append(ARCHIVES[model])
+    rows = []
+    for cls in models:
+        rows.extend(cls.query.filter(cls.timestamp < end_time + timedelta(days=1))
+                    .filter(cls.timestamp >= start_time).all())
+    return sorted(rows, key=lambda row: (row.timestamp, row.id))
+
+
+def lookup(model, ids):
+    """Map id to row for the given ids, from the hot table first and from the
+    archive for the ids that have been moved there."""
+    ids = set(ids)
+    rows = {row.id: row for row in model.query.filter(model.id.in_(list(ids)))} if ids else {}
+    missing = ids - set(rows)
+    if missing:
+        cold = ARCHIVES[model]
+        rows.update((row.id, row) for row in cold.query.filter(cold.id.in_(list(missing))))
+    return rows
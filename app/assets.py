@@ -0,0 +1,48 @@
+import hashlib
+import os
+from flask import request
+
+# Static URLs carry a hash of the file content as ?v=..., so a file can be
+# cached for a year: when it changes, pages link to a new URL.
+MAX_AGE = 365 * 24 * 3600
+
+_digests = {}
+
+
+def digest(app, filename):
+    """Short content hash of a file in the static folder, or None if it does
+    not exist.  Hashes are kept for the life of the process, except in debug
+    mode where they follow the file's modification time."""
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path) if app.debug else None
+    except OSError:
+        return None
+    cached = _digests.get(path)
+    if cached is None or cached[0] != mtime:
+        try:
+            with open(path, 'rb') as f:
+                cached = (mtime, hashlib.sha1(f.read()).hexdigest()[:12])
+        except OSError:
+            return None
+        _digests[path] = cached
+    return cached[1]
+
+
+def init_app(app):
+    @app.url_defaults
+    def fingerprint(endpoint, values):
+        if endpoint == 'static' and 'filename' in values and 'v' not in values:
+            version = digest(app, values['filename'])
+            if version:
+                values['v'] = version
+
+    @app.after_request
+    def cache_fingerprinted(response):
+        if request.endpoint == 'static' and response.status_code == 200 \
+                and request.args.get('v') == digest(app, request.view_args['filename']):
+            response.cache_control.public = True
+            response.cache_control.max_age = MAX_AGE
+            response.cache_control.immutable = True
+            response.headers.pop('Expires', None)
+        return response
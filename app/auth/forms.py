@@ -2,7 +2,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Length, Email, Regexp, EqualTo
 from wtforms import ValidationError
-from ..models import User
+from .. import repository
 
 
 class LoginForm(FlaskForm):
@@ -27,11 +27,11 @@ class RegistrationForm(FlaskForm):
     submit = SubmitField('Register')
 
     def validate_email(self, field):
-        if User.query.filter_by(email=field.data.lower()).first():
+        if repository.email_taken(field.data.lower()):
             raise ValidationError('Email already registered.')
 
     def validate_username(self, field):
-        if User.query.filter_by(username=field.data).first():
+        if repository.username_taken(field.data):
             raise ValidationError('Username already in use.')
 
 
@@ -64,5 +64,5 @@ class ChangeEmailForm(FlaskForm):
     submit = SubmitField('Update Email Address')
 
     def validate_email(self, field):
-        if User.query.filter_by(email=field.data.lower()).first():
+        if repository.email_taken(field.data.lower()):
             raise ValidationError('Email already registered.')
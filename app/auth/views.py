@@ -2,9 +2,10 @@ from flask import render_template, redirect, request, url_for, flash
 from flask_login import login_user, logout_user, login_required, \
     current_user
 from . import auth
-from .. import db
+from .. import db, repository
 from ..models import User
 from ..email import send_email
+from ..hashing import HashingBusy
 from .forms import LoginForm, RegistrationForm, ChangePasswordForm,\
     PasswordResetRequestForm, PasswordResetForm, ChangeEmailForm
 
@@ -31,8 +32,14 @@ def unconfirmed():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data.lower()).first()
-        if user is not None and user.verify_password(form.password.data):
+        user = repository.user_by_email(form.email.data.lower())
+        try:
+            verified = user is not None and user.verify_password(form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('auth/login.html', form=form), 503
+        if verified:
+            db.session.commit()
             login_user(user, form.remember_me.data)
             next = request.args.get('next')
             if next is None or not next.startswith('/'):
@@ -54,9 +61,13 @@ def logout():
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
-        user = User(email=form.email.data.lower(),
-                    username=form.username.data,
-                    password=form.password.data)
+        try:
+            user = User(email=form.email.data.lower(),
+                        username=form.username.data,
+                        password=form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('auth/register.html', form=form), 503
         db.session.add(user)
         db.session.commit()
         token = user.generate_confirmation_token()
@@ -95,8 +106,14 @@ def resend_confirmation():
 def change_password():
     form = ChangePasswordForm()
     if form.validate_on_submit():
-        if current_user.verify_password(form.old_password.data):
-            current_user.password = form.password.data
+        try:
+            verified = current_user.verify_password(form.old_password.data)
+            if verified:
+                current_user.password = form.password.data
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template("auth/change_password.html", form=form), 503
+        if verified:
             db.session.add(current_user)
             db.session.commit()
             flash('Your password has been updated.')
@@ -112,7 +129,7 @@ def password_reset_request():
         return redirect(url_for('main.index'))
     form = PasswordResetRequestForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data.lower()).first()
+        user = repository.user_by_email(form.email.data.lower())
         if user:
             token = user.generate_reset_token()
             send_email(user.email, 'Reset Your Password',
@@ -130,7 +147,12 @@ def password_reset(token):
         return redirect(url_for('main.index'))
     form = PasswordResetForm()
     if form.validate_on_submit():
-        if User.reset_password(token, form.password.data):
+        try:
+            reset = User.reset_password(token, form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template('auth/reset_password.html', form=form), 503
+        if reset:
             db.session.commit()
             flash('Your password has been updated.')
             return redirect(url_for('auth.login'))
@@ -144,7 +166,12 @@ def password_reset(token):
 def change_email_request():
     form = ChangeEmailForm()
     if form.validate_on_submit():
-        if current_user.verify_password(form.password.data):
+        try:
+            verified = current_user.verify_password(form.password.data)
+        except HashingBusy:
+            flash('The server is busy, please try again in a moment.')
+            return render_template("auth/change_email.html", form=form), 503
+        if verified:
             new_email = form.email.data.lower()
             token = current_user.generate_email_change_token(new_email)
             send_email(new_email, 'Confirm your email address',
@@ -0,0 +1,401 @@
+"""Online backups of the SQLite databases.
+
+A full backup copies the live database with SQLite's online backup API,
+FLASKY_BACKUP_PAGES pages per step, and gzips the copy.  In WAL mode the
+copy reads one snapshot from start to end, which writers never wait for.
+In rollback journal mode every step holds a shared lock and the copy
+pauses FLASKY_BACKUP_SLEEP seconds between steps, so that a writer waits
+for one step at most; a write in between restarts the copy.
+
+Every full backup starts a chain in its own directory, holding
+base.sqlite.gz and chain.json.  With FLASKY_BACKUP_WAL the app's
+connections leave checkpoints to the backup job, and until the chain is
+FLASKY_BACKUP_BASE_HOURS old every run appends the frames committed to the
+write-ahead log since the last run as wal-000001.gz, wal-000002.gz, ...
+then checkpoints and truncates the log itself.  chain.json records the
+salts of the log and the offset the next segment starts at; when the log
+no longer matches them it was checkpointed by someone else and frames were
+never shipped, and the run starts a new chain instead.
+
+Restoring unpacks the base and writes the page images of the shipped
+frames over it in order, as a checkpoint would."""
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from . import db
+
+STAMP = '%Y%m%dT%H%M%S.%f'
+COPY_BUFFER = 1 << 20
+WAL_HEADER = 32
+FRAME_HEADER = 24
+# frames the log may hold before a run checkpoints it, as SQLite's own
+# autocheckpoint would
+CHECKPOINT_FRAMES = 1000
+# log magic number -> byte order of its checksums
+WAL_MAGIC = {0x377f0682: '<', 0x377f0683: '>'}
+
+# database path -> a connection the job keeps open, so that the app closing
+# its last connection does not checkpoint and delete the log between runs
+_held = {}
+
+
+def database_path(bind=None):
+    engine = db.get_engine(bind=bind)
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        raise ValueError('Only SQLite database files can be backed up.')
+    return engine.url.database
+
+
+def _root(path):
+    return os.path.join(current_app.config['FLASKY_BACKUP_DIR'],
+                        os.path.splitext(os.path.basename(path))[0])
+
+
+def chains(bind=None):
+    """The chain directories of the database, oldest first."""
+    root = _root(database_path(bind))
+    if not os.path.isdir(root):
+        return []
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if os.path.exists(os.path.join(root, name, 'chain.json'))]
+
+
+def read_chain(chain):
+    with open(os.path.join(chain, 'chain.json')) as f:
+        return json.load(f)
+
+
+def _save(chain, state):
+    path = os.path.join(chain, 'chain.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def _open(path, mode, level=9):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=level)
+    return open(path, mode)
+
+
+def _sync(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _journal_mode(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute('PRAGMA journal_mode').fetchone()[0]
+    finally:
+        connection.close()
+
+
+def _size(chain, state):
+    names = [state['base']] + [segment['name'] for segment in state['segments']]
+    return sum(os.path.getsize(os.path.join(chain, name)) for name in names)
+
+
+def _checksum(data, order, s1, s2):
+    """SQLite's running log checksum over `data`, continued from (s1, s2)."""
+    words = struct.unpack('%s%dI' % (order, len(data) // 4), data)
+    for i in range(0, len(words), 2):
+        s1 = (s1 + words[i] + s2) & 0xffffffff
+        s2 = (s2 + words[i + 1] + s1) & 0xffffffff
+    return s1, s2
+
+
+def _header(f):
+    """The salts, page size and checksum of the log header, or None if the
+    log is empty or its header is not valid."""
+    data = f.read(WAL_HEADER)
+    if len(data) < WAL_HEADER:
+        return None
+    magic, _, page_size, _, salt1, salt2, s1, s2 = struct.unpack('>8I', data)
+    order = WAL_MAGIC.get(magic)
+    if order is None or _checksum(data[:24], order, 0, 0) != (s1, s2):
+        return None
+    return {'salt1': salt1, 'salt2': salt2, 'page_size': page_size, 'order': order,
+            'offset': WAL_HEADER, 'sums': [s1, s2]}
+
+
+def _copy_frames(f, position, out):
+    """Copy the frames from `position` to the last valid commit frame into
+    `out`.  Returns the number of frames copied and the position after
+    them."""
+    size = FRAME_HEADER + position['page_size']
+    s1, s2 = position['sums']
+    offset, copied, pending = position['offset'], 0, []
+    f.seek(offset)
+    while True:
+        frame = f.read(size)
+        if len(frame) < size:
+            break
+        _, commit, salt1, salt2, c1, c2 = struct.unpack('>6I', frame[:FRAME_HEADER])
+        if (salt1, salt2) != (position['salt1'], position['salt2']):
+            break
+        s1, s2 = _checksum(frame[:8], position['order'], s1, s2)
+        s1, s2 = _checksum(frame[FRAME_HEADER:], position['order'], s1, s2)
+        if (s1, s2) != (c1, c2):
+            break
+        pending.append(frame)
+        if commit:
+            out.write(b''.join(pending))
+            copied += len(pending)
+            offset += size * len(pending)
+            position = dict(position, offset=offset, sums=[s1, s2])
+            pending = []
+    return copied, position
+
+
+def _hold(path):
+    if path not in _held:
+        connection = sqlite3.connect(path, check_same_thread=False)
+        # a connection keeps its shared lock on a WAL database once it has read
+        connection.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        _held[path] = connection
+
+
+def _ship(path, chain, state, snapshot=None):
+    """Append the frames committed since the chain's position as its next
+    segment.  Once the log holds CHECKPOINT_FRAMES frames, checkpoint and
+    truncate it and touch the database, so that the new log starts with
+    salts this connection knows.  A new chain, whose position is not known
+    yet, takes the log as it stands.
+
+    The frames are copied under a read transaction, which writers do not
+    wait for but which keeps the log from restarting, and the ones committed
+    meanwhile under the write lock.  Returns the number of frames shipped,
+    or None if the log no longer matches the position, in which case
+    nothing is written.  `snapshot` is a connection whose read transaction
+    is ended once the frames are copied."""
+    level = current_app.config['FLASKY_BACKUP_COMPRESS_LEVEL']
+    name = 'wal-%06d%s' % (len(state['segments']) + 1, '.gz' if level else '')
+    segment, partial = os.path.join(chain, name), os.path.join(chain, 'partial-' + name)
+    adopt, position, frames = state['wal']['salt1'] is None, state['wal'], 0
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        connection.execute('BEGIN')
+        connection.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        try:
+            with open(path + '-wal', 'rb') as log, _open(partial, 'wb', level) as out:
+                for locked in (False, True):
+                    if locked:
+                        connection.execute('COMMIT')
+                        connection.execute('BEGIN IMMEDIATE')
+                    log.seek(0)
+                    header = _header(log)
+                    if adopt and (position is None or position['salt1'] is None):
+                        position = header
+                    elif header is None or any(header[key] != position[key]
+                                               for key in ('salt1', 'salt2', 'page_size')):
+                        return None
+                    if position is not None:
+                        copied, position = _copy_frames(log, position, out)
+                        frames += copied
+            version = connection.execute('PRAGMA data_version').fetchone()[0]
+        finally:
+            connection.execute('COMMIT')
+            if snapshot is not None and snapshot.in_transaction:
+                snapshot.execute('COMMIT')
+        if frames:
+            _sync(partial)
+            os.replace(partial, segment)
+            state['segments'].append({'name': name, 'frames': frames})
+        state['wal'] = position
+        if (position is None or position['offset'] > WAL_HEADER + CHECKPOINT_FRAMES *
+                (FRAME_HEADER + position['page_size'])) \
+                and not connection.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()[0]:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                # a commit made since ours may have been truncated unshipped
+                unchanged = connection.execute('PRAGMA data_version').fetchone()[0] == version
+                if unchanged:
+                    user_version = connection.execute('PRAGMA user_version').fetchone()[0]
+                    connection.execute('PRAGMA user_version = %d' % user_version)
+            finally:
+                connection.execute('COMMIT')
+            state['wal'] = None
+            if unchanged:
+                with open(path + '-wal', 'rb') as log:
+                    state['wal'] = _header(log)
+        _hold(path)
+        return frames
+    finally:
+        connection.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def _base(path):
+    """Start a new chain with a full backup.  In WAL mode the whole log as
+    it stands at the end of the copy becomes the first segment: the copy's
+    snapshot stays open until then, which keeps anyone from restarting the
+    log more than once, so the log holds every change since the snapshot.
+    Frames from before it are written again on restore, to the same end."""
+    config = current_app.config
+    level = config['FLASKY_BACKUP_COMPRESS_LEVEL']
+    stamp = datetime.utcnow().strftime(STAMP)
+    chain = os.path.join(_root(path), stamp)
+    os.makedirs(chain)
+    name = 'base.sqlite' + ('.gz' if level else '')
+    copy = os.path.join(chain, 'base.sqlite.tmp')
+    state = {'created': stamp, 'base': name, 'segments': [], 'wal': None}
+    try:
+        source = sqlite3.connect(path, isolation_level=None)
+        try:
+            if config['FLASKY_BACKUP_WAL']:
+                try:
+                    source.execute('PRAGMA journal_mode = WAL')
+                except sqlite3.OperationalError:
+                    pass
+            wal = source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            if wal:
+                source.execute('BEGIN')
+                source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+
+            def pause(status, remaining, total):
+                if not wal:
+                    time.sleep(config['FLASKY_BACKUP_SLEEP'])
+
+            target = sqlite3.connect(copy)
+            try:
+                source.backup(target, pages=config['FLASKY_BACKUP_PAGES'], progress=pause)
+            finally:
+                target.close()
+            if wal and config['FLASKY_BACKUP_WAL']:
+                state['wal'] = {'salt1': None}
+                try:
+                    shipped = _ship(path, chain, state, snapshot=source)
+                except sqlite3.OperationalError:
+                    # writers kept the log busy
+                    shipped = None
+                if shipped is None:
+                    # the copy stands on its own
+                    state['segments'], state['wal'] = [], None
+        finally:
+            if source.in_transaction:
+                source.execute('COMMIT')
+            source.close()
+        if level:
+            with open(copy, 'rb') as src, _open(os.path.join(chain, name), 'wb', level) as dst:
+                shutil.copyfileobj(src, dst, COPY_BUFFER)
+            os.remove(copy)
+        else:
+            os.replace(copy, os.path.join(chain, name))
+        _sync(os.path.join(chain, name))
+        _save(chain, state)
+    except BaseException:
+        shutil.rmtree(chain, ignore_errors=True)
+        raise
+    return chain, state
+
+
+def prune(bind=None):
+    """Delete the oldest chains beyond FLASKY_BACKUP_KEEP."""
+    found = chains(bind)
+    for chain in found[:-current_app.config['FLASKY_BACKUP_KEEP']]:
+        shutil.rmtree(chain)
+    return max(0, len(found) - current_app.config['FLASKY_BACKUP_KEEP'])
+
+
+def backup(bind=None, full=False, if_due=False):
+    """Back up the database of `bind`: ship the log into the newest chain if
+    it is younger than FLASKY_BACKUP_BASE_HOURS and shipping is on, else
+    start a new chain.  With `full` always start a new chain; with `if_due`
+    only do so once the newest chain is old enough, or when it can no
+    longer be shipped to although the database is in WAL mode.  Returns
+    what was done."""
+    path = database_path(bind)
+    found = chains(bind)
+    shipping = current_app.config['FLASKY_BACKUP_WAL']
+    if found and not full:
+        state = read_chain(found[-1])
+        age = datetime.utcnow() - datetime.strptime(state['created'], STAMP)
+        if age < timedelta(hours=current_app.config['FLASKY_BACKUP_BASE_HOURS']):
+            if shipping and state['wal'] is not None:
+                frames = _ship(path, found[-1], state)
+                if frames is not None:
+                    _save(found[-1], state)
+                    return '%s: %d frames shipped' % (found[-1], frames)
+            elif if_due and not (shipping and _journal_mode(path) == 'wal'):
+                return '%s is recent' % found[-1]
+    start = time.perf_counter()
+    chain, state = _base(path)
+    pruned = prune(bind)
+    return '%s: %.1f MB in %.1f s%s' % (chain, _size(chain, state) / 1e6, time.perf_counter() - start,
+                                        ', %d old chains deleted' % pruned if pruned else '')
+
+
+def _apply(database, page_size, stream):
+    """Write the page images of the frames in `stream` into the open
+    database file.  Returns the size in pages of the last commit."""
+    size, pages = FRAME_HEADER + page_size, None
+    while True:
+        frame = stream.read(size)
+        if len(frame) < size:
+            return pages
+        page, commit = struct.unpack('>2I', frame[:8])
+        database.seek((page - 1) * page_size)
+        database.write(frame[FRAME_HEADER:])
+        if commit:
+            pages = commit
+
+
+def restore(chain, target, segments=None, check=False):
+    """Rebuild the database of `chain` at `target`, with the first
+    `segments` segments or all of them.  The file is assembled next to the
+    target and only replaces it once complete; the target's log and index
+    are removed, since they belong to the database being replaced.  The app
+    must not be running on the target."""
+    state = read_chain(chain)
+    shipped = state['segments'] if segments is None else state['segments'][:segments]
+    work = target + '.restore'
+    try:
+        with _open(os.path.join(chain, state['base']), 'rb') as src, open(work, 'wb') as dst:
+            shutil.copyfileobj(src, dst, COPY_BUFFER)
+        if shipped:
+            page_size, pages = _page_size(work), None
+            with open(work, 'r+b') as database:
+                for segment in shipped:
+                    with _open(os.path.join(chain, segment['name']), 'rb') as stream:
+                        pages = _apply(database, page_size, stream) or pages
+                if pages:
+                    database.truncate(pages * page_size)
+                database.flush()
+                os.fsync(database.fileno())
+        if check:
+            connection = sqlite3.connect(work)
+            try:
+                result = connection.execute('PRAGMA quick_check').fetchone()[0]
+            finally:
+                connection.close()
+            if result != 'ok':
+                raise ValueError('The restored database is damaged: %s' % result)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(target + suffix):
+                os.remove(target + suffix)
+        os.replace(work, target)
+    except BaseException:
+        if os.path.exists(work):
+            os.remove(work)
+        raise
+    return len(shipped)
+
+
+def _page_size(path):
+    with open(path, 'rb') as f:
+        f.seek(16)
+        page_size, = struct.unpack('>H', f.read(2))
+    return 65536 if page_size == 1 else page_size
@@ -0,0 +1,94 @@
+import csv
+import hashlib
+from flask import current_app
+from . import db
+from .models import Medicine, Inventory
+
+FIELDS = ("medicine_name", "medicine_type", "medicine_factory")
+
+
+def content_hash(name, type, factory):
+    return hashlib.sha1("\x1f".join((name or "", type or "", factory or "")).encode("utf-8")).hexdigest()
+
+
+def read_csv(path):
+    """Yield (medicine_id, name, type, factory) from a supplier master file
+    with a medicine_id,medicine_name,medicine_type,medicine_factory header,
+    one row at a time."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            yield int(row["medicine_id"]), row["medicine_name"], row["medicine_type"], row["medicine_factory"]
+
+
+def _flush(statement, batch):
+    if batch:
+        db.session.execute(statement, batch)
+        db.session.commit()
+        del batch[:]
+
+
+def sync(rows, deactivate=True, batch_size=None):
+    """Bring Medicine in line with `rows` of (medicine_id, name, type,
+    factory), e.g. from read_csv.
+
+    Only the current id, hash and active flag are loaded; each incoming row
+    is compared by content hash, and inserts, updates and (unless
+    `deactivate` is false) deactivations of medicines missing from `rows`
+    are written with one executemany per batch, each batch committed on its
+    own so the writer is never held for long.  Medicines are deactivated
+    rather than deleted because the ledgers refer to them.  Finally the
+    names and types copied into Inventory are refreshed with one UPDATE.
+    Returns the number of rows changed per kind."""
+    batch_size = batch_size or current_app.config["FLASKY_CATALOG_BATCH_SIZE"]
+    medicine = Medicine.__table__
+    current = {medicine_id: (content_hash, active) for medicine_id, content_hash, active in
+               db.session.query(Medicine.medicine_id, Medicine.content_hash, Medicine.active)}
+    insert = medicine.insert()
+    update = medicine.update().where(medicine.c.medicine_id == db.bindparam("m_id")).values(
+        medicine_name=db.bindparam("m_name"), medicine_type=db.bindparam("m_type"),
+        medicine_factory=db.bindparam("m_factory"), content_hash=db.bindparam("m_hash"), active=True)
+    inserts, updates = [], []
+    counts = dict(inserted=0, updated=0, deactivated=0, inventory=0)
+    seen = set()
+    for medicine_id, name, type, factory in rows:
+        if medicine_id in seen:
+            continue
+        seen.add(medicine_id)
+        digest = content_hash(name, type, factory)
+        if medicine_id not in current:
+            inserts.append(dict(medicine_id=medicine_id, medicine_name=name, medicine_type=type,
+                                medicine_factory=factory, content_hash=digest, active=True))
+            counts["inserted"] += 1
+        elif current[medicine_id] != (digest, True):
+            updates.append(dict(m_id=medicine_id, m_name=name, m_type=type, m_factory=factory, m_hash=digest))
+            counts["updated"] += 1
+        if len(inserts) >= batch_size:
+            _flush(insert, inserts)
+        if len(updates) >= batch_size:
+            _flush(update, updates)
+    _flush(insert, inserts)
+    _flush(update, updates)
+
+    if deactivate:
+        gone = [dict(m_id=medicine_id) for medicine_id, (digest, active) in current.items()
+                if active and medicine_id not in seen]
+        counts["deactivated"] = len(gone)
+        deactivation = medicine.update().where(medicine.c.medicine_id == db.bindparam("m_id")).values(active=False)
+        for start in range(0, len(gone), batch_size):
+            _flush(deactivation, gone[start:start + batch_size])
+
+    inventory = Inventory.__table__
+
+    def catalog(column):
+        return db.select(column).where(medicine.c.medicine_id == inventory.c.medicine_id).scalar_subquery()
+
+    stale = db.select(medicine.c.medicine_id) \
+        .where(medicine.c.medicine_id == inventory.c.medicine_id) \
+        .where(db.or_(medicine.c.medicine_name.isnot(inventory.c.medicine_name),
+                      medicine.c.medicine_type.isnot(inventory.c.medicine_type)))
+    result = db.session.execute(inventory.update().where(stale.exists())
+                                .values(medicine_name=catalog(medicine.c.medicine_name),
+                                        medicine_type=catalog(medicine.c.medicine_type)))
+    counts["inventory"] = result.rowcount
+    db.session.commit()
+    return counts
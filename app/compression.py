@@ -0,0 +1,48 @@
+import gzip
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is used without it
+    brotli = None
+
+COMPRESSIBLE = {'text/html', 'application/json', 'text/css', 'application/javascript', 'text/csv'}
+
+
+def _encoding(accept_encodings):
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def init_app(app):
+    @app.after_request
+    def compress(response):
+        """Compress buffered text responses of at least
+        FLASKY_COMPRESS_MIN_SIZE bytes with brotli or gzip, whichever the
+        client accepts.  Streamed responses, such as the live inventory
+        stream and static files, are left alone."""
+        if response.mimetype in COMPRESSIBLE:
+            response.vary.add('Accept-Encoding')
+        if response.direct_passthrough or response.is_streamed \
+                or response.mimetype not in COMPRESSIBLE \
+                or response.status_code < 200 or response.status_code in (204, 304) \
+                or 'Content-Encoding' in response.headers \
+                or (response.content_length is not None and
+                    response.content_length < app.config['FLASKY_COMPRESS_MIN_SIZE']):
+            return response
+        encoding = _encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+        data = response.get_data()
+        if len(data) < app.config['FLASKY_COMPRESS_MIN_SIZE']:
+            return response
+        if encoding == 'br':
+            data = brotli.compress(data, quality=app.config['FLASKY_COMPRESS_LEVEL'])
+        else:
+            data = gzip.compress(data, compresslevel=app.config['FLASKY_COMPRESS_LEVEL'])
+        response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        return response
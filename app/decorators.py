@@ -1,6 +1,12 @@
+import math
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
-from flask import abort
+from flask import abort, current_app, request
 from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+from . import db
 from .models import Permission
 
 
@@ -17,3 +23,109 @@ def permission_required(permission):
 
 def admin_required(f):
     return permission_required(Permission.ADMIN)(f)
+
+
+def read_only(f):
+    """Send the view's queries on the primary database to the replica bind,
+    see app.routing."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        db.session.info['read_only'] = True
+        try:
+            return f(*args, **kwargs)
+        finally:
+            db.session.info.pop('read_only', None)
+    return decorated_function
+
+
+class TokenBucket:
+    """`capacity` tokens, refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Take a token and return 0, or return the seconds until one is
+        available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def give(self):
+        """Return a token taken for a request that was refused later on."""
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class WriteLimiter:
+    """Admission control in front of the single SQLite writer: a token bucket
+    per user, one for all users, and at most FLASKY_WRITE_CONCURRENCY writes
+    in progress.  Held in memory, so the limits are per process."""
+
+    def __init__(self, config):
+        self.config = config
+        self.everyone = TokenBucket(config['FLASKY_WRITE_GLOBAL_RATE'], config['FLASKY_WRITE_GLOBAL_BURST'])
+        self.users = OrderedDict()
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(config['FLASKY_WRITE_CONCURRENCY'])
+
+    def bucket(self, key):
+        with self.lock:
+            bucket = self.users.get(key)
+            if bucket is None:
+                bucket = self.users[key] = TokenBucket(self.config['FLASKY_WRITE_RATE'],
+                                                       self.config['FLASKY_WRITE_BURST'])
+                if len(self.users) > self.config['FLASKY_WRITE_USERS']:
+                    self.users.popitem(last=False)
+            else:
+                self.users.move_to_end(key)
+            return bucket
+
+    def admit(self, key):
+        """Take a write slot, or raise 429 with the seconds to wait.  A
+        refused request gives back the tokens it took, so it does not count
+        against the user or everyone."""
+        bucket = self.bucket(key)
+        wait = bucket.take()
+        if not wait:
+            wait = self.everyone.take()
+            if wait:
+                bucket.give()
+        if wait:
+            raise TooManyRequests(retry_after=max(1, math.ceil(wait)))
+        if not self.slots.acquire(timeout=self.config['FLASKY_WRITE_WAIT']):
+            bucket.give()
+            self.everyone.give()
+            raise TooManyRequests(retry_after=1)
+
+    def release(self):
+        self.slots.release()
+
+
+def write_limited(f):
+    """Rate limit the POSTs of a view, see WriteLimiter.  GETs, and so the
+    pages around the forms, are never limited."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        app = current_app._get_current_object()
+        if request.method != 'POST' or not app.config['FLASKY_WRITE_LIMITS']:
+            return f(*args, **kwargs)
+        limiter = app.extensions.get('write_limiter')
+        if limiter is None:
+            limiter = app.extensions.setdefault('write_limiter', WriteLimiter(app.config))
+        key = current_user.get_id() if current_user.is_authenticated else request.remote_addr
+        limiter.admit(key)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            limiter.release()
+    return decorated_function
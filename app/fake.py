@@ -3,15 +3,17 @@ from sqlalchemy.exc import IntegrityError
 from faker import Faker
 from . import db
 from .models import User, Post
+from .hashing import hash_password
 
 
 def users(count=100):
     fake = Faker()
+    password_hash = hash_password('password')
     i = 0
     while i < count:
         u = User(email=fake.email(),
                  username=fake.user_name(),
-                 password='password',
+                 password_hash=password_hash,
                  confirmed=True,
                  name=fake.name(),
                  location=fake.city(),
@@ -0,0 +1,65 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+
+class HashingBusy(Exception):
+    """Raised when a hash could not be computed within FLASKY_HASH_TIMEOUT,
+    either because the pool queue is full or because the work took too long."""
+
+
+def _pool(app):
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            # spawn rather than fork: the app process has threads of its own
+            _executor = ProcessPoolExecutor(max_workers=app.config['FLASKY_HASH_WORKERS'],
+                                            mp_context=multiprocessing.get_context('spawn'))
+            _slots = threading.BoundedSemaphore(app.config['FLASKY_HASH_QUEUE'])
+        return _executor, _slots
+
+
+def _run(fn, *args):
+    """Run `fn` in the hashing pool, or inline when FLASKY_HASH_WORKERS is 0.
+    At most FLASKY_HASH_QUEUE calls are queued or running at once, so a burst
+    of logins waits for a slot instead of piling up work."""
+    app = current_app._get_current_object()
+    if not app.config['FLASKY_HASH_WORKERS']:
+        return fn(*args)
+    timeout = app.config['FLASKY_HASH_TIMEOUT']
+    executor, slots = _pool(app)
+    if not slots.acquire(timeout=timeout):
+        raise HashingBusy()
+    future = executor.submit(fn, *args)
+    future.add_done_callback(lambda f: slots.release())
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel()
+        raise HashingBusy()
+
+
+def hash_password(password):
+    return _run(generate_password_hash, password, current_app.config['FLASKY_HASH_METHOD'],
+                current_app.config['FLASKY_HASH_SALT_LENGTH'])
+
+
+def verify_password(password_hash, password):
+    if not password_hash:
+        return False
+    return _run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """True if the hash was made with a method, cost or salt length other
+    than the configured ones."""
+    method, _, rest = password_hash.partition('$')
+    salt = rest.partition('$')[0]
+    return method != current_app.config['FLASKY_HASH_METHOD'] or \
+        len(salt) != current_app.config['FLASKY_HASH_SALT_LENGTH']
@@ -0,0 +1,244 @@
+import os
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from flask import current_app
+from . import db
+from .models import Job, User
+
+# name -> function; the schedules are in FLASKY_JOBS
+JOBS = {}
+
+
+def job(name):
+    def decorator(f):
+        JOBS[name] = f
+        return f
+    return decorator
+
+
+@job('archive')
+def archive_ledger():
+    from .archive import archive
+    return ', '.join('%s: %d' % item for item in archive().items())
+
+
+@job('reconcile')
+def reconcile_stock():
+    from .reconcile import expected_stock, stock_drift
+    return '%d medicines drifted' % len(stock_drift(expected_stock()))
+
+
+@job('counters')
+def repair_counters():
+    User.repair_counters()
+    return 'counters recomputed'
+
+
+@job('optimize')
+def optimize():
+    # keeps SQLite's statistics current, so the planner picks the right
+    # partial and expression indexes
+    db.session.execute(db.text('PRAGMA optimize'))
+    return 'optimized'
+
+
+@job('backup')
+def backup_database():
+    from .backup import backup
+    return backup(if_due=True)
+
+
+class Cron:
+    """A five-field cron schedule: minute, hour, day of month, month and day
+    of week, each `*`, a number, a range `a-b`, a list `a,b`, or any of
+    those with a `/step`.  Times are UTC, like every timestamp in the app."""
+
+    FIELDS = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('A cron schedule has five fields: %r' % expression)
+        self.minutes, self.hours, self.days, self.months, weekdays = \
+            (self._parse(field, low, high) for field, (low, high) in zip(fields, self.FIELDS))
+        self.weekdays = {weekday % 7 for weekday in weekdays}
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    @staticmethod
+    def _parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = (int(value) for value in part.split('-', 1))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError('Bad cron field %r' % field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, when):
+        day = when.day in self.days
+        weekday = when.isoweekday() % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        # like cron, a restricted day of month and day of week match either
+        return day or weekday
+
+    def next(self, after):
+        """The first matching minute after `after`."""
+        when = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = when + timedelta(days=5 * 366)
+        while when < limit:
+            if when.month not in self.months:
+                when = (when.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(when):
+                when = when.replace(hour=0, minute=0) + timedelta(days=1)
+            elif when.hour not in self.hours:
+                when = when.replace(minute=0) + timedelta(hours=1)
+            elif when.minute not in self.minutes:
+                when += timedelta(minutes=1)
+            else:
+                return when
+        raise ValueError('Schedule never matches')
+
+
+def sync():
+    """Create the rows of jobs that have none and follow schedule changes
+    made in FLASKY_JOBS."""
+    now = datetime.utcnow()
+    schedules = current_app.config['FLASKY_JOBS']
+    jobs = {row.name: row for row in Job.query}
+    for name, schedule in schedules.items():
+        if name not in JOBS:
+            raise ValueError('Unknown job %r' % name)
+        row = jobs.get(name)
+        if row is None:
+            db.session.add(Job(name=name, schedule=schedule, paused=False, next_run=Cron(schedule).next(now)))
+        elif row.schedule != schedule:
+            row.schedule = schedule
+            row.next_run = Cron(schedule).next(now)
+    db.session.commit()
+
+
+def claim(name, owner, force=False):
+    """Lock the job for `owner` if it is due, not paused and not locked by
+    anyone else, in one UPDATE; SQLite runs it atomically, so of all the
+    workers polling the same job only one gets it.  With `force` the job
+    only has to be unlocked."""
+    now = datetime.utcnow()
+    jobs = Job.__table__
+    update = jobs.update().where(jobs.c.name == name) \
+        .where(db.or_(jobs.c.locked_until == None, jobs.c.locked_until < now))
+    if not force:
+        update = update.where(jobs.c.paused == False).where(jobs.c.next_run <= now)
+    result = db.session.execute(update.values(
+        locked_by=owner, locked_until=now + timedelta(seconds=current_app.config['FLASKY_JOBS_LOCK_SECONDS'])))
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def run(name, owner):
+    """Run a job claimed by `owner`, record the outcome and schedule the
+    next run."""
+    try:
+        result, status = JOBS[name](), 'ok'
+    except Exception:
+        db.session.rollback()
+        result, status = traceback.format_exc(), 'failed'
+    now = datetime.utcnow()
+    row = Job.query.get(name)
+    row.last_run = now
+    row.last_status = status
+    row.last_result = result
+    row.next_run = Cron(row.schedule).next(now)
+    if row.locked_by == owner:
+        row.locked_by = row.locked_until = None
+    db.session.commit()
+    return status, result
+
+
+class Scheduler:
+    """Polls the job table every FLASKY_JOBS_POLL seconds from a daemon
+    thread and runs due jobs on a pool of FLASKY_JOBS_WORKERS threads.
+    Every web worker process can run one; the lock in claim() makes sure a
+    run happens once."""
+
+    def __init__(self, app):
+        self.app = app
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.workers = app.config['FLASKY_JOBS_WORKERS']
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        self.running = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        with self.app.app_context():
+            sync()
+        self.thread = threading.Thread(target=self._loop, name='jobs', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=True)
+
+    def _loop(self):
+        while not self.stopped.wait(self.app.config['FLASKY_JOBS_POLL']):
+            try:
+                with self.app.app_context():
+                    self.tick()
+            except Exception:
+                self.app.logger.exception('Job scheduler tick failed')
+
+    def tick(self):
+        due = [name for name, in db.session.query(Job.name)
+               .filter(Job.paused == False, Job.next_run <= datetime.utcnow())
+               .order_by(Job.next_run)]
+        for name in due:
+            with self.lock:
+                if len(self.running) >= self.workers or name in self.running or name not in JOBS:
+                    continue
+                if not claim(name, self.owner):
+                    continue
+                self.running.add(name)
+            self.executor.submit(self._run, name)
+
+    def _run(self, name):
+        try:
+            with self.app.app_context():
+                run(name, self.owner)
+        finally:
+            with self.lock:
+                self.running.discard(name)
+
+
+def init_app(app):
+    """Start a scheduler in the process on its first request, so that CLI
+    commands and the process that preloads the app never run one.  If it
+    cannot start, e.g. because the jobs table is missing, the error is logged
+    and the app serves requests without one."""
+    if not app.config['FLASKY_JOBS_ENABLED']:
+        return
+
+    @app.before_first_request
+    def start_scheduler():
+        if 'scheduler' not in app.extensions:
+            scheduler = Scheduler(app)
+            try:
+                scheduler.start()
+            except Exception:
+                app.logger.exception('Job scheduler not started')
+                scheduler.stop()
+                return
+            app.extensions['scheduler'] = scheduler
@@ -0,0 +1,38 @@
+# The JSON list endpoints under /api, as plain SQL shared by the Flask views
+# and the async read path in app.aio, so that both return the same pages.
+# Paging asks for one row more than a page to know whether there is a next.
+
+QUERIES = {
+    "inventory": (
+        "SELECT medicine_id, medicine_name, medicine_type, count, warning_count "
+        "FROM inventory ORDER BY medicine_id DESC LIMIT :limit OFFSET :offset"),
+    "medicine": (
+        "SELECT medicine_id, medicine_name, medicine_type, medicine_factory "
+        "FROM Medicine WHERE active ORDER BY medicine_id LIMIT :limit OFFSET :offset"),
+    "warning": (
+        "SELECT medicine_id, count, warning_count, coalesce(count, 0) < warning_count AS warning "
+        "FROM inventory WHERE warning_count IS NOT NULL "
+        "ORDER BY medicine_id DESC LIMIT :limit OFFSET :offset"),
+    # served by ix_inventory_shortfall
+    "warning/triggered": (
+        "SELECT medicine_id, count, warning_count, 1 AS warning "
+        "FROM inventory WHERE count - warning_count < 0 "
+        "ORDER BY medicine_id DESC LIMIT :limit OFFSET :offset"),
+}
+
+
+def params(page, per_page):
+    page = max(page or 1, 1)
+    return {"limit": per_page + 1, "offset": (page - 1) * per_page}
+
+
+def result(rows, columns, page, per_page):
+    """The JSON body for one page of rows."""
+    items = []
+    for row in rows[:per_page]:
+        item = dict(zip(columns, row))
+        if "warning" in item:
+            item["warning"] = bool(item["warning"])
+        items.append(item)
+    page = max(page or 1, 1)
+    return {"items": items, "page": page, "next": page + 1 if len(rows) > per_page else None}
@@ -0,0 +1,154 @@
+import asyncio
+import collections
+import itertools
+import json
+import threading
+from . import db
+from .models import Inventory
+
+# In-process pub/sub of inventory changes for the live tables.  Model code
+# calls Inventory.touch() with the medicines it changed; just before the
+# session commits their new counts are read, and once the commit went
+# through they are pushed to every open stream.  Rolled back changes are
+# never published.  Subscribers only live in this process, so with several
+# worker processes a screen sees the movements made through its own worker.
+#
+# stream() holds a thread for as long as the screen is open, so behind a plain
+# WSGI server it needs a threaded or gevent worker; ReadPath in app.aio serves
+# the stream with stream_async() on the event loop instead.
+CHANGED = "inventory_changed"
+PENDING = "inventory_deltas"
+
+_subscribers = set()
+# replaces the backlog of a dropped subscriber
+RESET = None
+_lock = threading.Lock()
+_sequence = itertools.count(1)
+
+
+def _before_commit(session):
+    medicine_ids = session.info.pop(CHANGED, None)
+    if medicine_ids:
+        rows = session.query(Inventory.medicine_id, Inventory.count, Inventory.warning_count) \
+            .filter(Inventory.medicine_id.in_(list(medicine_ids))).all()
+        session.info[PENDING] = [{"medicine_id": medicine_id, "count": count, "warning_count": warning_count,
+                                  "warning": warning_count is not None and (count or 0) < warning_count}
+                                 for medicine_id, count, warning_count in rows]
+
+
+def _after_commit(session):
+    deltas = session.info.pop(PENDING, None)
+    if deltas:
+        publish(deltas)
+
+
+def _after_rollback(session):
+    session.info.pop(CHANGED, None)
+    session.info.pop(PENDING, None)
+
+
+db.event.listen(db.session, 'before_commit', _before_commit)
+db.event.listen(db.session, 'after_commit', _after_commit)
+db.event.listen(db.session, 'after_soft_rollback', lambda session, previous: _after_rollback(session))
+
+
+class _Subscriber:
+    """The events not yet sent to one stream.  `wakeup` is called whenever
+    events are added, from whatever thread committed them."""
+
+    def __init__(self, size, wakeup):
+        self.events = collections.deque()
+        self.size = size
+        self.wakeup = wakeup
+
+
+def _subscribe(size, wakeup):
+    subscriber = _Subscriber(size, wakeup)
+    with _lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+
+def _unsubscribe(subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def _take(subscriber):
+    """Take the pending events of `subscriber` as SSE lines; the second item
+    is True when the stream was dropped and must end."""
+    with _lock:
+        events = list(subscriber.events)
+        subscriber.events.clear()
+    if RESET in events:
+        return ["event: reset\ndata: \n\n"], True
+    return ["id: %d\nevent: inventory\ndata: %s\n\n" % event for event in events], False
+
+
+def publish(deltas):
+    """Queue one event with the given deltas for every subscriber.  A
+    subscriber whose queue is full is dropped: its backlog is replaced by a
+    reset, so that its stream tells the client to reload right away instead
+    of silently missing changes."""
+    event = (next(_sequence), json.dumps(deltas))
+    with _lock:
+        for subscriber in list(_subscribers):
+            if len(subscriber.events) < subscriber.size:
+                subscriber.events.append(event)
+            else:
+                _subscribers.discard(subscriber)
+                subscriber.events.clear()
+                subscriber.events.append(RESET)
+            subscriber.wakeup()
+
+
+def stream(heartbeat, size):
+    """Server-sent events for one client.  The generator sleeps on its own
+    event between changes, so an idle screen costs a sleeping thread and a
+    comment line every `heartbeat` seconds, which is also how a closed
+    connection is noticed."""
+    pending = threading.Event()
+    subscriber = _subscribe(size, pending.set)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            if not pending.wait(heartbeat):
+                yield ": keep-alive\n\n"
+                continue
+            pending.clear()
+            lines, dropped = _take(subscriber)
+            for line in lines:
+                yield line
+            if dropped:
+                return
+    finally:
+        _unsubscribe(subscriber)
+
+
+async def stream_async(heartbeat, size):
+    """stream() for the event loop: waiting for changes costs no thread, the
+    committing thread wakes the loop up."""
+    loop = asyncio.get_running_loop()
+    pending = asyncio.Event()
+
+    def wakeup():
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(pending.set)
+
+    subscriber = _subscribe(size, wakeup)
+    try:
+        yield "retry: 5000\n\n"
+        while True:
+            try:
+                await asyncio.wait_for(pending.wait(), heartbeat)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            pending.clear()
+            lines, dropped = _take(subscriber)
+            for line in lines:
+                yield line
+            if dropped:
+                return
+    finally:
+        _unsubscribe(subscriber)
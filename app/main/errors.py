@@ -12,6 +12,11 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
+@main.app_errorhandler(429)
+def too_many_requests(e):
+    return render_template('429.html'), 429, {'Retry-After': str(e.retry_after or 1)}
+
+
 @main.app_errorhandler(500)
 def internal_server_error(e):
     return render_template('500.html'), 500
@@ -1,9 +1,12 @@
+from decimal import Decimal, InvalidOperation
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, BooleanField, SelectField, SubmitField, IntegerField
 from wtforms.validators import DataRequired, Length, Email, Regexp
 from wtforms import ValidationError
 from flask_pagedown.fields import PageDownField
-from ..models import Role, User, Purchase, Storage, Inventory, Medicine
+from flask_wtf.file import FileField, FileRequired
+from ..models import Role, Purchase, Storage, Medicine, AllocateOrder
+from .. import repository
 
 
 class NameForm(FlaskForm):
@@ -40,13 +43,11 @@ class EditProfileAdminForm(FlaskForm):
         self.user = user
 
     def validate_email(self, field):
-        if field.data != self.user.email and \
-                User.query.filter_by(email=field.data).first():
+        if field.data != self.user.email and repository.email_taken(field.data):
             raise ValidationError('Email already registered.')
 
     def validate_username(self, field):
-        if field.data != self.user.username and \
-                User.query.filter_by(username=field.data).first():
+        if field.data != self.user.username and repository.username_taken(field.data):
             raise ValidationError('Username already in use.')
 
 
@@ -63,6 +64,7 @@ class CommentForm(FlaskForm):
 class PurchaseForm(FlaskForm):
     medicine_id = StringField("Enter the medicine id", validators=[DataRequired()])
     count = StringField("Enter the count", validators=[DataRequired()])
+    unit_cost = StringField("Enter the unit cost")
     submit = SubmitField("Submit")
 
     def validate_count(self, field):
@@ -71,57 +73,118 @@ class PurchaseForm(FlaskForm):
         except TypeError:
             raise ValidationError("Please enter the correct count")
 
+    def validate_unit_cost(self, field):
+        # kept in cents, so that running stock values add up exactly
+        if not field.data:
+            field.data = None
+            return
+        try:
+            cost = Decimal(field.data)
+        except InvalidOperation:
+            raise ValidationError("Please enter the correct unit cost")
+        if cost < 0 or cost != cost.quantize(Decimal("0.01")):
+            raise ValidationError("Please enter the correct unit cost")
+        field.data = int(cost * 100)
+
     def validate_medicine_id(self, field):
-        medicine = Medicine.query.filter_by(medicine_id=field.data).first()
-        if not medicine:
+        try:
+            active = repository.medicine_active(int(field.data))
+        except ValueError:
+            active = None
+        if active is None:
             raise ValidationError("Please enter the correct medicine id from Medicine Table ")
+        if active == False:
+            raise ValidationError("This medicine is no longer in the catalog")
+
+
+def parse_ids(data):
+    """Split scanned ids separated by commas, spaces or new lines, dropping
+    duplicates but keeping the scan order."""
+    ids = []
+    for text in data.replace(",", " ").split():
+        try:
+            value = int(text)
+        except ValueError:
+            raise ValidationError("%s is not a correct id" % text)
+        if value not in ids:
+            ids.append(value)
+    return ids
 
 
 class RefundForm(FlaskForm):
-    purchase_id = StringField("Enter the previous purchase id", validators=[DataRequired()])
+    purchase_id = TextAreaField("Enter the previous purchase ids", validators=[DataRequired()])
     submit = SubmitField("Submit")
 
     def validate_purchase_id(self, field):
-        truncation = Purchase.query.filter_by(id=field.data).first()
-        if not truncation:
-            raise ValidationError("We don't have this truncation")
-        return_goods = truncation.return_goods
-        if return_goods:
-            raise ValidationError("Goods have been returned!")
+        self.purchase_ids = parse_ids(field.data)
+        flags = Purchase.flags(self.purchase_ids)
+        errors = []
+        leaving = {}
+        for purchase_id in self.purchase_ids:
+            truncation = flags.get(purchase_id)
+            if not truncation:
+                errors.append("We don't have truncation %d" % purchase_id)
+            elif truncation.return_goods:
+                errors.append("Goods of truncation %d have been returned!" % purchase_id)
+            elif truncation.have_storage:
+                leaving[truncation.medicine_id] = leaving.get(truncation.medicine_id, 0) + truncation.count
+                if truncation.stock < leaving[truncation.medicine_id]:
+                    errors.append("Goods of truncation %d have already been allocated!" % purchase_id)
+        if errors:
+            raise ValidationError("; ".join(errors))
 
 
 class StorageForm(FlaskForm):
-    storage_items_id = StringField("Enter the truncation ID can storage into warehouse", validators=[DataRequired()])
+    storage_items_id = TextAreaField("Enter the truncation IDs can storage into warehouse",
+                                     validators=[DataRequired()])
 
     submit = SubmitField("Submit")
 
     def validate_storage_items_id(self, field):
-        truncation = Purchase.query.filter_by(id=field.data).first()
-        if not truncation:
-            raise ValidationError("We don't have this truncation")
-        if truncation.return_goods:
-            raise ValidationError("Goods have been returned!")
-        if truncation.have_storage:
-            raise ValidationError("Goods have been stored!")
+        self.purchase_ids = parse_ids(field.data)
+        flags = Purchase.flags(self.purchase_ids)
+        errors = []
+        for purchase_id in self.purchase_ids:
+            truncation = flags.get(purchase_id)
+            if not truncation:
+                errors.append("We don't have truncation %d" % purchase_id)
+            elif truncation.return_goods:
+                errors.append("Goods of truncation %d have been returned!" % purchase_id)
+            elif truncation.have_storage:
+                errors.append("Goods of truncation %d have been stored!" % purchase_id)
+        if errors:
+            raise ValidationError("; ".join(errors))
 
 
 class AllocateForm(FlaskForm):
     receiver = StringField("Enter the receiver ID", validators=[DataRequired()])
-    medicine_id = StringField("Enter the medicine_id", validators=[DataRequired()])
-    count = StringField("Enter the count", validators=[DataRequired()])
+    items = TextAreaField("Enter one medicine_id and count per line", validators=[DataRequired()])
     submit = SubmitField("Submit")
 
-    def validate_medicine_id(self, field):
-        truncation = Inventory.query.filter_by(medicine_id=field.data).first()
-        if not truncation:
-            raise ValidationError("We don't have this medicine in warehouse!")
-
-    def validate_count(self, field):
-        truncation = Inventory.query.filter_by(medicine_id=self.medicine_id.data).first()
-        if not truncation:
-            raise ValidationError("We don't have this medicine in warehouse!")
-        if truncation.count < int(field.data):
-            raise ValidationError("We don't have enough medicine. ")
+    def validate_items(self, field):
+        self.lines = []
+        errors = []
+        for number, text in enumerate(field.data.splitlines(), 1):
+            if not text.strip():
+                continue
+            parts = text.replace(",", " ").split()
+            try:
+                medicine_id, count = int(parts[0]), int(parts[1])
+            except (ValueError, IndexError):
+                errors.append("Line %d: please enter the medicine id and the count" % number)
+                continue
+            if len(parts) != 2 or count <= 0:
+                errors.append("Line %d: please enter the correct count" % number)
+                continue
+            self.lines.append((medicine_id, count))
+        if errors:
+            raise ValidationError("; ".join(errors))
+        if not self.lines:
+            raise ValidationError("Please enter at least one medicine")
+        shortages = AllocateOrder.shortages(self.lines)
+        if shortages:
+            raise ValidationError("; ".join(
+                "Medicine %d: %d requested but only %d in warehouse" % shortage for shortage in shortages))
 
 
 class AccountForm(FlaskForm):
@@ -140,6 +203,15 @@ class InventoryWarningForm(FlaskForm):
     submit = SubmitField("Submit")
 
     def validate_medicine_id(self, field):
-        truncation = Inventory.query.filter_by(medicine_id=self.medicine_id.data).first()
-        if not truncation:
+        if not repository.in_stock(self.medicine_id.data):
             raise ValidationError("We don't have this medicine in warehouse!")
+
+
+class StockTakeForm(FlaskForm):
+    counts = FileField("Upload the counted stock as medicine_id,count CSV", validators=[FileRequired()])
+    full = BooleanField("Count medicines missing from the file as zero")
+    submit = SubmitField("Upload")
+
+
+class PostStockTakeForm(FlaskForm):
+    submit = SubmitField("Post adjustments")
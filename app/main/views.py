@@ -1,15 +1,20 @@
 import datetime
+import io
 
 from flask import render_template, redirect, url_for, abort, flash, request, \
-    current_app, make_response
+    current_app, make_response, Response, jsonify
 from flask_login import login_required, current_user
 from . import main
 from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm, PurchaseForm, RefundForm, StorageForm, \
-    AllocateForm, AccountForm, InventoryWarningForm
+    AllocateForm, AccountForm, InventoryWarningForm, StockTakeForm, PostStockTakeForm
 from .. import db
-from ..models import Permission, Role, User, Post, Comment, Inventory, Purchase, Refund, Storage, Allocate, Medicine, \
-    Warning
-from ..decorators import admin_required, permission_required
+from ..models import Permission, Role, User, Follow, Post, Comment, Inventory, Purchase, Refund, Storage, Allocate, \
+    Medicine, AllocateOrder, Valuation, CostOfGoods, StockTake
+from ..decorators import admin_required, permission_required, read_only, write_limited
+from ..archive import ledger, lookup
+from ..analytics import summary
+from ..search import search as search_index
+from .. import live, lists, repository, stocktake
 
 
 @main.route('/', methods=['GET', 'POST'])
@@ -26,12 +31,12 @@ def index():
     if current_user.is_authenticated:
         show_followed = bool(request.cookies.get('show_followed', ''))
     if show_followed:
-        query = current_user.followed_posts
+        pagination = current_user.followed_posts_page(
+            page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
     else:
-        query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
-        error_out=False)
+        pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
+            page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+            error_out=False)
     posts = pagination.items
     return render_template('index.html', form=form, posts=posts,
                            show_followed=show_followed, pagination=pagination)
@@ -39,14 +44,18 @@ def index():
 
 @main.route('/user/<username>')
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = repository.user_by_username(username)
+    if user is None:
+        abort(404)
     page = request.args.get('page', 1, type=int)
     pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     posts = pagination.items
+    following, followed_by = current_user.follow_states([user.id])[user.id]
     return render_template('user.html', user=user, posts=posts,
-                           pagination=pagination)
+                           pagination=pagination, following=following,
+                           followed_by=followed_by)
 
 
 @main.route('/edit-profile', methods=['GET', 'POST'])
@@ -109,7 +118,7 @@ def post(id):
         return redirect(url_for('.post', id=post.id, page=-1))
     page = request.args.get('page', 1, type=int)
     if page == -1:
-        page = (post.comments.count() - 1) // \
+        page = (post.comments_count - 1) // \
                current_app.config['FLASKY_COMMENTS_PER_PAGE'] + 1
     pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
         page, per_page=current_app.config['FLASKY_COMMENTS_PER_PAGE'],
@@ -141,7 +150,7 @@ def edit(id):
 @login_required
 @permission_required(Permission.FOLLOW)
 def follow(username):
-    user = User.query.filter_by(username=username).first()
+    user = repository.user_by_username(username)
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
@@ -158,7 +167,7 @@ def follow(username):
 @login_required
 @permission_required(Permission.FOLLOW)
 def unfollow(username):
-    user = User.query.filter_by(username=username).first()
+    user = repository.user_by_username(username)
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
@@ -173,36 +182,40 @@ def unfollow(username):
 
 @main.route('/followers/<username>')
 def followers(username):
-    user = User.query.filter_by(username=username).first()
+    user = repository.user_by_username(username)
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    pagination = user.followers.paginate(
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
-    follows = [{'user': item.follower, 'timestamp': item.timestamp}
-               for item in pagination.items]
+    pagination = User.query.join(Follow, Follow.follower_id == User.id) \
+        .filter(Follow.followed_id == user.id).add_columns(Follow.timestamp).paginate(
+            page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
+            error_out=False)
+    follows = [{'user': item, 'timestamp': timestamp}
+               for item, timestamp in pagination.items]
+    states = current_user.follow_states([follow['user'].id for follow in follows])
     return render_template('followers.html', user=user, title="Followers of",
                            endpoint='.followers', pagination=pagination,
-                           follows=follows)
+                           follows=follows, states=states)
 
 
 @main.route('/followed_by/<username>')
 def followed_by(username):
-    user = User.query.filter_by(username=username).first()
+    user = repository.user_by_username(username)
     if user is None:
         flash('Invalid user.')
         return redirect(url_for('.index'))
     page = request.args.get('page', 1, type=int)
-    pagination = user.followed.paginate(
-        page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
-        error_out=False)
-    follows = [{'user': item.followed, 'timestamp': item.timestamp}
-               for item in pagination.items]
+    pagination = User.query.join(Follow, Follow.followed_id == User.id) \
+        .filter(Follow.follower_id == user.id).add_columns(Follow.timestamp).paginate(
+            page, per_page=current_app.config['FLASKY_FOLLOWERS_PER_PAGE'],
+            error_out=False)
+    follows = [{'user': item, 'timestamp': timestamp}
+               for item, timestamp in pagination.items]
+    states = current_user.follow_states([follow['user'].id for follow in follows])
     return render_template('followers.html', user=user, title="Followed by",
                            endpoint='.followed_by', pagination=pagination,
-                           follows=follows)
+                           follows=follows, states=states)
 
 
 @main.route('/all')
@@ -221,6 +234,20 @@ def show_followed():
     return resp
 
 
+@main.route('/search')
+@read_only
+def search():
+    q = request.args.get('q', '', type=str)
+    kind = 'comments' if request.args.get('kind') == 'comments' else 'posts'
+    after = None
+    if 'rank' in request.args and 'after' in request.args:
+        after = (request.args.get('rank', type=float), request.args.get('after', type=int))
+    items, next_key = search_index(Comment if kind == 'comments' else Post, q, after,
+                                   per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+                                   include_disabled=current_user.can(Permission.MODERATE))
+    return render_template('search.html', q=q, kind=kind, posts=items, comments=items, next_key=next_key)
+
+
 @main.route('/moderate')
 @login_required
 @permission_required(Permission.MODERATE)
@@ -279,11 +306,12 @@ def moderate_disable(id):
 
 @main.route('/purchase', methods=['GET', 'POST'])
 @login_required
+@write_limited
 def purchase():
     form = PurchaseForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
         purchase_item = Purchase(medicine_id=form.medicine_id.data, count=form.count.data,
-                                 author=current_user._get_current_object())
+                                 unit_cost=form.unit_cost.data, author=current_user._get_current_object())
         db.session.add(purchase_item)
         db.session.commit()
         return redirect(url_for('.purchase'))
@@ -299,69 +327,72 @@ def purchase():
 
 @main.route('/return_goods', methods=['GET', "POST"])
 @login_required
+@write_limited
 def return_goods():
     form = RefundForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
-        return_goods_item = Refund(purchase_id=form.purchase_id.data,
-                                   author=current_user._get_current_object())
-        db.session.add(return_goods_item)
-        query = Purchase.query.filter_by(id=form.purchase_id.data).first()
-        query.return_goods = True
-        db.session.add(query)
-        db.session.commit()
+        if Refund.return_purchases(form.purchase_ids, current_user._get_current_object()):
+            flash('%d purchases have been refunded.' % len(form.purchase_ids))
+        else:
+            flash('Some purchases changed meanwhile, nothing has been refunded. Please check again.')
         return redirect(url_for('.return_goods'))
     page = request.args.get('page', 1, type=int)
     pagination = Refund.query.order_by(Refund.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     return_goods_items = pagination.items
+    purchases = lookup(Purchase, [item.purchase_id for item in return_goods_items])
     return render_template('return_goods.html', form=form, return_goods_items=return_goods_items, pagination=pagination,
-                           Purchase=Purchase)
+                           purchases=purchases)
+
+
+def purchase_queue(title, endpoint, source):
+    medicine_id = request.args.get('medicine_id', None, type=int)
+    after = request.args.get('after', None, type=int)
+    purchase_items, next_after = source(medicine_id=medicine_id, after=after,
+                                        per_page=current_app.config['FLASKY_POSTS_PER_PAGE'])
+    return render_template('purchase_queue.html', title=title, endpoint=endpoint, medicine_id=medicine_id,
+                           purchase_items=purchase_items, next_after=next_after)
+
+
+@main.route("/return_goods/eligible")
+@login_required
+@read_only
+def return_goods_eligible():
+    return purchase_queue('Refundable Purchases', '.return_goods_eligible', Purchase.refundable)
+
+
+@main.route("/storage/pending")
+@login_required
+@read_only
+def storage_pending():
+    return purchase_queue('Pending Receipts', '.storage_pending', Purchase.pending)
 
 
 @main.route("/storage", methods=["GET", "POST"])
 @login_required
+@write_limited
 def storage():
     form = StorageForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
-        storage_item = Storage(purchase_id=form.storage_items_id.data, author=current_user._get_current_object())
-        db.session.add(storage_item)
-        query = Purchase.query.filter_by(id=form.storage_items_id.data).first()
-        query.have_storage = True
-
-        temp_query = Inventory.query.filter_by(medicine_id=query.medicine_id).first()
-
-        if temp_query:
-            temp_query.count += int(query.count)
-            # inventory_item = Inventory(medicine_id=query.medicine_id, count=query.count + temp_query.count)
+        if Storage.receive(form.purchase_ids, current_user._get_current_object()):
+            flash('%d purchases have been put in storage.' % len(form.purchase_ids))
         else:
-            medicine_feature = Medicine.query.filter_by(medicine_id=query.medicine_id).first()
-            temp_query = Inventory(medicine_id=query.medicine_id, medicine_name=medicine_feature.medicine_name,
-                                   medicine_type=medicine_feature.medicine_type, count=query.count)
-        db.session.add(temp_query)
-        db.session.add(query)
-        db.session.commit()
-
-        # warning check
-        warning_items = Warning.query.filter_by(medicine_id=query.medicine_id).first()
-        if warning_items:
-            warning_items.count = temp_query.count
-            warning_items.warning = warning_items.count < warning_items.warning_count
-            db.session.add(warning_items)
-            db.session.commit()
-
+            flash('Some purchases changed meanwhile, nothing has been stored. Please check again.')
         return redirect(url_for('.storage'))
     page = request.args.get('page', 1, type=int)
     pagination = Storage.query.order_by(Storage.timestamp.desc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     storage_items = pagination.items
+    purchases = lookup(Purchase, [item.purchase_id for item in storage_items])
     return render_template('storage.html', form=form, storage_items=storage_items, pagination=pagination,
-                           Purchase=Purchase)
+                           purchases=purchases)
 
 
 @main.route("/inventory", methods=["GET", "POST"])
 @login_required
+@read_only
 def inventory():
     page = request.args.get('page', 1, type=int)
     pagination = Inventory.query.order_by(Inventory.medicine_id.desc()).paginate(
@@ -371,45 +402,94 @@ def inventory():
     return render_template('inventory.html', inventory_items=inventory_items, pagination=pagination)
 
 
+@main.route("/api/<path:name>")
+@login_required
+@read_only
+def api_list(name):
+    if name not in lists.QUERIES:
+        abort(404)
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['FLASKY_POSTS_PER_PAGE']
+    result = db.session.execute(db.text(lists.QUERIES[name]), lists.params(page, per_page))
+    return jsonify(lists.result(result.fetchall(), list(result.keys()), page, per_page))
+
+
+@main.route("/inventory/stream")
+@login_required
+def inventory_stream():
+    stream = live.stream(current_app.config['FLASKY_LIVE_HEARTBEAT'], current_app.config['FLASKY_LIVE_QUEUE'])
+    return Response(stream, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @main.route('/allocate', methods=['GET', "POST"])
 @login_required
+@write_limited
 def allocate():
     form = AllocateForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
-        allocate_item = Allocate(medicine_id=form.medicine_id.data,
-                                 receiver=form.receiver.data,
-                                 count=form.count.data,
-                                 author=current_user._get_current_object())
-        db.session.add(allocate_item)
-
-        query = Inventory.query.filter_by(medicine_id=form.medicine_id.data).first()
-        query.count -= int(form.count.data)
-        query = Inventory.query.filter_by(medicine_id=form.medicine_id.data).first()
-        if query.count == 0:
-            db.session.delete(query)
-            db.session.commit()
+        order, shortages = AllocateOrder.place(form.receiver.data, form.lines,
+                                               current_user._get_current_object())
+        if order is not None:
+            flash('Allocate order %d has been placed.' % order.id)
+            return redirect(url_for('.allocate'))
+        form.items.errors.extend("Medicine %d: %d requested but only %d in warehouse" % shortage
+                                 for shortage in shortages)
+    page = request.args.get('page', 1, type=int)
+    pagination = AllocateOrder.query.options(db.selectinload(AllocateOrder.items)) \
+        .order_by(AllocateOrder.timestamp.desc()).paginate(
+        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+        error_out=False)
+    allocate_orders = pagination.items
+    return render_template('allocate.html', form=form, allocate_orders=allocate_orders, pagination=pagination)
+
+
+@main.route("/stocktake", methods=["GET", "POST"])
+@login_required
+@write_limited
+def stock_take():
+    form = StockTakeForm()
+    if current_user.can(Permission.WRITE) and form.validate_on_submit():
+        stream = io.TextIOWrapper(form.counts.data.stream, encoding="utf-8-sig", newline="")
+        try:
+            item = stocktake.start(stocktake.read_csv(stream), current_user._get_current_object(),
+                                   full=form.full.data)
+        except ValueError as e:
+            db.session.rollback()
+            form.counts.errors.append(str(e))
         else:
-            db.session.add(query)
-            db.session.commit()
+            return redirect(url_for('.stock_take_review', id=item.id))
+    page = request.args.get('page', 1, type=int)
+    pagination = StockTake.query.order_by(StockTake.timestamp.desc()).paginate(
+        page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
+        error_out=False)
+    return render_template('stocktake.html', form=form, stock_takes=pagination.items, pagination=pagination)
 
-        warning_items = Warning.query.filter_by(medicine_id=form.medicine_id.data).first()
-        if warning_items:
-            warning_items.count = Inventory.query.filter_by(medicine_id=form.medicine_id.data).first().count
-            warning_items.warning = warning_items.count < warning_items.warning_count
-            db.session.add(warning_items)
-            db.session.commit()
 
-        return redirect(url_for('.allocate'))
+@main.route("/stocktake/<int:id>", methods=["GET", "POST"])
+@login_required
+@write_limited
+def stock_take_review(id):
+    item = StockTake.query.get_or_404(id)
+    form = PostStockTakeForm()
+    if current_user.can(Permission.WRITE) and item.posted is None and form.validate_on_submit():
+        posted = stocktake.post(item, current_user._get_current_object())
+        if posted is None:
+            flash('Stock take %d has been posted already.' % id)
+        else:
+            flash('Stock take %d posted with %d adjustments.' % (id, posted))
+        return redirect(url_for('.stock_take_review', id=id))
     page = request.args.get('page', 1, type=int)
-    pagination = Allocate.query.order_by(Allocate.timestamp.desc()).paginate(
+    pagination = stocktake.variances(item).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
-    allocate_items = pagination.items
-    return render_template('allocate.html', form=form, allocate_items=allocate_items, pagination=pagination)
+    return render_template('stocktake_review.html', form=form, stock_take=item, totals=stocktake.totals(item),
+                           lines=pagination.items, pagination=pagination)
 
 
 @main.route("/account", methods=["GET", "POST"])
 @login_required
+@read_only
 def account():
     form = AccountForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
@@ -417,24 +497,25 @@ def account():
         end_year, end_month, end_day = form.end_year.data, form.end_month.data, form.end_day.data
         start_time = datetime.date(year=start_year, month=start_month, day=start_day)
         end_time = datetime.date(year=end_year, month=end_month, day=end_day)
-        # purchase_query = db.session.query(Purchase).filter(Purchase.timestamp <= end_time).all()
-        purchase_query = Purchase.query.filter(Purchase.timestamp <= end_time).filter(
-            Purchase.timestamp >= start_time).all()
-        return_query = Refund.query.filter(Refund.timestamp <= end_time).filter(Refund.timestamp >= start_time).all()
-        storage_query = Storage.query.filter(Storage.timestamp <= end_time).filter(
-            Storage.timestamp >= start_time).all()
-        allocate_query = Allocate.query.filter(Allocate.timestamp <= end_time).filter(
-            Allocate.timestamp >= start_time).all()
+        purchase_query = ledger(Purchase, start_time, end_time)
+        return_query = ledger(Refund, start_time, end_time)
+        storage_query = ledger(Storage, start_time, end_time)
+        allocate_query = ledger(Allocate, start_time, end_time)
+        purchases = lookup(Purchase, [item.purchase_id for item in return_query + storage_query])
         return render_template('account.html', form=form, purchase_query=purchase_query, return_query=return_query,
-                               storage_query=storage_query, allocate_query=allocate_query, Purchase=Purchase)
+                               storage_query=storage_query, allocate_query=allocate_query, purchases=purchases,
+                               summary=summary(start_time, end_time), stock_value=Valuation.totals(),
+                               cost_of_goods=CostOfGoods.between(start_time, end_time))
     return render_template('account.html', form=form)
 
 
 @main.route("/medicine", methods=['GET', "POST"])
 @login_required
+@read_only
 def medicine():
     page = request.args.get('page', 1, type=int)
-    pagination = Medicine.query.order_by(Medicine.medicine_id.asc()).paginate(
+    pagination = Medicine.query.filter(Medicine.active == True) \
+        .order_by(Medicine.medicine_id.asc()).paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     medicine_items = pagination.items
@@ -443,28 +524,19 @@ def medicine():
 
 @main.route("/warning", methods=['GET', "POST"])
 @login_required
+@write_limited
 def warning():
     form = InventoryWarningForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
-        query = Warning.query.filter_by(medicine_id=form.medicine_id.data).first()
-        if not query:
-            warning_items = Warning(medicine_id=form.medicine_id.data,
-                                    count=Inventory.query.filter_by(medicine_id=form.medicine_id.data).first().count,
-                                    warning_count=form.warning_count.data,
-                                    warning=Inventory.query.filter_by(
-                                        medicine_id=form.medicine_id.data).first().count < form.warning_count.data)
-            db.session.add(warning_items)
-            db.session.commit()
-        else:
-            query.warning_count = form.warning_count.data
-            query.warning = Inventory.query.filter_by(
-                medicine_id=form.medicine_id.data).first().count < form.warning_count.data
-            db.session.add(query)
-            db.session.commit()
+        repository.set_warning_count(form.medicine_id.data, form.warning_count.data)
+        db.session.commit()
         return redirect(url_for('.warning'))
     page = request.args.get('page', 1, type=int)
-    pagination = Warning.query.order_by(Warning.medicine_id.desc()).paginate(
+    triggered = request.args.get('triggered', 0, type=int)
+    query = Inventory.triggered() if triggered else Inventory.warnings()
+    pagination = query.paginate(
         page, per_page=current_app.config['FLASKY_POSTS_PER_PAGE'],
         error_out=False)
     warning_items = pagination.items
-    return render_template('warning.html', form=form, warning_items=warning_items, pagination=pagination)
+    return render_template('warning.html', form=form, warning_items=warning_items, pagination=pagination,
+                           triggered=triggered)
@@ -1,12 +1,15 @@
+from collections import defaultdict
 from datetime import datetime
 import hashlib
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.hybrid import hybrid_property
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from markdown import markdown
 import bleach
-from flask import current_app, request
+from flask import current_app, request, g
 from flask_login import UserMixin, AnonymousUserMixin
-from . import db, login_manager
+from flask_sqlalchemy import Pagination
+from . import db, login_manager, hashing
 
 
 class Permission:
@@ -70,6 +73,13 @@ class Role(db.Model):
         return '<Role %r>' % self.name
 
 
+def bump_counters(connection, table, id, delta, *columns):
+    """Add `delta` to the counter `columns` of one row, in the transaction
+    of the flush that created or deleted the counted row."""
+    connection.execute(table.update().where(table.c.id == id).values(
+        {name: db.func.coalesce(table.c[name], 0) + delta for name in columns}))
+
+
 class Follow(db.Model):
     __tablename__ = 'follows'
     follower_id = db.Column(db.Integer, db.ForeignKey('users.id'),
@@ -78,6 +88,38 @@ class Follow(db.Model):
                             primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_count(delta):
+        def listener(mapper, connection, target):
+            bump_counters(connection, User.__table__, target.follower_id, delta, 'followed_count')
+            bump_counters(connection, User.__table__, target.followed_id, delta, 'followers_count')
+        return listener
+
+
+class Timeline(db.Model):
+    """The newest followed posts of a user, filled when a post is created so
+    that the followed feed is one range read instead of a join."""
+    __tablename__ = 'timelines'
+    __table_args__ = (db.Index('ix_timelines_user_timestamp', 'user_id', 'timestamp'),)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('posts.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+
+    @staticmethod
+    def trim(executor, user_ids):
+        """Drop everything but the newest FLASKY_TIMELINE_LENGTH entries from
+        the timelines of `user_ids`, which may be a list or a subquery."""
+        timeline = Timeline.__table__
+        newer = timeline.alias()
+        cutoff = db.select(newer.c.timestamp) \
+            .where(newer.c.user_id == timeline.c.user_id) \
+            .order_by(newer.c.timestamp.desc()) \
+            .limit(1).offset(current_app.config['FLASKY_TIMELINE_LENGTH'] - 1) \
+            .scalar_subquery()
+        executor.execute(timeline.delete()
+                         .where(timeline.c.user_id.in_(user_ids))
+                         .where(timeline.c.timestamp < cutoff))
+
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -93,6 +135,11 @@ class User(UserMixin, db.Model):
     member_since = db.Column(db.DateTime(), default=datetime.utcnow)
     last_seen = db.Column(db.DateTime(), default=datetime.utcnow)
     avatar_hash = db.Column(db.String(32))
+    timeline_warm = db.Column(db.Boolean, default=False)
+    posts_count = db.Column(db.Integer, default=0, server_default='0')
+    comments_count = db.Column(db.Integer, default=0, server_default='0')
+    followers_count = db.Column(db.Integer, default=0, server_default='0')
+    followed_count = db.Column(db.Integer, default=0, server_default='0')
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     followed = db.relationship('Follow',
                                foreign_keys=[Follow.follower_id],
@@ -109,6 +156,8 @@ class User(UserMixin, db.Model):
     refund = db.relationship("Refund", backref='author', lazy='dynamic')
     storage = db.relationship("Storage", backref='author', lazy='dynamic')
     allocate = db.relationship("Allocate", backref="author", lazy="dynamic")
+    allocate_orders = db.relationship("AllocateOrder", backref="author", lazy="dynamic")
+    stock_takes = db.relationship("StockTake", backref="author", lazy="dynamic")
 
     @staticmethod
     def add_self_follows():
@@ -135,10 +184,15 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hashing.hash_password(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not hashing.verify_password(self.password_hash, password):
+            return False
+        if hashing.needs_rehash(self.password_hash):
+            self.password = password
+            db.session.add(self)
+        return True
 
     def generate_confirmation_token(self, expiration=3600):
         s = Serializer(current_app.config['SECRET_KEY'], expiration)
@@ -217,14 +271,54 @@ class User(UserMixin, db.Model):
             url=url, hash=hash, size=size, default=default, rating=rating)
 
     def follow(self, user):
+        g.pop('follow_states', None)
         if not self.is_following(user):
             f = Follow(follower=self, followed=user)
             db.session.add(f)
+            if self.timeline_warm:
+                length = current_app.config['FLASKY_TIMELINE_LENGTH']
+                newest = db.select(db.literal(self.id), Post.id, Post.timestamp) \
+                    .where(Post.author_id == user.id) \
+                    .order_by(Post.timestamp.desc()).limit(length)
+                db.session.execute(Timeline.__table__.insert().prefix_with('OR IGNORE')
+                                   .from_select(['user_id', 'post_id', 'timestamp'], newest))
+                Timeline.trim(db.session, [self.id])
 
     def unfollow(self, user):
+        g.pop('follow_states', None)
         f = self.followed.filter_by(followed_id=user.id).first()
         if f:
             db.session.delete(f)
+            if self.timeline_warm:
+                # a full timeline may have trimmed older posts of the users
+                # still followed, so it is rebuilt on the next read instead
+                length = current_app.config['FLASKY_TIMELINE_LENGTH']
+                if Timeline.query.filter_by(user_id=self.id).count() >= length:
+                    self.timeline_warm = False
+                timeline = Timeline.__table__
+                db.session.execute(timeline.delete()
+                                   .where(timeline.c.user_id == self.id)
+                                   .where(timeline.c.post_id.in_(
+                                       db.select(Post.id).where(Post.author_id == user.id))))
+
+    def follow_states(self, user_ids):
+        """Map each of `user_ids` to a (following, followed_by) pair relative
+        to this user.  The ids not resolved yet in this request are read in
+        one query over both directions of Follow."""
+        cache = g.setdefault('follow_states', {}).setdefault(self.id, {})
+        missing = list({user_id for user_id in user_ids if user_id not in cache})
+        if missing:
+            states = {user_id: [False, False] for user_id in missing}
+            rows = db.session.query(Follow.follower_id, Follow.followed_id).filter(db.or_(
+                db.and_(Follow.follower_id == self.id, Follow.followed_id.in_(missing)),
+                db.and_(Follow.followed_id == self.id, Follow.follower_id.in_(missing))))
+            for follower_id, followed_id in rows:
+                if follower_id == self.id:
+                    states[followed_id][0] = True
+                if followed_id == self.id:
+                    states[follower_id][1] = True
+            cache.update((user_id, tuple(state)) for user_id, state in states.items())
+        return {user_id: cache[user_id] for user_id in user_ids}
 
     def is_following(self, user):
         if user.id is None:
@@ -243,6 +337,62 @@ class User(UserMixin, db.Model):
         return Post.query.join(Follow, Follow.followed_id == Post.author_id) \
             .filter(Follow.follower_id == self.id)
 
+    @staticmethod
+    def repair_counters():
+        """Recompute every post, comment and follow counter with one GROUP BY
+        per counter and write them back in batched UPDATEs."""
+        users = User.__table__
+        posts = Post.__table__
+        db.session.execute(users.update().values(posts_count=0, comments_count=0,
+                                                 followers_count=0, followed_count=0))
+        db.session.execute(posts.update().values(comments_count=0))
+        for table, column, key in ((users, 'posts_count', Post.author_id),
+                                   (users, 'comments_count', Comment.author_id),
+                                   (users, 'followers_count', Follow.followed_id),
+                                   (users, 'followed_count', Follow.follower_id),
+                                   (posts, 'comments_count', Comment.post_id)):
+            counts = db.session.query(key, db.func.count()).filter(key != None).group_by(key).all()
+            if counts:
+                db.session.execute(table.update()
+                                   .where(table.c.id == db.bindparam('row_id'))
+                                   .values({column: db.bindparam('row_count')}),
+                                   [{'row_id': row_id, 'row_count': count} for row_id, count in counts])
+        db.session.commit()
+
+    def build_timeline(self):
+        """Materialize the newest followed posts, for users whose timeline
+        has not been kept up to date so far."""
+        timeline = Timeline.__table__
+        newest = db.select(db.literal(self.id), Post.id, Post.timestamp) \
+            .join(Follow, Follow.followed_id == Post.author_id) \
+            .where(Follow.follower_id == self.id) \
+            .order_by(Post.timestamp.desc()) \
+            .limit(current_app.config['FLASKY_TIMELINE_LENGTH'])
+        db.session.execute(timeline.delete().where(timeline.c.user_id == self.id))
+        db.session.execute(timeline.insert().from_select(['user_id', 'post_id', 'timestamp'], newest))
+        self.timeline_warm = True
+        db.session.add(self)
+        db.session.commit()
+
+    def followed_posts_page(self, page, per_page):
+        """A page of followed_posts, newest first.  Pages within the first
+        FLASKY_TIMELINE_LENGTH posts are read from the timeline; older pages
+        fall back to the join."""
+        length = current_app.config['FLASKY_TIMELINE_LENGTH']
+        if page < 1 or page * per_page > length:
+            return self.followed_posts.order_by(Post.timestamp.desc()).paginate(
+                page, per_page=per_page, error_out=False)
+        if not self.timeline_warm:
+            self.build_timeline()
+        query = Post.query.join(Timeline, Timeline.post_id == Post.id) \
+            .filter(Timeline.user_id == self.id) \
+            .order_by(Timeline.timestamp.desc(), Timeline.post_id.desc())
+        items = query.limit(per_page).offset((page - 1) * per_page).all()
+        total = query.order_by(None).count()
+        if total >= length:
+            total = self.followed_posts.order_by(None).count()
+        return Pagination(query, page, per_page, total, items)
+
     def __repr__(self):
         return '<User %r>' % self.username
 
@@ -251,6 +401,9 @@ class AnonymousUser(AnonymousUserMixin):
     def can(self, permissions):
         return False
 
+    def follow_states(self, user_ids):
+        return {user_id: (False, False) for user_id in user_ids}
+
     def is_administrator(self):
         return False
 
@@ -260,7 +413,7 @@ login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 
 class Post(db.Model):
@@ -270,6 +423,7 @@ class Post(db.Model):
     body_html = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    comments_count = db.Column(db.Integer, default=0, server_default='0')
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
 
     @staticmethod
@@ -281,8 +435,27 @@ class Post(db.Model):
             markdown(value, output_format='html'),
             tags=allowed_tags, strip=True))
 
+    @staticmethod
+    def on_created(mapper, connection, target):
+        timeline = Timeline.__table__
+        followers = db.select(Follow.follower_id) \
+            .join(User, User.id == Follow.follower_id) \
+            .where(Follow.followed_id == target.author_id) \
+            .where(User.timeline_warm == True)
+        connection.execute(timeline.insert().from_select(
+            ['user_id', 'post_id', 'timestamp'],
+            followers.add_columns(db.literal(target.id), db.literal(target.timestamp))))
+        Timeline.trim(connection, followers)
+        bump_counters(connection, User.__table__, target.author_id, 1, 'posts_count')
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        bump_counters(connection, User.__table__, target.author_id, -1, 'posts_count')
+
 
 db.event.listen(Post.body, 'set', Post.on_changed_body)
+db.event.listen(Post, 'after_insert', Post.on_created)
+db.event.listen(Post, 'after_delete', Post.on_deleted)
 
 
 class Comment(db.Model):
@@ -303,8 +476,19 @@ class Comment(db.Model):
             markdown(value, output_format='html'),
             tags=allowed_tags, strip=True))
 
+    @staticmethod
+    def on_count(delta):
+        def listener(mapper, connection, target):
+            bump_counters(connection, User.__table__, target.author_id, delta, 'comments_count')
+            bump_counters(connection, Post.__table__, target.post_id, delta, 'comments_count')
+        return listener
+
 
 db.event.listen(Comment.body, 'set', Comment.on_changed_body)
+db.event.listen(Comment, 'after_insert', Comment.on_count(1))
+db.event.listen(Comment, 'after_delete', Comment.on_count(-1))
+db.event.listen(Follow, 'after_insert', Follow.on_count(1))
+db.event.listen(Follow, 'after_delete', Follow.on_count(-1))
 
 
 class Inventory(db.Model):
@@ -313,6 +497,35 @@ class Inventory(db.Model):
     medicine_name = db.Column(db.String)
     medicine_type = db.Column(db.String)
     count = db.Column(db.Integer, default=0)
+    # stock level below which the medicine is reported on the warning page;
+    # NULL means no threshold has been set
+    warning_count = db.Column(db.Integer)
+
+    @hybrid_property
+    def warning(self):
+        return self.warning_count is not None and (self.count or 0) < self.warning_count
+
+    @warning.expression
+    def warning(cls):
+        # matches the expression of ix_inventory_shortfall, so SQLite serves
+        # it from the index; NULL thresholds drop out of it
+        return cls.count - cls.warning_count < 0
+
+    @staticmethod
+    def touch(medicine_ids):
+        """Record that the stock or threshold of these medicines changed in
+        the current transaction, for app.live to publish on commit."""
+        db.session.info.setdefault("inventory_changed", set()).update(medicine_ids)
+
+    @staticmethod
+    def warnings():
+        """Medicines with a threshold, most recently added first."""
+        return Inventory.query.filter(Inventory.warning_count != None).order_by(Inventory.medicine_id.desc())
+
+    @staticmethod
+    def triggered():
+        """Medicines whose stock is below their threshold."""
+        return Inventory.query.filter(Inventory.warning).order_by(Inventory.medicine_id.desc())
 
     #
     # def purchase(self, medicine_id, count):
@@ -340,6 +553,9 @@ class Inventory(db.Model):
     #             db.delete(self)
 
 
+db.Index('ix_inventory_shortfall', Inventory.count - Inventory.warning_count)
+
+
 class Purchase(db.Model):
     __tablename__ = "Purchase"
     id = db.Column(db.Integer, primary_key=True)
@@ -347,36 +563,547 @@ class Purchase(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     count = db.Column(db.Integer)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    return_goods = db.Column(db.Boolean, default=False)
-    have_storage = db.Column(db.Boolean, default=False)
+    return_goods = db.Column(db.Boolean, default=False, server_default='0')
+    have_storage = db.Column(db.Boolean, default=False, server_default='0')
+    # in cents; NULL for purchases made before costs were recorded
+    unit_cost = db.Column(db.Integer)
+
+    # Partial indexes over open work only: purchases still waiting to be
+    # received, and received purchases that can still be refunded.  The two
+    # sets are disjoint, so every queue query matches exactly one of them,
+    # and they shrink as work is done, so the queues never read closed history.
+    UNRECEIVED = db.and_(have_storage == False, return_goods == False)
+    STORED = db.and_(have_storage == True, return_goods == False)
+    __table_args__ = (
+        db.Index("ix_purchase_unreceived", "id", sqlite_where=UNRECEIVED),
+        db.Index("ix_purchase_unreceived_medicine", "medicine_id", "id", sqlite_where=UNRECEIVED),
+        db.Index("ix_purchase_stored", "id", sqlite_where=STORED),
+        db.Index("ix_purchase_stored_medicine", "medicine_id", "id", sqlite_where=STORED),
+        {"sqlite_autoincrement": True},
+    )
+
+    @staticmethod
+    def queue(conditions, medicine_id=None, after=None, per_page=20):
+        """Purchases matching any of `conditions`, oldest first, paged by
+        keyset: `after` is the id of the last purchase on the previous page.
+        Each condition is read with its own query so that it is served by its
+        own partial index.  Returns the rows and the id to continue after, or
+        None on the last page."""
+        rows = []
+        for condition in conditions:
+            query = Purchase.query.filter(condition)
+            if medicine_id is not None:
+                query = query.filter(Purchase.medicine_id == medicine_id)
+            if after is not None:
+                query = query.filter(Purchase.id > after)
+            rows.extend(query.order_by(Purchase.id).limit(per_page + 1))
+        rows = sorted(rows, key=lambda row: row.id)[:per_page + 1]
+        return rows[:per_page], rows[per_page - 1].id if len(rows) > per_page else None
+
+    @staticmethod
+    def pending(**kwargs):
+        """Purchases waiting to be put in storage."""
+        return Purchase.queue([Purchase.UNRECEIVED], **kwargs)
+
+    @staticmethod
+    def refundable(**kwargs):
+        """Purchases that have not been refunded, received or not."""
+        return Purchase.queue([Purchase.UNRECEIVED, Purchase.STORED], **kwargs)
+
+    @property
+    def unit_price(self):
+        return '' if self.unit_cost is None else '%.2f' % (self.unit_cost / 100.0)
+
+    @staticmethod
+    def flags(purchase_ids):
+        """Map purchase id to its (id, medicine_id, count, unit_cost,
+        return_goods, have_storage, stock) row, reading the flags of every
+        purchase and the warehouse stock of its medicine in one query."""
+        rows = db.session.query(Purchase.id, Purchase.medicine_id, Purchase.count, Purchase.unit_cost,
+                                Purchase.return_goods, Purchase.have_storage,
+                                db.func.coalesce(Inventory.count, 0).label("stock")) \
+            .outerjoin(Inventory, Inventory.medicine_id == Purchase.medicine_id) \
+            .filter(Purchase.id.in_(list(purchase_ids))).all()
+        return {row.id: row for row in rows}
+
+    @staticmethod
+    def mark(purchase_ids, flag, *guards):
+        """Set `flag` on every purchase in one UPDATE, guarded so that it only
+        applies while `flag` and the `guards` flags are all still unset.
+        Returns False if any purchase was flagged meanwhile, e.g. by a
+        concurrent submit; the caller must roll back."""
+        purchase = Purchase.__table__
+        update = purchase.update().where(purchase.c.id.in_(list(purchase_ids)))
+        for name in (flag,) + guards:
+            update = update.where(db.func.coalesce(purchase.c[name], False) == False)
+        result = db.session.execute(update.values({flag: True}))
+        return result.rowcount == len(purchase_ids)
 
 
 class Refund(db.Model):
     __tablename__ = "Refund"
+    __table_args__ = {"sqlite_autoincrement": True}
     id = db.Column(db.Integer, primary_key=True)
     purchase_id = db.Column(db.Integer, db.ForeignKey("Purchase.id"))
     # medicine_id = db.Column(db.Integer, db.ForeignKey("inventory.medicine_id"))
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    # cost of the goods taken back out of the warehouse, in cents
+    fifo_cost = db.Column(db.Integer)
+    average_cost = db.Column(db.Integer)
+
+    @staticmethod
+    def return_purchases(purchase_ids, author):
+        """Refund a batch of purchases and commit once.  Goods that were
+        already put in storage leave the warehouse again, aggregated per
+        medicine.  Returns False and rolls back if any purchase changed since
+        the form was validated."""
+        rows = Purchase.flags(purchase_ids).values()
+        if not Purchase.mark(purchase_ids, "return_goods"):
+            db.session.rollback()
+            return False
+        totals = defaultdict(int)
+        stored = [row for row in rows if row.have_storage]
+        for row in stored:
+            totals[row.medicine_id] += row.count
+        costs = {}
+        if totals:
+            inventory = Inventory.__table__
+            decrement = inventory.update() \
+                .where(inventory.c.medicine_id == db.bindparam("m_id")) \
+                .where(inventory.c.count >= db.bindparam("m_count")) \
+                .values(count=inventory.c.count - db.bindparam("m_count"))
+            result = db.session.execute(decrement, [{"m_id": medicine_id, "m_count": count}
+                                                    for medicine_id, count in totals.items()])
+            if result.rowcount != len(totals):
+                db.session.rollback()
+                return False
+            # the refunded purchase's own layer goes first
+            costs = dict(zip((row.id for row in stored),
+                             Valuation.issue([(row.medicine_id, row.count, row.id) for row in stored])))
+            Inventory.touch(totals)
+        db.session.add_all([Refund(purchase_id=purchase_id, author=author,
+                                   fifo_cost=costs.get(purchase_id, (None, None))[0],
+                                   average_cost=costs.get(purchase_id, (None, None))[1])
+                            for purchase_id in purchase_ids])
+        db.session.commit()
+        return True
 
 
 class Storage(db.Model):
     __tablename__ = "Storage"
+    __table_args__ = {"sqlite_autoincrement": True}
     id = db.Column(db.Integer, primary_key=True)
     purchase_id = db.Column(db.Integer, db.ForeignKey("Purchase.id"))
     medicine_id = db.Column(db.Integer, db.ForeignKey("inventory.medicine_id"))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
 
+    @staticmethod
+    def receive(purchase_ids, author):
+        """Put a batch of purchases into storage and commit once.  Inventory
+        is incremented once per medicine and rows for medicines that are not
+        in the warehouse yet are created from Medicine in one query.  Returns
+        False and rolls back if any purchase changed since the form was
+        validated."""
+        rows = Purchase.flags(purchase_ids).values()
+        if not Purchase.mark(purchase_ids, "have_storage", "return_goods"):
+            db.session.rollback()
+            return False
+        totals = defaultdict(int)
+        for row in rows:
+            totals[row.medicine_id] += row.count
+        in_stock = {medicine_id for medicine_id, in Inventory.query.with_entities(Inventory.medicine_id)
+                    .filter(Inventory.medicine_id.in_(list(totals)))}
+        inventory = Inventory.__table__
+        increment = inventory.update() \
+            .where(inventory.c.medicine_id == db.bindparam("m_id")) \
+            .values(count=inventory.c.count + db.bindparam("m_count"))
+        updates = [{"m_id": medicine_id, "m_count": count}
+                   for medicine_id, count in totals.items() if medicine_id in in_stock]
+        if updates:
+            db.session.execute(increment, updates)
+        missing = [medicine_id for medicine_id in totals if medicine_id not in in_stock]
+        for medicine in Medicine.query.filter(Medicine.medicine_id.in_(missing)):
+            db.session.add(Inventory(medicine_id=medicine.medicine_id, medicine_name=medicine.medicine_name,
+                                     medicine_type=medicine.medicine_type, count=totals[medicine.medicine_id]))
+        db.session.add_all([Storage(purchase_id=row.id, medicine_id=row.medicine_id, author=author)
+                            for row in rows])
+        Valuation.receive(rows)
+        Inventory.touch(totals)
+        db.session.commit()
+        return True
+
+
+class AllocateOrder(db.Model):
+    __tablename__ = "AllocateOrder"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = db.Column(db.Integer, primary_key=True)
+    receiver = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    items = db.relationship("Allocate", backref="order", order_by="Allocate.id")
+
+    @property
+    def total_count(self):
+        return sum(item.count for item in self.items)
+
+    @staticmethod
+    def shortages(lines):
+        """Return (medicine_id, requested, in_stock) for every medicine the
+        given (medicine_id, count) lines cannot be served from, using one
+        query over Inventory."""
+        requested = defaultdict(int)
+        for medicine_id, count in lines:
+            requested[medicine_id] += count
+        stock = dict(Inventory.query.with_entities(Inventory.medicine_id, Inventory.count)
+                     .filter(Inventory.medicine_id.in_(list(requested))).all())
+        return [(medicine_id, count, stock.get(medicine_id, 0))
+                for medicine_id, count in requested.items()
+                if stock.get(medicine_id, 0) < count]
+
+    @staticmethod
+    def place(receiver, lines, author):
+        """Allocate every (medicine_id, count) line in one transaction.
+
+        Stock is decremented with a guarded UPDATE per medicine, so lines that
+        were valid when the form was checked but lost their stock to a
+        concurrent order make the whole order roll back.  Returns the order,
+        or None and the shortages that made it fail."""
+        requested = defaultdict(int)
+        for medicine_id, count in lines:
+            requested[medicine_id] += count
+        inventory = Inventory.__table__
+        decrement = inventory.update() \
+            .where(inventory.c.medicine_id == db.bindparam("m_id")) \
+            .where(inventory.c.count >= db.bindparam("m_count")) \
+            .values(count=inventory.c.count - db.bindparam("m_count"))
+        result = db.session.execute(decrement, [{"m_id": medicine_id, "m_count": count}
+                                                for medicine_id, count in requested.items()])
+        if result.rowcount != len(requested):
+            db.session.rollback()
+            return None, AllocateOrder.shortages(lines)
+
+        costs = Valuation.issue(lines)
+        CostOfGoods.add(datetime.utcnow().date(), lines, costs)
+        order = AllocateOrder(receiver=receiver, author=author)
+        db.session.add(order)
+        for (medicine_id, count), (fifo_cost, average_cost) in zip(lines, costs):
+            db.session.add(Allocate(order=order, receiver=receiver, medicine_id=medicine_id,
+                                    count=count, author=author, fifo_cost=fifo_cost, average_cost=average_cost))
+        Inventory.touch(requested)
+        db.session.commit()
+        return order, []
+
 
 class Allocate(db.Model):
     __tablename__ = "Allocate"
+    __table_args__ = {"sqlite_autoincrement": True}
     id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey("AllocateOrder.id"), index=True)
     receiver = db.Column(db.Integer)
     medicine_id = db.Column(db.Integer, db.ForeignKey("inventory.medicine_id"))
     count = db.Column(db.Integer)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # cost of the goods allocated, in cents
+    fifo_cost = db.Column(db.Integer)
+    average_cost = db.Column(db.Integer)
+
+
+class CostLayer(db.Model):
+    """The goods of one received purchase at their unit cost, and how many of
+    them are still in stock.  FIFO valuation consumes the oldest open layer
+    first."""
+    __tablename__ = "CostLayer"
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer)
+    purchase_id = db.Column(db.Integer, index=True)
+    unit_cost = db.Column(db.Integer)
+    count = db.Column(db.Integer)
+    remaining = db.Column(db.Integer)
+    # only open layers are ever read, in the order they are consumed
+    __table_args__ = (
+        db.Index("ix_costlayer_open", "medicine_id", "id", sqlite_where=remaining > 0),
+        {"sqlite_autoincrement": True},
+    )
+
+
+class Valuation(db.Model):
+    """Running valuation of the stock of a medicine, kept up to date by every
+    receipt, refund and allocation: the quantity valued, its FIFO value (the
+    sum of its open layers) and its weighted-average value, in cents."""
+    __tablename__ = "Valuation"
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    quantity = db.Column(db.Integer, default=0)
+    fifo_value = db.Column(db.Integer, default=0)
+    average_value = db.Column(db.Integer, default=0)
+
+    @staticmethod
+    def receive(rows):
+        """Open a layer per received purchase, given rows that start with
+        (id, medicine_id, count, unit_cost), e.g. those of Purchase.flags,
+        and add them to the running values.  Purchases without a cost are
+        valued at zero."""
+        rows = [(purchase_id, medicine_id, count, unit_cost or 0)
+                for purchase_id, medicine_id, count, unit_cost, *_ in rows if count]
+        if not rows:
+            return
+        db.session.execute(CostLayer.__table__.insert(), [
+            {"medicine_id": medicine_id, "purchase_id": purchase_id, "unit_cost": unit_cost,
+             "count": count, "remaining": count} for purchase_id, medicine_id, count, unit_cost in rows])
+        totals = defaultdict(lambda: [0, 0])
+        for purchase_id, medicine_id, count, unit_cost in rows:
+            totals[medicine_id][0] += count
+            totals[medicine_id][1] += count * unit_cost
+        insert = sqlite_insert(Valuation.__table__)
+        db.session.execute(insert.on_conflict_do_update(index_elements=["medicine_id"], set_={
+            "quantity": Valuation.__table__.c.quantity + insert.excluded.quantity,
+            "fifo_value": Valuation.__table__.c.fifo_value + insert.excluded.fifo_value,
+            "average_value": Valuation.__table__.c.average_value + insert.excluded.average_value,
+        }), [{"medicine_id": medicine_id, "quantity": count, "fifo_value": value, "average_value": value}
+             for medicine_id, (count, value) in totals.items()])
+
+    @staticmethod
+    def issue(lines):
+        """Take goods out of the running values, given (medicine_id, count)
+        or (medicine_id, count, purchase_id) lines; with a purchase id that
+        purchase's layer is consumed before the oldest ones.  Returns the
+        (fifo_cost, average_cost) of every line.
+
+        Only the open layers and the valuations of the medicines involved
+        are read, and written back in one executemany each.  Stock that was
+        never valued, e.g. received before costs were recorded, costs zero."""
+        medicine_ids = list({line[0] for line in lines})
+        valuations = {medicine_id: [quantity, fifo_value, average_value]
+                      for medicine_id, quantity, fifo_value, average_value in
+                      db.session.query(Valuation.medicine_id, Valuation.quantity, Valuation.fifo_value,
+                                       Valuation.average_value).filter(Valuation.medicine_id.in_(medicine_ids))}
+        layers = defaultdict(list)
+        for layer_id, medicine_id, purchase_id, unit_cost, remaining in \
+                db.session.query(CostLayer.id, CostLayer.medicine_id, CostLayer.purchase_id,
+                                 CostLayer.unit_cost, CostLayer.remaining) \
+                .filter(CostLayer.medicine_id.in_(medicine_ids), CostLayer.remaining > 0) \
+                .order_by(CostLayer.medicine_id, CostLayer.id):
+            layers[medicine_id].append([layer_id, purchase_id, unit_cost, remaining])
+        changed = {}
+        costs = []
+        for line in lines:
+            medicine_id, count = line[0], line[1]
+            open_layers = layers[medicine_id]
+            if len(line) > 2:
+                open_layers.sort(key=lambda layer: layer[1] != line[2])
+            fifo_cost, left = 0, count
+            for layer in open_layers:
+                if not left:
+                    break
+                taken = min(left, layer[3])
+                fifo_cost += taken * layer[2]
+                layer[3] -= taken
+                left -= taken
+                changed[layer[0]] = layer
+            layers[medicine_id] = [layer for layer in open_layers if layer[3]]
+            valuation = valuations.setdefault(medicine_id, [0, 0, 0])
+            taken = min(count, valuation[0])
+            average_cost = valuation[2] * taken // valuation[0] if taken else 0
+            valuation[0] -= taken
+            valuation[1] -= fifo_cost
+            valuation[2] -= average_cost
+            costs.append((fifo_cost, average_cost))
+        if changed:
+            layer_table = CostLayer.__table__
+            db.session.execute(layer_table.update()
+                               .where(layer_table.c.id == db.bindparam("layer_id"))
+                               .values(remaining=db.bindparam("layer_remaining")),
+                               [{"layer_id": layer_id, "layer_remaining": layer[3]}
+                                for layer_id, layer in changed.items()])
+        table = Valuation.__table__
+        db.session.execute(sqlite_insert(table).prefix_with("OR REPLACE"), [
+            {"medicine_id": medicine_id, "quantity": quantity, "fifo_value": fifo_value,
+             "average_value": average_value}
+            for medicine_id, (quantity, fifo_value, average_value) in valuations.items()])
+        return costs
+
+    @staticmethod
+    def totals():
+        """Quantity, FIFO value and weighted-average value of all stock."""
+        return db.session.query(db.func.coalesce(db.func.sum(Valuation.quantity), 0),
+                                db.func.coalesce(db.func.sum(Valuation.fifo_value), 0),
+                                db.func.coalesce(db.func.sum(Valuation.average_value), 0)).one()
+
+
+class CostOfGoods(db.Model):
+    """Allocated quantity and its FIFO and weighted-average cost per day and
+    medicine, so that the cost of goods of a period is one range read."""
+    __tablename__ = "CostOfGoods"
+    day = db.Column(db.Date, primary_key=True)
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, default=0)
+    fifo_cost = db.Column(db.Integer, default=0)
+    average_cost = db.Column(db.Integer, default=0)
+
+    @staticmethod
+    def add(day, lines, costs):
+        """Add allocated (medicine_id, count) lines and their costs to `day`."""
+        totals = defaultdict(lambda: [0, 0, 0])
+        for (medicine_id, count), (fifo_cost, average_cost) in zip(lines, costs):
+            totals[medicine_id][0] += count
+            totals[medicine_id][1] += fifo_cost
+            totals[medicine_id][2] += average_cost
+        table = CostOfGoods.__table__
+        insert = sqlite_insert(table)
+        db.session.execute(insert.on_conflict_do_update(index_elements=["day", "medicine_id"], set_={
+            "count": table.c.count + insert.excluded.count,
+            "fifo_cost": table.c.fifo_cost + insert.excluded.fifo_cost,
+            "average_cost": table.c.average_cost + insert.excluded.average_cost,
+        }), [{"day": day, "medicine_id": medicine_id, "count": count, "fifo_cost": fifo_cost,
+              "average_cost": average_cost} for medicine_id, (count, fifo_cost, average_cost) in totals.items()])
+
+    @staticmethod
+    def between(start, end):
+        """Allocated count, FIFO cost and weighted-average cost from day
+        `start` to day `end` inclusive."""
+        return db.session.query(db.func.coalesce(db.func.sum(CostOfGoods.count), 0),
+                                db.func.coalesce(db.func.sum(CostOfGoods.fifo_cost), 0),
+                                db.func.coalesce(db.func.sum(CostOfGoods.average_cost), 0)) \
+            .filter(CostOfGoods.day >= start, CostOfGoods.day <= end).one()
+
+
+class StockTake(db.Model):
+    """A physical count of the warehouse: the counted quantities are loaded
+    as lines, reviewed against Inventory and then posted as adjustments."""
+    __tablename__ = "StockTake"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # missing SKUs count as zero instead of being left alone
+    full = db.Column(db.Boolean, default=False)
+    posted = db.Column(db.DateTime)
+    lines = db.relationship("StockTakeLine", backref="stock_take", lazy="dynamic")
+
+
+class StockTakeLine(db.Model):
+    """A counted quantity, and the Inventory count it was compared with."""
+    __tablename__ = "StockTakeLine"
+    stock_take_id = db.Column(db.Integer, db.ForeignKey("StockTake.id"), primary_key=True)
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    counted = db.Column(db.Integer)
+    expected = db.Column(db.Integer)
+
+    @hybrid_property
+    def variance(self):
+        return self.counted - self.expected
+
+
+class Adjustment(db.Model):
+    """A stock movement posted by a stock take, the difference between the
+    counted and the booked quantity; negative for losses."""
+    __tablename__ = "Adjustment"
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = db.Column(db.Integer, primary_key=True)
+    stock_take_id = db.Column(db.Integer, db.ForeignKey("StockTake.id"), index=True)
+    medicine_id = db.Column(db.Integer, db.ForeignKey("inventory.medicine_id"))
+    count = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # value of the goods found or lost, in cents
+    fifo_cost = db.Column(db.Integer)
+    average_cost = db.Column(db.Integer)
+
+
+class StockCheckpoint(db.Model):
+    """How far app.reconcile has read each movement table."""
+    __tablename__ = "StockCheckpoint"
+    source = db.Column(db.String(32), primary_key=True)
+    last_id = db.Column(db.Integer, default=0)
+
+
+class StockExpected(db.Model):
+    """Stock per medicine implied by every movement up to the checkpoint."""
+    __tablename__ = "StockExpected"
+    medicine_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
+
+class Job(db.Model):
+    """A periodic job of app.jobs and the state of its last run.  A worker
+    owns a run while locked_by is set and locked_until is in the future."""
+    __tablename__ = "jobs"
+    name = db.Column(db.String(64), primary_key=True)
+    schedule = db.Column(db.String(64))
+    paused = db.Column(db.Boolean, default=False)
+    next_run = db.Column(db.DateTime, index=True)
+    last_run = db.Column(db.DateTime)
+    last_status = db.Column(db.String(16))
+    last_result = db.Column(db.Text)
+    locked_by = db.Column(db.String(64))
+    locked_until = db.Column(db.DateTime)
+
+
+# Closed ledger rows are moved here by app.archive so that the hot tables and
+# their indexes only hold open and recent work.  The ids are kept, so rows in
+# the archive still match the purchase ids referenced by refunds and storage.
+
+class PurchaseArchive(db.Model):
+    __tablename__ = "PurchaseArchive"
+    __bind_key__ = "archive"
+    id = db.Column(db.Integer, primary_key=True)
+    medicine_id = db.Column(db.Integer, index=True)
+    timestamp = db.Column(db.DateTime, index=True)
+    count = db.Column(db.Integer)
+    user_id = db.Column(db.Integer)
+    return_goods = db.Column(db.Boolean)
+    have_storage = db.Column(db.Boolean)
+    unit_cost = db.Column(db.Integer)
+
+    @property
+    def unit_price(self):
+        return '' if self.unit_cost is None else '%.2f' % (self.unit_cost / 100.0)
+
+
+class RefundArchive(db.Model):
+    __tablename__ = "RefundArchive"
+    __bind_key__ = "archive"
+    id = db.Column(db.Integer, primary_key=True)
+    purchase_id = db.Column(db.Integer, index=True)
+    user_id = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True)
+    fifo_cost = db.Column(db.Integer)
+    average_cost = db.Column(db.Integer)
+
+
+class StorageArchive(db.Model):
+    __tablename__ = "StorageArchive"
+    __bind_key__ = "archive"
+    id = db.Column(db.Integer, primary_key=True)
+    purchase_id = db.Column(db.Integer, index=True)
+    medicine_id = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer)
+
+
+class AllocateOrderArchive(db.Model):
+    __tablename__ = "AllocateOrderArchive"
+    __bind_key__ = "archive"
+    id = db.Column(db.Integer, primary_key=True)
+    receiver = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer)
+
+
+class AllocateArchive(db.Model):
+    __tablename__ = "AllocateArchive"
+    __bind_key__ = "archive"
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, index=True)
+    receiver = db.Column(db.Integer)
+    medicine_id = db.Column(db.Integer)
+    count = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True)
+    user_id = db.Column(db.Integer)
+    fifo_cost = db.Column(db.Integer)
+    average_cost = db.Column(db.Integer)
 
 
 class Medicine(db.Model):
@@ -385,22 +1112,18 @@ class Medicine(db.Model):
     medicine_name = db.Column(db.String)
     medicine_type = db.Column(db.String)
     medicine_factory = db.Column(db.String)
+    # maintained by app.catalog: a hash of the three columns above, and
+    # whether the medicine is still in the supplier master file
+    content_hash = db.Column(db.String(40))
+    active = db.Column(db.Boolean, default=True, server_default='1')
 
     @staticmethod
     def insert_medicine():
+        from .catalog import sync
         medicine_id = [1, 2, 3, 4, 5]
         medicine_name = ["999感冒灵", "罗红霉素胶囊", "清热解毒口服液", "板蓝根", "夏桑菊"]
         medicine_type = ['感冒药', '消炎药', '清热去火', '清热去火', '清热去火']
         medicine_factory = ['华润三九医药股份有限公司', '山东鲁抗辰欣医药有限公司', '河南宛西制药有限公司', '河南宛西制药有限公司', '河南宛西制药有限公司']
 
-        for id, name, type, factory in zip(medicine_id, medicine_name, medicine_type, medicine_factory):
-            db.session.add(Medicine(medicine_id=id, medicine_name=name, medicine_type=type, medicine_factory=factory))
-        db.session.commit()
-
+        sync(zip(medicine_id, medicine_name, medicine_type, medicine_factory), deactivate=False)
 
-class Warning(db.Model):
-    __tablename__ = "Warning"
-    medicine_id = db.Column(db.Integer, primary_key=True)
-    count = db.Column(db.Integer)
-    warning_count = db.Column(db.Integer)
-    warning = db.Column(db.Boolean,default=False)
@@ -0,0 +1,101 @@
+from . import db
+from .models import Purchase, Refund, Storage, Allocate, Adjustment, Inventory, Medicine, StockCheckpoint, \
+    StockExpected, PurchaseArchive, RefundArchive, StorageArchive, AllocateArchive
+
+SOURCES = {"Storage": Storage, "Refund": Refund, "Allocate": Allocate, "Adjustment": Adjustment}
+
+
+def _deltas(purchase, storage, refund, allocate, adjustment=None, after=None, upto=None):
+    """Stock change per medicine from the movements with ids in
+    (after[source], upto[source]], as one aggregate over a UNION ALL:
+    stored receipts add, refunds of stored goods and allocations subtract,
+    stock take adjustments carry their own sign.  Adjustments are never
+    archived, so the archive has no `adjustment` table."""
+
+    def window(table, source):
+        clauses = []
+        if after is not None:
+            clauses.append(table.c.id > after.get(source, 0))
+        if upto is not None:
+            clauses.append(table.c.id <= upto[source])
+        return db.and_(db.true(), *clauses)
+
+    selects = [
+        db.select(purchase.c.medicine_id, purchase.c.count.label("delta"))
+        .select_from(storage.join(purchase, purchase.c.id == storage.c.purchase_id))
+        .where(window(storage, "Storage")),
+        db.select(purchase.c.medicine_id, -purchase.c.count)
+        .select_from(refund.join(purchase, purchase.c.id == refund.c.purchase_id))
+        .where(purchase.c.have_storage == True)
+        .where(window(refund, "Refund")),
+        db.select(allocate.c.medicine_id, -allocate.c.count)
+        .where(window(allocate, "Allocate")),
+    ]
+    if adjustment is not None:
+        selects.append(db.select(adjustment.c.medicine_id, adjustment.c.count)
+                       .where(window(adjustment, "Adjustment")))
+    movements = db.union_all(*selects).subquery()
+    return db.select(movements.c.medicine_id, db.func.sum(movements.c.delta)) \
+        .group_by(movements.c.medicine_id)
+
+
+def expected_stock(full=False):
+    """Expected count per medicine.  Normally only the movements added since
+    the last checkpoint are read and added to the stored totals; `full`
+    recomputes everything, including the archive, and so does the first run
+    without a checkpoint.  The checkpoint is moved forward either way."""
+    upto = {source: db.session.query(db.func.max(model.id)).scalar() or 0
+            for source, model in SOURCES.items()}
+    after = {} if full else {row.source: row.last_id for row in StockCheckpoint.query}
+    full = full or not after
+    if full:
+        expected = {}
+    else:
+        expected = dict(StockExpected.query.with_entities(StockExpected.medicine_id, StockExpected.count))
+    hot = [model.__table__ for model in (Purchase, Storage, Refund, Allocate, Adjustment)]
+    changes = db.session.execute(_deltas(*hot, after=after, upto=upto)).fetchall()
+    if full:
+        cold = [model.__table__ for model in (PurchaseArchive, StorageArchive, RefundArchive, AllocateArchive)]
+        with db.get_engine(bind="archive").connect() as connection:
+            changes += connection.execute(_deltas(*cold)).fetchall()
+    for medicine_id, delta in changes:
+        expected[medicine_id] = expected.get(medicine_id, 0) + int(delta or 0)
+
+    if full:
+        db.session.execute(StockExpected.__table__.delete())
+    if expected:
+        db.session.execute(StockExpected.__table__.insert().prefix_with("OR REPLACE"),
+                           [{"medicine_id": medicine_id, "count": count}
+                            for medicine_id, count in expected.items()])
+    db.session.execute(StockCheckpoint.__table__.insert().prefix_with("OR REPLACE"),
+                       [{"source": source, "last_id": last_id} for source, last_id in upto.items()])
+    db.session.commit()
+    return expected
+
+
+def stock_drift(expected):
+    """(medicine_id, inventory count, expected count) for every medicine whose
+    Inventory count differs from the expected one; a missing Inventory row
+    counts as zero stock."""
+    inventory = dict(Inventory.query.with_entities(Inventory.medicine_id, Inventory.count))
+    return sorted((medicine_id, inventory.get(medicine_id), expected.get(medicine_id, 0))
+                  for medicine_id in set(inventory) | set(expected)
+                  if (inventory.get(medicine_id) or 0) != expected.get(medicine_id, 0))
+
+
+def repair(drift):
+    """Set Inventory to the expected counts with one batched UPDATE, create
+    the rows that are missing."""
+    inventory = Inventory.__table__
+    updates = [{"m_id": medicine_id, "m_count": expected}
+               for medicine_id, count, expected in drift if count is not None]
+    if updates:
+        db.session.execute(inventory.update()
+                           .where(inventory.c.medicine_id == db.bindparam("m_id"))
+                           .values(count=db.bindparam("m_count")), updates)
+    missing = {medicine_id: expected for medicine_id, count, expected in drift if count is None}
+    for medicine in Medicine.query.filter(Medicine.medicine_id.in_(list(missing))):
+        db.session.add(Inventory(medicine_id=medicine.medicine_id, medicine_name=medicine.medicine_name,
+                                 medicine_type=medicine.medicine_type, count=missing[medicine.medicine_id]))
+    Inventory.touch([row[0] for row in drift])
+    db.session.commit()
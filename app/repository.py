@@ -0,0 +1,70 @@
+"""The hot single-row lookups of the views and forms.
+
+Lookups by primary key go through Session.get, which returns the instance
+already in the request's identity map without any SQL.  The others are
+lambda statements: SQLAlchemy builds and compiles each one once and reuses
+it, binding only the new value.  Where a caller only needs to know that a
+row exists or one of its columns, only that column is loaded."""
+from . import db
+from .models import User, Purchase, Inventory, Medicine
+
+
+def _first(statement):
+    return db.session.execute(statement).scalars().first()
+
+
+def purchase(purchase_id):
+    return db.session.get(Purchase, purchase_id)
+
+
+def medicine(medicine_id):
+    return db.session.get(Medicine, medicine_id)
+
+
+def inventory(medicine_id):
+    return db.session.get(Inventory, medicine_id)
+
+
+def medicine_active(medicine_id):
+    """True or False if the medicine is in the catalog, None if it isn't."""
+    return _first(db.lambda_stmt(lambda: db.select(Medicine.active)
+                                 .where(Medicine.medicine_id == medicine_id)))
+
+
+def in_stock(medicine_id):
+    """Whether the warehouse has an Inventory row for the medicine."""
+    return _first(db.lambda_stmt(lambda: db.select(Inventory.medicine_id)
+                                 .where(Inventory.medicine_id == medicine_id))) is not None
+
+
+def warning_count(medicine_id):
+    """The warning threshold of the medicine, None if it has none."""
+    return _first(db.lambda_stmt(lambda: db.select(Inventory.warning_count)
+                                 .where(Inventory.medicine_id == medicine_id)))
+
+
+def set_warning_count(medicine_id, count):
+    db.session.execute(db.lambda_stmt(lambda: db.update(Inventory)
+                                      .where(Inventory.medicine_id == medicine_id)
+                                      .values(warning_count=count)))
+    Inventory.touch([medicine_id])
+
+
+def user(user_id):
+    return db.session.get(User, user_id)
+
+
+def user_by_username(username):
+    return _first(db.lambda_stmt(lambda: db.select(User).where(User.username == username)))
+
+
+def user_by_email(email):
+    return _first(db.lambda_stmt(lambda: db.select(User).where(User.email == email)))
+
+
+def username_taken(username):
+    return _first(db.lambda_stmt(lambda: db.select(User.id).where(User.username == username))) is not None
+
+
+def email_taken(email):
+    return _first(db.lambda_stmt(lambda: db.select(User.id).where(User.email == email))) is not None
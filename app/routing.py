@@ -0,0 +1,53 @@
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+
+# Reads on the primary database can be sent to a second bind named
+# 'replica': by default a second connection pool on the same SQLite file
+# whose connections are put in query_only mode, or a snapshot or real
+# replica if one is configured.  Only queries made while a view marked with
+# decorators.read_only is running are routed there.  Flushes, INSERT,
+# UPDATE and DELETE statements and models with their own __bind_key__ keep
+# their usual engine.
+REPLICA = 'replica'
+
+
+def _query_only(dbapi_connection, connection_record):
+    dbapi_connection.execute('PRAGMA query_only = ON')
+
+
+def _manual_checkpoints(dbapi_connection, connection_record):
+    # with FLASKY_BACKUP_WAL the backup job checkpoints the log once it has
+    # shipped it; see app.backup
+    dbapi_connection.execute('PRAGMA wal_autocheckpoint = 0')
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        default = mapper is None or mapper.persist_selectable.info.get('bind_key') is None
+        if self.info.get('read_only') and not self._flushing \
+                and not getattr(clause, 'is_dml', False) \
+                and REPLICA in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+            if default:
+                return get_state(self.app).db.get_engine(self.app, bind=REPLICA)
+        if mapper is not None and default:
+            # the default engine, without walking the clause for a table with
+            # a bind of its own; for a lambda statement that walk would build
+            # the statement again and undo its caching
+            return self.bind
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = SQLAlchemy.get_engine(self, app, bind)
+        if engine.dialect.name != 'sqlite':
+            return engine
+        if bind == REPLICA and not event.contains(engine, 'connect', _query_only):
+            event.listen(engine, 'connect', _query_only)
+        if self.get_app(app).config.get('FLASKY_BACKUP_WAL') \
+                and not event.contains(engine, 'connect', _manual_checkpoints):
+            event.listen(engine, 'connect', _manual_checkpoints)
+        return engine
@@ -0,0 +1,71 @@
+from . import db
+from .models import Post, Comment
+
+# External content FTS5 indexes over the body of posts and comments.  The
+# triggers keep them in step with every insert, edit and delete, whichever
+# code path makes the change.
+INDEXES = {
+    Post: "posts_fts",
+    Comment: "comments_fts",
+}
+
+_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+    "body, content='{table}', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN "
+    "INSERT INTO {index}(rowid, body) VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN "
+    "INSERT INTO {index}({index}, rowid, body) VALUES ('delete', old.id, old.body); END",
+    "CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF body ON {table} BEGIN "
+    "INSERT INTO {index}({index}, rowid, body) VALUES ('delete', old.id, old.body); "
+    "INSERT INTO {index}(rowid, body) VALUES (new.id, new.body); END",
+]
+
+for _model, _index in INDEXES.items():
+    for _statement in _DDL:
+        db.event.listen(_model.__table__, 'after_create',
+                        db.DDL(_statement.format(table=_model.__tablename__, index=_index))
+                        .execute_if(dialect='sqlite'))
+
+
+def rebuild():
+    """Create the indexes and triggers if they are missing, e.g. on a database
+    created before search existed, and re-read every existing row."""
+    for model, index in INDEXES.items():
+        for statement in _DDL:
+            db.session.execute(db.text(statement.format(table=model.__tablename__, index=index)))
+        db.session.execute(db.text("INSERT INTO {index}({index}) VALUES ('rebuild')".format(index=index)))
+    db.session.commit()
+
+
+def match_expression(text):
+    """Turn free text into an FTS5 query that matches every word, quoting
+    each word so that user input can't break the query syntax."""
+    return " ".join('"%s"' % word.replace('"', '""') for word in text.split())
+
+
+def search(model, text, after=None, per_page=20, include_disabled=False):
+    """Rows of `model` whose body matches `text`, best match first.
+
+    Paging is by keyset: `after` is the (rank, id) of the last row of the
+    previous page.  Returns the rows and the key for the next page, or None
+    on the last page."""
+    query = match_expression(text)
+    if not query:
+        return [], None
+    index = INDEXES[model]
+    sql = "SELECT {index}.rowid, {index}.rank FROM {index} " \
+          "JOIN {table} ON {table}.id = {index}.rowid " \
+          "WHERE {index} MATCH :query".format(index=index, table=model.__tablename__)
+    params = {"query": query, "limit": per_page + 1}
+    if model is Comment and not include_disabled:
+        sql += " AND NOT coalesce(comments.disabled, 0)"
+    if after is not None:
+        sql += " AND ({index}.rank > :rank OR ({index}.rank = :rank AND {index}.rowid > :id))".format(index=index)
+        params.update(rank=after[0], id=after[1])
+    sql += " ORDER BY {index}.rank, {index}.rowid LIMIT :limit".format(index=index)
+    hits = db.session.execute(db.text(sql), params).fetchall()
+    next_key = (hits[per_page - 1][1], hits[per_page - 1][0]) if len(hits) > per_page else None
+    hits = hits[:per_page]
+    rows = {row.id: row for row in model.query.filter(model.id.in_([hit[0] for hit in hits]))}
+    return [rows[hit[0]] for hit in hits if hit[0] in rows], next_key
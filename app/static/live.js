@@ -0,0 +1,37 @@
+// Patch the count and warning cells of the inventory and warning tables in
+// place as /inventory/stream reports changes, instead of reloading the page.
+(function () {
+    var script = document.currentScript;
+    var source = new EventSource(script.getAttribute('data-stream'));
+
+    function text(value) {
+        return value === null ? 'None' : String(value);
+    }
+
+    source.addEventListener('inventory', function (event) {
+        JSON.parse(event.data).forEach(function (delta) {
+            var row = document.querySelector('tr[data-medicine-id="' + delta.medicine_id + '"]');
+            if (!row) {
+                return;
+            }
+            var cell = row.querySelector('[data-field="count"]');
+            if (cell) {
+                cell.textContent = text(delta.count);
+            }
+            cell = row.querySelector('[data-field="warning_count"]');
+            if (cell) {
+                cell.textContent = text(delta.warning_count);
+            }
+            cell = row.querySelector('[data-field="warning"]');
+            if (cell) {
+                cell.innerHTML = delta.warning ? '<font color="red">True</font>' : 'False';
+            }
+        });
+    });
+
+    // the server dropped this stream because it fell behind
+    source.addEventListener('reset', function () {
+        source.close();
+        window.location.reload();
+    });
+})();
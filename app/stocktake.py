@@ -0,0 +1,158 @@
+import csv
+from collections import namedtuple
+from datetime import datetime
+from flask import current_app
+from . import db
+from .models import Inventory, Medicine, StockTake, StockTakeLine, Adjustment, Valuation
+
+# a gain is valued like a receipt of the counted goods
+Gain = namedtuple("Gain", "id medicine_id count unit_cost")
+
+
+def read_csv(stream):
+    """Yield (medicine_id, count) from a medicine_id,count file."""
+    for number, row in enumerate(csv.DictReader(stream), 2):
+        try:
+            yield int(row["medicine_id"]), int(row["count"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Line %d: please enter the medicine id and the count" % number)
+
+
+def start(rows, author, full=False, batch_size=None):
+    """Open a stock take with the counted (medicine_id, count) `rows`.
+
+    The lines are inserted with one executemany per batch and compared with
+    Inventory by a single UPDATE, so the cost is a few statements however
+    many SKUs were counted.  With `full`, every medicine in stock that was
+    not counted gets a line with a count of zero.  A medicine counted twice
+    keeps its last count.  Raises ValueError for negative counts or ids that
+    are not in the catalog, before anything is written."""
+    batch_size = batch_size or current_app.config["FLASKY_STOCKTAKE_BATCH_SIZE"]
+    counts = {}
+    for medicine_id, count in rows:
+        if count < 0:
+            raise ValueError("Medicine %d: the count can't be negative" % medicine_id)
+        counts[medicine_id] = count
+    known = {medicine_id for medicine_id, in db.session.query(Medicine.medicine_id)}
+    unknown = sorted(set(counts) - known)
+    if unknown:
+        raise ValueError("Not in the catalog: %s" % ", ".join(str(medicine_id) for medicine_id in unknown[:20]))
+
+    stock_take = StockTake(author=author, full=full)
+    db.session.add(stock_take)
+    db.session.flush()
+    lines = StockTakeLine.__table__
+    items = [{"stock_take_id": stock_take.id, "medicine_id": medicine_id, "counted": count}
+             for medicine_id, count in counts.items()]
+    for begin in range(0, len(items), batch_size):
+        db.session.execute(lines.insert(), items[begin:begin + batch_size])
+    inventory = Inventory.__table__
+    if full:
+        counted = db.select(lines.c.medicine_id).where(lines.c.stock_take_id == stock_take.id)
+        db.session.execute(lines.insert().from_select(
+            ["stock_take_id", "medicine_id", "counted"],
+            db.select(db.literal(stock_take.id), inventory.c.medicine_id, db.literal(0))
+            .where(inventory.c.count != 0)
+            .where(inventory.c.medicine_id.notin_(counted))))
+    db.session.execute(lines.update().where(lines.c.stock_take_id == stock_take.id).values(
+        expected=db.func.coalesce(db.select(inventory.c.count)
+                                  .where(inventory.c.medicine_id == lines.c.medicine_id)
+                                  .scalar_subquery(), 0)))
+    db.session.commit()
+    return stock_take
+
+
+def totals(stock_take):
+    """Lines, lines with a variance, units found and units lost."""
+    variance = StockTakeLine.counted - StockTakeLine.expected
+    return db.session.query(
+        db.func.count(),
+        db.func.coalesce(db.func.sum(db.case((variance != 0, 1), else_=0)), 0),
+        db.func.coalesce(db.func.sum(db.case((variance > 0, variance), else_=0)), 0),
+        db.func.coalesce(db.func.sum(db.case((variance < 0, -variance), else_=0)), 0)) \
+        .filter(StockTakeLine.stock_take_id == stock_take.id).one()
+
+
+def variances(stock_take):
+    """The lines whose count differs from Inventory, biggest loss first."""
+    return stock_take.lines.filter(StockTakeLine.variance != 0) \
+        .order_by(StockTakeLine.variance, StockTakeLine.medicine_id)
+
+
+def post(stock_take, author):
+    """Bring Inventory to the counted quantities in one transaction.
+
+    The adjustment of each line is the counted quantity less the stock at
+    the time of posting, so movements booked since the upload are not
+    undone.  Adjustments are inserted and Inventory updated with one
+    set-based statement each; losses are taken out of valuation like an
+    allocation and gains valued at the medicine's average cost.  Touching
+    the medicines publishes the new counts and warning states.  Returns the
+    number of adjustments, or None if the stock take was posted already."""
+    now = datetime.utcnow()
+    stock_takes = StockTake.__table__
+    result = db.session.execute(stock_takes.update()
+                                .where(stock_takes.c.id == stock_take.id)
+                                .where(stock_takes.c.posted == None)
+                                .values(posted=now))
+    if result.rowcount != 1:
+        db.session.rollback()
+        return None
+
+    lines = StockTakeLine.__table__
+    inventory = Inventory.__table__
+    medicine = Medicine.__table__
+    adjustments = Adjustment.__table__
+    db.session.execute(inventory.insert().from_select(
+        ["medicine_id", "medicine_name", "medicine_type", "count"],
+        db.select(medicine.c.medicine_id, medicine.c.medicine_name, medicine.c.medicine_type, db.literal(0))
+        .select_from(lines.join(medicine, medicine.c.medicine_id == lines.c.medicine_id))
+        .where(lines.c.stock_take_id == stock_take.id)
+        .where(lines.c.counted != 0)
+        .where(~db.exists().where(inventory.c.medicine_id == lines.c.medicine_id))))
+    db.session.execute(adjustments.insert().from_select(
+        ["stock_take_id", "medicine_id", "count", "timestamp", "user_id"],
+        db.select(lines.c.stock_take_id, lines.c.medicine_id, lines.c.counted - inventory.c.count,
+                  db.literal(now, db.DateTime), db.literal(author.id))
+        .select_from(lines.join(inventory, inventory.c.medicine_id == lines.c.medicine_id))
+        .where(lines.c.stock_take_id == stock_take.id)
+        .where(lines.c.counted != inventory.c.count)))
+    moved = [tuple(row) for row in db.session.query(Adjustment.id, Adjustment.medicine_id, Adjustment.count)
+             .filter(Adjustment.stock_take_id == stock_take.id)]
+    if moved:
+        counted = db.select(lines.c.counted) \
+            .where(lines.c.stock_take_id == stock_take.id) \
+            .where(lines.c.medicine_id == inventory.c.medicine_id).scalar_subquery()
+        db.session.execute(inventory.update()
+                           .where(inventory.c.medicine_id.in_(
+                               db.select(adjustments.c.medicine_id)
+                               .where(adjustments.c.stock_take_id == stock_take.id)))
+                           .values(count=counted))
+        _value(moved)
+        Inventory.touch([medicine_id for _, medicine_id, _ in moved])
+    db.session.commit()
+    return len(moved)
+
+
+def _value(moved):
+    """Value the (id, medicine_id, count) adjustments and store their cost."""
+    losses = [(adjustment_id, medicine_id, -count) for adjustment_id, medicine_id, count in moved if count < 0]
+    gains = [(adjustment_id, medicine_id, count) for adjustment_id, medicine_id, count in moved if count > 0]
+    costs = []
+    if losses:
+        costs.extend(zip((adjustment_id for adjustment_id, _, _ in losses),
+                         Valuation.issue([(medicine_id, count) for _, medicine_id, count in losses])))
+    if gains:
+        average = dict(db.session.query(Valuation.medicine_id, Valuation.average_value / Valuation.quantity)
+                       .filter(Valuation.medicine_id.in_([medicine_id for _, medicine_id, _ in gains]))
+                       .filter(Valuation.quantity > 0))
+        Valuation.receive([Gain(None, medicine_id, count, average.get(medicine_id, 0))
+                           for _, medicine_id, count in gains])
+        costs.extend((adjustment_id, (count * average.get(medicine_id, 0),) * 2)
+                     for adjustment_id, medicine_id, count in gains)
+    adjustments = Adjustment.__table__
+    db.session.execute(adjustments.update()
+                       .where(adjustments.c.id == db.bindparam("a_id"))
+                       .values(fifo_cost=db.bindparam("a_fifo"), average_cost=db.bindparam("a_average")),
+                       [{"a_id": adjustment_id, "a_fifo": fifo_cost, "a_average": average_cost}
+                        for adjustment_id, (fifo_cost, average_cost) in costs])
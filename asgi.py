@@ -0,0 +1,6 @@
+import os
+from app import create_app
+from app.aio import ReadPath
+
+# uvicorn asgi:application
+application = ReadPath(create_app(os.getenv('FLASK_CONFIG') or 'default'))
@@ -0,0 +1,21 @@
+"""Benchmarks run with ``flask bench <name>``.
+
+Each benchmark builds its own app from the testing config on a throwaway
+database, so it never touches the development or production data.
+"""
+import os
+import tempfile
+from app import create_app, db
+
+
+def make_app(**overrides):
+    """An app on a fresh SQLite file with the given config overrides."""
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    app = create_app('testing')
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + path,
+                      WTF_CSRF_ENABLED=False, **overrides)
+    with app.app_context():
+        db.create_all()
+    app.bench_database = path
+    return app
@@ -0,0 +1,129 @@
+"""Full online backup, WAL shipping and restore of a generated database of
+several GB, each with a writer committing small rows throughout, against a
+plain copy of the file."""
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from app import backup
+from . import make_app
+
+ROW = 1000
+BATCH = 100000
+
+
+def _fill(path, size):
+    """Grow the database to about `size` MB with rows of ROW characters,
+    half random hex and half repeated, which compress about as well as the
+    app's own tables."""
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('CREATE TABLE bench_rows (id INTEGER PRIMARY KEY, body TEXT)')
+    while os.path.getsize(path) < size * 1e6:
+        connection.execute('BEGIN')
+        connection.execute(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < ?) "
+            "INSERT INTO bench_rows (body) SELECT hex(randomblob(?)) || printf('%.*c', ?, 'x') FROM n",
+            (BATCH, ROW // 4, ROW // 2))
+        connection.execute('COMMIT')
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    connection.close()
+
+
+class Writer(threading.Thread):
+    """Commits a small row every few milliseconds and records how long each
+    commit took, like the app's writes would."""
+
+    def __init__(self, path):
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.latencies = []
+        self.stopped = threading.Event()
+
+    def run(self):
+        connection = sqlite3.connect(self.path, isolation_level=None, timeout=60)
+        connection.execute('PRAGMA wal_autocheckpoint = 0')
+        while not self.stopped.wait(0.002):
+            start = time.perf_counter()
+            connection.execute("INSERT INTO bench_rows (body) VALUES ('written during the backup')")
+            self.latencies.append(time.perf_counter() - start)
+        connection.close()
+
+    def stop(self):
+        """The number of commits and the slowest in milliseconds."""
+        self.stopped.set()
+        self.join()
+        return len(self.latencies), max(self.latencies, default=0) * 1000
+
+
+def _step(path, fn, *args):
+    """Time fn with a writer going."""
+    writer = Writer(path)
+    writer.start()
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    return (elapsed,) + writer.stop()
+
+
+def _rows(path):
+    connection = sqlite3.connect(path)
+    try:
+        return connection.execute('SELECT count(*), max(id) FROM bench_rows').fetchone()
+    finally:
+        connection.close()
+
+
+def run(size=2048, writes=20000):
+    directory = tempfile.mkdtemp()
+    app = make_app(FLASKY_BACKUP_DIR=directory, FLASKY_BACKUP_WAL=True)
+    path = app.bench_database
+    target = os.path.join(directory, 'restored.sqlite')
+    try:
+        start = time.perf_counter()
+        _fill(path, size)
+        megabytes = os.path.getsize(path) / 1e6
+        print('database %.0f MB, generated in %.1f s' % (megabytes, time.perf_counter() - start))
+        print('%-22s %9s %9s %9s %9s %13s' % ('step', 'seconds', 'MB/s', 'out MB', 'commits', 'max commit ms'))
+
+        def report(name, out, elapsed, commits=0, worst=0.0):
+            print('%-22s %9.1f %9.0f %9.1f %9d %13.1f' % (name, elapsed, megabytes / elapsed, out / 1e6, commits, worst))
+
+        report('plain copy', os.path.getsize(path), *_step(path, shutil.copyfile, path, target))
+        os.remove(target)
+        with app.app_context():
+            measured = _step(path, backup.backup)
+            chain = backup.chains()[-1]
+            report('full backup', sum(os.path.getsize(os.path.join(chain, name)) for name in os.listdir(chain)),
+                   *measured)
+
+            connection = sqlite3.connect(path, isolation_level=None)
+            connection.execute('PRAGMA wal_autocheckpoint = 0')
+            for _ in range(writes):
+                connection.execute("INSERT INTO bench_rows (body) VALUES (printf('%.*c', ?, 'y'))", (ROW,))
+            connection.close()
+            elapsed, commits, worst = _step(path, backup.backup)
+            segment = backup.read_chain(chain)['segments'][-1]
+            print('%-22s %9.1f %9s %9.1f %9d %13.1f  %d frames after %d commits' % (
+                'WAL segment', elapsed, '-', os.path.getsize(os.path.join(chain, segment['name'])) / 1e6,
+                commits, worst, segment['frames'], writes))
+            # the rows the writer added while the segment was shipped
+            backup.backup()
+
+            expected = _rows(path)
+            start = time.perf_counter()
+            applied = backup.restore(chain, target)
+            report('restore, %d segments' % applied, os.path.getsize(target), time.perf_counter() - start)
+            restored = _rows(target)
+            print('restored %d rows up to id %d: %s' % (restored + (
+                'same as the database' if restored == expected else 'expected %d up to %d' % expected,)))
+            held = backup._held.pop(path, None)
+            if held is not None:
+                held.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
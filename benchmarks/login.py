@@ -0,0 +1,40 @@
+"""Logins per second, with hashing inline and in the process pool."""
+import threading
+import time
+from app import db
+from app.models import Role, User
+from . import make_app
+
+
+def _measure(workers, logins, concurrency):
+    app = make_app(FLASKY_HASH_WORKERS=workers)
+    with app.app_context():
+        Role.insert_roles()
+        for i in range(concurrency):
+            db.session.add(User(email='bench%d@example.com' % i, username='bench%d' % i,
+                                password='password', confirmed=True))
+        db.session.commit()
+
+    def worker(i, count):
+        client = app.test_client()
+        for _ in range(count):
+            client.post('/auth/login', data={'email': 'bench%d@example.com' % i,
+                                             'password': 'password'})
+            client.get('/auth/logout')
+
+    # start the pool processes before the clock does
+    app.test_client().post('/auth/login', data={'email': 'bench0@example.com', 'password': 'password'})
+    threads = [threading.Thread(target=worker, args=(i, logins // concurrency))
+               for i in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return (logins // concurrency) * concurrency / elapsed
+
+
+def run(logins=200, concurrency=8, workers=4):
+    for label, pool in (('inline', 0), ('pool of %d' % workers, workers)):
+        print('%-12s %8.1f logins/s' % (label, _measure(pool, logins, concurrency)))
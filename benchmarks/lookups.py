@@ -0,0 +1,64 @@
+"""CPU cost of the hot single-row lookups, written ad hoc with Query
+against the same lookups through app.repository."""
+import time
+from app import db, repository
+from app.models import User, Purchase, Inventory, Medicine
+from .micro import _populate
+from . import make_app
+
+# name -> (ad hoc, repository), each a function of an id
+LOOKUPS = {
+    'Medicine by id': (lambda i: Medicine.query.filter_by(medicine_id=i).first(),
+                       repository.medicine),
+    'Medicine active': (lambda i: Medicine.query.filter_by(medicine_id=i).first().active,
+                        repository.medicine_active),
+    'Inventory exists': (lambda i: Inventory.query.filter_by(medicine_id=i).first() is not None,
+                         repository.in_stock),
+    'Inventory warning': (lambda i: Inventory.query.filter_by(medicine_id=i).first().warning_count,
+                          repository.warning_count),
+    'Purchase by id': (lambda i: Purchase.query.filter_by(id=i).first(),
+                       repository.purchase),
+    'User by username': (lambda i: User.query.filter_by(username='user%d' % i).first(),
+                         lambda i: repository.user_by_username('user%d' % i)),
+    'Username taken': (lambda i: User.query.filter_by(username='user%d' % i).first() is not None,
+                       lambda i: repository.username_taken('user%d' % i)),
+}
+
+
+def _time(fn, ids, fresh, repeat=5):
+    """Best microseconds per lookup over `ids` in `repeat` runs.  With
+    `fresh` the session is cleared before every lookup, as for the first
+    lookup of a row in a request; otherwise the rows found are kept
+    referenced, as a request keeps them, so the identity map can serve them
+    again."""
+    best = None
+    for _ in range(repeat):
+        db.session.expunge_all()
+        found = []
+        start = time.perf_counter()
+        for i in ids:
+            if fresh:
+                db.session.expunge_all()
+            found.append(fn(i))
+        elapsed = (time.perf_counter() - start) / len(ids) * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(size=1000, lookups=2000):
+    app = make_app()
+    with app.app_context():
+        _populate(size)
+        db.session.execute(Purchase.__table__.insert(), [
+            {'medicine_id': i % size + 1, 'count': 1} for i in range(size)])
+        db.session.commit()
+        # every row is looked up twice, the second time from the identity map
+        # where the lookup can use it
+        ids = [i % (lookups // 2) % size + 1 for i in range(lookups)]
+        print('%-20s %12s %12s %14s %14s' % ('lookup', 'ad hoc us', 'repo us', 'ad hoc, twice', 'repo, twice'))
+        for name, (ad_hoc, repo) in LOOKUPS.items():
+            for fn in (ad_hoc, repo):
+                _time(fn, ids[:50], True)
+            print('%-20s %12.1f %12.1f %14.1f %14.1f' % (
+                name, _time(ad_hoc, ids, True), _time(repo, ids, True),
+                _time(ad_hoc, ids, False), _time(repo, ids, False)))
@@ -0,0 +1,245 @@
+"""Time, allocations and queries of the hot model and form paths, on
+generated datasets of several sizes, checked against the baselines in
+benchmarks/baselines.json.
+
+A size is the number of users and of medicines.  Every user follows
+FOLLOWS others and wrote POSTS posts; every medicine has 100 in stock."""
+import json
+import math
+import os
+import random
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from werkzeug.datastructures import MultiDict
+from app import db
+from app.models import Role, User, Permission, Post, Follow, Medicine, Inventory
+from app.main.forms import AllocateForm, PurchaseForm
+from . import make_app
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+SIZES = (100, 1000, 10000)
+FOLLOWS = 20
+POSTS = 5
+BODY = '\n\n'.join(['# Heading', 'Some *emphasis*, a [link](http://example.com) and `code`.',
+                    '* one\n* two\n* three', '<script>alert(1)</script> http://example.com/bare'] * 4)
+
+
+def _populate(size):
+    """Bulk-insert the dataset; constructors are bypassed, so that a large
+    size takes seconds rather than minutes."""
+    rng = random.Random(size)
+    now = datetime.utcnow()
+    Role.insert_roles()
+    role_id = Role.query.filter_by(default=True).first().id
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'email': 'user%d@example.com' % i, 'username': 'user%d' % i,
+         'role_id': role_id, 'password_hash': 'x', 'confirmed': True}
+        for i in range(1, size + 1)])
+    follows = []
+    for i in range(1, size + 1):
+        followed = {i} | set(rng.sample(range(1, size + 1), min(FOLLOWS, size)))
+        follows.extend({'follower_id': i, 'followed_id': j} for j in followed)
+    db.session.execute(Follow.__table__.insert(), follows)
+    db.session.execute(Post.__table__.insert(), [
+        {'body': 'post', 'body_html': '<p>post</p>', 'author_id': i % size + 1,
+         'timestamp': now - timedelta(minutes=i)}
+        for i in range(size * POSTS)])
+    db.session.execute(Medicine.__table__.insert(), [
+        {'medicine_id': i, 'medicine_name': 'medicine %d' % i, 'medicine_type': 'type %d' % (i % 10),
+         'medicine_factory': 'factory %d' % (i % 7), 'active': True}
+        for i in range(1, size + 1)])
+    db.session.execute(Inventory.__table__.insert(), [
+        {'medicine_id': i, 'medicine_name': 'medicine %d' % i, 'medicine_type': 'type %d' % (i % 10),
+         'count': 100} for i in range(1, size + 1)])
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+
+
+# name -> function(app, size) that returns the callable to measure
+CASES = {}
+
+
+def case(name):
+    def decorator(f):
+        CASES[name] = f
+        return f
+    return decorator
+
+
+@case('User.is_following')
+def is_following(app, size):
+    user, other = User.query.get(1), User.query.get(size)
+    return lambda: (user.is_following(other), other.is_following(user))
+
+
+@case('User.followed_posts')
+def followed_posts(app, size):
+    user = User.query.get(1)
+    return lambda: user.followed_posts.order_by(Post.timestamp.desc()).limit(20).all()
+
+
+@case('Role.has_permission')
+def has_permission(app, size):
+    role = Role.query.filter_by(name='Moderator').first()
+    return lambda: [role.has_permission(perm) for perm in
+                    (Permission.FOLLOW, Permission.COMMENT, Permission.WRITE, Permission.MODERATE, Permission.ADMIN)]
+
+
+@case('Post.on_changed_body')
+def on_changed_body(app, size):
+    post = Post()
+    return lambda: Post.on_changed_body(post, BODY, None, None)
+
+
+@case('AllocateForm.validate')
+def allocate_form(app, size):
+    items = '\n'.join('%d %d' % (size * n // 20 + 1, 5) for n in range(20))
+    return _form(app, AllocateForm, {'receiver': 'ward 1', 'items': items})
+
+
+@case('PurchaseForm.validate')
+def purchase_form(app, size):
+    return _form(app, PurchaseForm, {'medicine_id': str(size // 2), 'count': '10'})
+
+
+def _form(app, form_class, data):
+    def validate():
+        assert form_class(formdata=MultiDict(data)).validate()
+    return validate
+
+
+def _reference():
+    """A fixed pure Python workload that the cases are timed against."""
+    return sorted(str(i) for i in range(1000))
+
+
+def _loop(fn, budget):
+    """How many calls of `fn` take about `budget` seconds."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget:
+            return number
+        number *= 2 if elapsed == 0 else max(2, int(budget / elapsed))
+
+
+def _time(fn, number):
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return (time.perf_counter() - start) / number
+
+
+def _measure(fn, repeat=7, budget=0.05):
+    """Time per call in microseconds, also relative to the reference
+    workload, then the bytes allocated and the queries sent by one call.
+
+    The case and the reference are timed in alternation and the median of
+    the ratios is kept, so that a machine that slows down for a while, or
+    another machine altogether, still compares with the baselines."""
+    fn()
+    number, reference = _loop(fn, budget), _loop(_reference, budget)
+    times, ratios = [], []
+    for _ in range(repeat):
+        times.append(_time(fn, number))
+        ratios.append(times[-1] / _time(_reference, reference))
+
+    queries = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    db.event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        fn()
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', count)
+    # the peak of the smallest of a few calls, so that a garbage collection
+    # or a cache fill landing in one of them does not count
+    allocated = []
+    for _ in range(repeat):
+        tracemalloc.start()
+        try:
+            fn()
+            allocated.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+    return {'us': round(min(times) * 1e6, 1), 'x': round(sorted(ratios)[repeat // 2], 3), 'kb': round(min(allocated) / 1024.0, 1), 'queries': len(queries)}
+
+
+def measure(sizes=SIZES, names=None):
+    """{case: {size: measurement}} for every case, or the named ones."""
+    results = {name: {} for name in CASES if not names or name in names}
+    for size in sizes:
+        app = make_app()
+        with app.app_context():
+            _populate(size)
+            for name in results:
+                with app.test_request_context('/', method='POST'):
+                    results[name][str(size)] = _measure(CASES[name](app, size))
+                    db.session.remove()
+        os.remove(app.bench_database)
+    return results
+
+
+def _slope(points):
+    """Growth exponent of time against size: about 0 for constant, 1 for
+    linear."""
+    (size0, first), (size1, last) = points[0], points[-1]
+    if size0 == size1 or first <= 0 or last <= 0:
+        return 0.0
+    return math.log(last / first) / math.log(size1 / size0)
+
+
+def regressions(results, baselines, tolerance):
+    """(case, size, what, baseline, now) for every measurement more than
+    `tolerance` slower, relative to the reference, or bigger than its
+    baseline.  Query counts are deterministic, so any increase counts."""
+    found = []
+    for name, by_size in results.items():
+        for size, now in by_size.items():
+            base = baselines.get(name, {}).get(size)
+            if base is None:
+                continue
+            if now['queries'] > base['queries']:
+                found.append((name, size, 'queries', base['queries'], now['queries']))
+            # a floor for the smallest cases, whose noise exceeds any ratio
+            for what, floor in (('x', 0.05), ('kb', 1)):
+                if now[what] > base[what] * (1 + tolerance) and now[what] - base[what] > floor:
+                    found.append((name, size, what, base[what], now[what]))
+    return found
+
+
+def run(sizes=SIZES, names=None, save=False, tolerance=0.5):
+    """Measure, print a table with the baselines and the scaling, and
+    return the regressions.  With `save` the results become the new
+    baselines instead."""
+    results = measure(sizes, names)
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    print('%-24s %7s %10s %8s %8s %9s %8s' % ('case', 'size', 'us', 'x ref', 'baseline', 'kb', 'queries'))
+    for name, by_size in results.items():
+        for size, now in by_size.items():
+            base = baselines.get(name, {}).get(size)
+            print('%-24s %7s %10.1f %8.3f %8s %9.1f %8d' % (
+                name, size, now['us'], now['x'], '%.3f' % base['x'] if base else '-', now['kb'], now['queries']))
+        points = [(int(size), now['x']) for size, now in by_size.items()]
+        print('%-24s %7s  time ~ size^%.2f' % ('', 'scaling', _slope(points)))
+    if save:
+        for name, by_size in results.items():
+            baselines.setdefault(name, {}).update(by_size)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('Saved baselines to %s' % BASELINES)
+        return []
+    found = regressions(results, baselines, tolerance)
+    for name, size, what, base, now in found:
+        print('REGRESSION %s at %s: %s %s -> %s' % (name, size, what, base, now))
+    return found
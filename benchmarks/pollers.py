@@ -0,0 +1,94 @@
+"""Many concurrent pollers of /api/inventory, served by the threaded WSGI
+server and by the async read path under uvicorn, each in its own process."""
+import asyncio
+import logging
+import multiprocessing
+import socket
+import time
+from app import db
+from app.models import Role, User, Medicine, Inventory
+from . import make_app
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _serve(kind, app, port):
+    if kind == 'sync':
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+    else:
+        import uvicorn
+        from app.aio import ReadPath
+        uvicorn.run(ReadPath(app), host='127.0.0.1', port=port, log_level='warning')
+
+
+async def _get(port, cookie):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(('GET /api/inventory?page=2 HTTP/1.1\r\nHost: localhost\r\nCookie: %s\r\n'
+                  'Connection: close\r\n\r\n' % cookie).encode('ascii'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return response.split(b' ', 2)[1]
+
+
+async def _poll(port, cookie, pollers, requests):
+    latencies = []
+    errors = 0
+
+    async def poller():
+        nonlocal errors
+        for _ in range(requests):
+            start = time.perf_counter()
+            try:
+                if await _get(port, cookie) != b'200':
+                    errors += 1
+            except OSError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(poller() for _ in range(pollers)))
+    return time.perf_counter() - start, sorted(latencies), errors
+
+
+def _wait_for(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+
+def run(pollers=200, requests=10):
+    app = make_app()
+    with app.app_context():
+        Role.insert_roles()
+        Medicine.insert_medicine()
+        db.session.add(User(email='bench@example.com', username='bench', password='password', confirmed=True))
+        for medicine_id in range(1, 501):
+            db.session.add(Inventory(medicine_id=medicine_id, count=medicine_id, warning_count=100))
+        db.session.commit()
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'bench@example.com', 'password': 'password'})
+    cookie = '; '.join('%s=%s' % (c.name, c.value) for c in client.cookie_jar)
+
+    print('%-6s %8s %8s %8s %8s %7s' % ('path', 'req/s', 'p50 ms', 'p95 ms', 'max ms', 'errors'))
+    for kind in ('sync', 'async'):
+        port = _free_port()
+        server = multiprocessing.get_context('fork').Process(target=_serve, args=(kind, app, port), daemon=True)
+        server.start()
+        _wait_for(port)
+        asyncio.run(_poll(port, cookie, 10, 2))
+        elapsed, latencies, errors = asyncio.run(_poll(port, cookie, pollers, requests))
+        server.terminate()
+        server.join()
+        print('%-6s %8.1f %8.1f %8.1f %8.1f %7d' % (
+            kind, len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000, latencies[-1] * 1000, errors))
@@ -0,0 +1,62 @@
+"""Read latency on /inventory while other users flood /purchase, with and
+without write admission control."""
+import threading
+import time
+from app import db
+from app.models import Role, User, Medicine
+from . import make_app
+
+
+def _client(app, i):
+    client = app.test_client()
+    client.post('/auth/login', data={'email': 'bench%d@example.com' % i, 'password': 'password'})
+    return client
+
+
+def _measure(limits, writers, seconds):
+    app = make_app(FLASKY_WRITE_LIMITS=limits)
+    with app.app_context():
+        Role.insert_roles()
+        Medicine.insert_medicine()
+        for i in range(writers + 1):
+            db.session.add(User(email='bench%d@example.com' % i, username='bench%d' % i,
+                                password='password', confirmed=True,
+                                role=Role.query.filter_by(name='Administrator').first()))
+        db.session.commit()
+    reader = _client(app, writers)
+    clients = [_client(app, i) for i in range(writers)]
+    statuses = {}
+    latencies = []
+    done = threading.Event()
+
+    def write(client):
+        while not done.is_set():
+            status = client.post('/purchase', data={'medicine_id': 1, 'count': 1}).status_code
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def read():
+        while not done.is_set():
+            start = time.perf_counter()
+            reader.get('/inventory')
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=write, args=(client,)) for client in clients]
+    threads.append(threading.Thread(target=read))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    done.set()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return latencies, statuses
+
+
+def run(writers=8, seconds=5):
+    print('%-10s %8s %8s %8s %8s  %s' % ('limits', 'reads', 'p50 ms', 'p95 ms', 'max ms', 'write statuses'))
+    for label, limits, count in (('no writes', False, 0), ('off', False, writers), ('on', True, writers)):
+        latencies, statuses = _measure(limits, count, seconds)
+        print('%-10s %8d %8.1f %8.1f %8.1f  %s' % (
+            label, len(latencies), latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000, latencies[-1] * 1000,
+            ', '.join('%d: %d' % item for item in sorted(statuses.items()))))
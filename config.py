@@ -18,6 +18,60 @@ class Config:
     FLASKY_POSTS_PER_PAGE = 20
     FLASKY_FOLLOWERS_PER_PAGE = 50
     FLASKY_COMMENTS_PER_PAGE = 5
+    FLASKY_TIMELINE_LENGTH = 500
+    # werkzeug method including the iteration count; hashes made with other
+    # parameters are upgraded on the next successful login
+    FLASKY_HASH_METHOD = os.environ.get('FLASKY_HASH_METHOD', 'pbkdf2:sha256:150000')
+    FLASKY_HASH_SALT_LENGTH = 8
+    FLASKY_HASH_WORKERS = int(os.environ.get('FLASKY_HASH_WORKERS', '2'))
+    FLASKY_HASH_QUEUE = 32
+    FLASKY_HASH_TIMEOUT = 10
+    FLASKY_ARCHIVE_DAYS = int(os.environ.get('FLASKY_ARCHIVE_DAYS', '365'))
+    FLASKY_ARCHIVE_BATCH_SIZE = 1000
+    FLASKY_ANALYTICS_CHUNK_SIZE = 50000
+    FLASKY_ANALYTICS_CACHE_DAYS = 400
+    FLASKY_LIVE_HEARTBEAT = 15
+    FLASKY_LIVE_QUEUE = 100
+    FLASKY_COMPRESS_MIN_SIZE = 1024
+    # gzip level, or brotli quality when the brotli package is installed
+    FLASKY_COMPRESS_LEVEL = 6
+    FLASKY_TEMPLATE_CACHE = os.environ.get('FLASKY_TEMPLATE_CACHE') or os.path.join(basedir, '.jinja-cache')
+    # write admission control, see decorators.write_limited
+    FLASKY_WRITE_LIMITS = True
+    FLASKY_WRITE_RATE = 2
+    FLASKY_WRITE_BURST = 10
+    FLASKY_WRITE_GLOBAL_RATE = 50
+    FLASKY_WRITE_GLOBAL_BURST = 100
+    FLASKY_WRITE_CONCURRENCY = 4
+    FLASKY_WRITE_WAIT = 0.5
+    FLASKY_WRITE_USERS = 10000
+    FLASKY_CATALOG_BATCH_SIZE = 1000
+    FLASKY_STOCKTAKE_BATCH_SIZE = 10000
+    FLASKY_ASYNC_CONNECTIONS = 4
+    # background jobs of app.jobs, as cron schedules in UTC
+    FLASKY_JOBS = {
+        'archive': '30 2 * * *',
+        'reconcile': '15 * * * *',
+        'counters': '0 4 * * 0',
+        'optimize': '0 5 * * *',
+        'backup': '*/15 * * * *',
+    }
+    # only production runs the scheduler unless it is switched on
+    FLASKY_JOBS_ENABLED = os.environ.get('FLASKY_JOBS_ENABLED', 'false').lower() in ['true', 'on', '1']
+    FLASKY_JOBS_WORKERS = 2
+    FLASKY_JOBS_POLL = 30
+    FLASKY_JOBS_LOCK_SECONDS = 3600
+    # online backups of the SQLite databases, see app.backup
+    FLASKY_BACKUP_DIR = os.environ.get('FLASKY_BACKUP_DIR') or os.path.join(basedir, 'backups')
+    FLASKY_BACKUP_PAGES = 1024
+    FLASKY_BACKUP_SLEEP = 0.005
+    # gzip level of backups, 0 for none
+    FLASKY_BACKUP_COMPRESS_LEVEL = 1
+    FLASKY_BACKUP_BASE_HOURS = 24
+    FLASKY_BACKUP_KEEP = 7
+    # ship the write-ahead log between full backups; the app's connections
+    # then never checkpoint, so the backup job must stay scheduled
+    FLASKY_BACKUP_WAL = os.environ.get('FLASKY_BACKUP_WAL', 'false').lower() in ['true', 'on', '1']
 
     @staticmethod
     def init_app(app):
@@ -28,17 +82,38 @@ class DevelopmentConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or \
                               'sqlite:///' + os.path.join(basedir, 'data-dev.sqlite')
+    SQLALCHEMY_BINDS = {
+        'archive': os.environ.get('DEV_ARCHIVE_DATABASE_URL') or
+                   'sqlite:///' + os.path.join(basedir, 'data-dev-archive.sqlite'),
+        # a query_only pool on the primary file unless a replica is configured
+        'replica': os.environ.get('DEV_REPLICA_DATABASE_URL') or
+                   'sqlite:///' + os.path.join(basedir, 'data-dev.sqlite')
+    }
 
 
 class TestingConfig(Config):
     TESTING = True
+    FLASKY_HASH_WORKERS = 0
+    FLASKY_TEMPLATE_CACHE = None
+    FLASKY_WRITE_LIMITS = False
+    FLASKY_JOBS_ENABLED = False
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or \
                               'sqlite://'
+    SQLALCHEMY_BINDS = {
+        'archive': os.environ.get('TEST_ARCHIVE_DATABASE_URL') or 'sqlite://'
+    }
 
 
 class ProductionConfig(Config):
+    FLASKY_JOBS_ENABLED = os.environ.get('FLASKY_JOBS_ENABLED', 'true').lower() in ['true', 'on', '1']
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
                               'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    SQLALCHEMY_BINDS = {
+        'archive': os.environ.get('ARCHIVE_DATABASE_URL') or
+                   'sqlite:///' + os.path.join(basedir, 'data-archive.sqlite'),
+        'replica': os.environ.get('REPLICA_DATABASE_URL') or
+                   'sqlite:///' + os.path.join(basedir, 'data.sqlite')
+    }
 
 
 config = {
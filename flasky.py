@@ -2,7 +2,7 @@ import os
 import click
 from flask_migrate import Migrate
 from app import create_app, db
-from app.models import User, Role, Permission, Post, Follow, Comment,Medicine
+from app.models import User, Role, Permission, Post, Follow, Comment, Medicine, Allocate, AllocateOrder
 
 app = create_app(os.getenv('FLASK_CONFIG') or 'default')
 migrate = Migrate(app, db)
@@ -11,7 +11,8 @@ migrate = Migrate(app, db)
 @app.shell_context_processor
 def make_shell_context():
     return dict(db=db, User=User, Follow=Follow, Role=Role,
-                Permission=Permission, Post=Post, Comment=Comment,Medicine=Medicine)
+                Permission=Permission, Post=Post, Comment=Comment, Medicine=Medicine,
+                Allocate=Allocate, AllocateOrder=AllocateOrder)
 
 
 @app.cli.command()
@@ -24,3 +25,271 @@ def test(test_names):
     else:
         tests = unittest.TestLoader().discover('tests')
     unittest.TextTestRunner(verbosity=2).run(tests)
+
+
+@app.cli.command()
+@click.option('--days', type=int, default=None,
+              help='Archive closed rows older than this many days.')
+@click.option('--vacuum', is_flag=True, help='Shrink the database file afterwards.')
+def archive(days, vacuum):
+    """Move closed ledger rows to the archive database."""
+    from app.archive import archive as archive_ledger
+    moved = archive_ledger(days)
+    for table, count in moved.items():
+        click.echo('%s: %d rows archived' % (table, count))
+    if vacuum:
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('VACUUM')
+
+
+@app.cli.command()
+@click.option('--bind', default=None, help='Back up this bind instead of the main database.')
+@click.option('--full', is_flag=True, help='Start a new chain with a full backup.')
+@click.option('--list', 'list_chains', is_flag=True, help='Only list the backup chains.')
+def backup(bind, full, list_chains):
+    """Back up the database while the app is running."""
+    from app.backup import backup as backup_database, chains, read_chain
+    if list_chains:
+        for chain in chains(bind):
+            state = read_chain(chain)
+            click.echo('%s  %d WAL segments%s' % (chain, len(state['segments']),
+                                                  '' if state['wal'] else ', closed'))
+        return
+    try:
+        click.echo(backup_database(bind, full=full))
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+
+@app.cli.command()
+@click.argument('chain', required=False)
+@click.option('--bind', default=None, help='Restore this bind instead of the main database.')
+@click.option('--target', type=click.Path(dir_okay=False), help='Restore to this file instead.')
+@click.option('--segments', type=int, default=None, help='Apply only the first N WAL segments.')
+@click.option('--check', is_flag=True, help='Run a quick integrity check before replacing the target.')
+@click.option('--force', is_flag=True, help='Replace an existing target.')
+def restore(chain, bind, target, segments, check, force):
+    """Restore the database from a backup chain, the newest by default.
+    Stop the app first."""
+    import time
+    from app.backup import restore as restore_database, chains, database_path
+    found = chains(bind)
+    chain = chain or (found[-1] if found else None)
+    if chain is None:
+        raise click.ClickException('No backups found.')
+    target = target or database_path(bind)
+    if os.path.exists(target) and not force:
+        raise click.ClickException('%s exists; use --force to replace it.' % target)
+    start = time.perf_counter()
+    try:
+        applied = restore_database(chain, target, segments, check)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo('Restored %s with %d WAL segments to %s in %.1f s.'
+               % (chain, applied, target, time.perf_counter() - start))
+
+
+@app.cli.command()
+def reindex():
+    """Rebuild the full-text search indexes of posts and comments."""
+    from app.search import rebuild
+    rebuild()
+
+
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--keep-missing', is_flag=True, help='Do not deactivate medicines missing from the file.')
+def catalog(path, keep_missing):
+    """Sync the Medicine catalog with a supplier master CSV file."""
+    from app.catalog import read_csv, sync
+    counts = sync(read_csv(path), deactivate=not keep_missing)
+    click.echo('%(inserted)d inserted, %(updated)d updated, %(deactivated)d deactivated, '
+               '%(inventory)d inventory rows renamed.' % counts)
+
+
+@app.cli.command()
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--email', required=True, help='The user the stock take is booked to.')
+@click.option('--full', is_flag=True, help='Count medicines missing from the file as zero.')
+@click.option('--post', 'post_now', is_flag=True, help='Post the adjustments right away.')
+def stocktake(path, email, full, post_now):
+    """Load a medicine_id,count CSV file as a stock take."""
+    from app.stocktake import read_csv, start, totals, post
+    author = User.query.filter_by(email=email).first()
+    if author is None:
+        raise click.ClickException('No user with email %s.' % email)
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        try:
+            stock_take = start(read_csv(f), author, full=full)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    click.echo('Stock take %d: %d lines, %d variances, %d found, %d missing.'
+               % ((stock_take.id,) + tuple(totals(stock_take))))
+    if post_now:
+        click.echo('%d adjustments posted.' % post(stock_take, author))
+
+
+@app.cli.command()
+def precompile():
+    """Compile every template into the Jinja bytecode cache."""
+    if not app.config['FLASKY_TEMPLATE_CACHE']:
+        raise click.ClickException('FLASKY_TEMPLATE_CACHE is not set.')
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    click.echo('Compiled %d templates into %s.' % (len(names), app.config['FLASKY_TEMPLATE_CACHE']))
+
+
+@app.cli.command()
+def counters():
+    """Recompute the post, comment and follow counters."""
+    User.repair_counters()
+
+
+@app.cli.group()
+def bench():
+    """Run the benchmarks in the benchmarks package."""
+
+
+@bench.command()
+@click.option('--logins', default=200, help='Total number of logins.')
+@click.option('--concurrency', default=8, help='Number of concurrent clients.')
+@click.option('--workers', default=4, help='Size of the hashing pool.')
+def login(logins, concurrency, workers):
+    """Measure logins per second with inline and pooled hashing."""
+    from benchmarks import login as login_benchmark
+    login_benchmark.run(logins, concurrency, workers)
+
+
+@bench.command()
+@click.option('--writers', default=8, help='Number of users flooding /purchase.')
+@click.option('--seconds', default=5, help='Length of each run.')
+def writes(writers, seconds):
+    """Measure read latency under a write flood, with and without limits."""
+    from benchmarks import writes as writes_benchmark
+    writes_benchmark.run(writers, seconds)
+
+
+@bench.command()
+@click.option('--pollers', default=200, help='Number of concurrent pollers.')
+@click.option('--requests', default=10, help='Requests per poller.')
+def pollers(pollers, requests):
+    """Compare the sync and async read paths under many pollers."""
+    from benchmarks import pollers as pollers_benchmark
+    pollers_benchmark.run(pollers, requests)
+
+
+@bench.command()
+@click.option('--size', default=1000, help='Number of users, medicines and purchases.')
+@click.option('--lookups', default=2000, help='Lookups per measurement.')
+def lookups(size, lookups):
+    """Compare ad hoc queries with app.repository for the hot lookups."""
+    from benchmarks import lookups as lookups_benchmark
+    lookups_benchmark.run(size, lookups)
+
+
+@bench.command('backup')
+@click.option('--size', default=2048, help='Size of the generated database in MB.')
+@click.option('--writes', default=20000, help='Commits shipped as one WAL segment.')
+def backup_bench(size, writes):
+    """Time a full online backup, a WAL segment and a restore."""
+    from benchmarks import backup as backup_benchmark
+    backup_benchmark.run(size, writes)
+
+
+@bench.command()
+@click.option('--size', 'sizes', type=int, multiple=True, help='Dataset size; repeat for several.')
+@click.option('--case', 'names', multiple=True, help='Only run this case; repeat for several.')
+@click.option('--save', is_flag=True, help='Store the results as the new baselines.')
+@click.option('--tolerance', default=0.5, help='Allowed slowdown over the baseline, 0.5 = 50%.')
+def micro(sizes, names, save, tolerance):
+    """Time the hot model and form paths against the stored baselines."""
+    from benchmarks import micro as micro_benchmark
+    found = micro_benchmark.run(sizes or micro_benchmark.SIZES, names, save, tolerance)
+    if found:
+        raise click.ClickException('%d regressions' % len(found))
+
+
+@app.cli.command()
+@click.option('--full', is_flag=True, help='Recompute from every movement, archive included.')
+@click.option('--repair', 'fix', is_flag=True, help='Write the expected counts to Inventory.')
+def reconcile(full, fix):
+    """Check Inventory against the ledger."""
+    from app.reconcile import expected_stock, stock_drift, repair
+    drift = stock_drift(expected_stock(full))
+    for medicine_id, count, expected in drift:
+        click.echo('medicine %d: inventory %s, expected %d' % (medicine_id, count, expected))
+    if fix and drift:
+        repair(drift)
+        click.echo('Repaired %d inventory rows.' % len(drift))
+
+
+@app.cli.group()
+def jobs():
+    """List, run and pause the background jobs."""
+
+
+@jobs.command('list')
+def list_jobs():
+    """Show every job with its schedule and last run."""
+    from app.jobs import sync
+    from app.models import Job
+    sync()
+    for row in Job.query.order_by(Job.name):
+        click.echo('%-10s %-14s %-7s next %s  last %s %s%s' % (
+            row.name, row.schedule, 'paused' if row.paused else 'active', row.next_run,
+            row.last_run or '-', row.last_status or '',
+            '  locked by %s until %s' % (row.locked_by, row.locked_until) if row.locked_by else ''))
+
+
+@jobs.command('run')
+@click.argument('name')
+def run_job(name):
+    """Run a job now, in the foreground."""
+    from app.jobs import sync, claim, run
+    sync()
+    owner = 'cli:%d' % os.getpid()
+    if not claim(name, owner, force=True):
+        raise click.ClickException('%s is unknown or running elsewhere.' % name)
+    status, result = run(name, owner)
+    click.echo('%s: %s' % (status, result))
+
+
+@jobs.command('pause')
+@click.argument('name')
+def pause_job(name):
+    """Stop scheduling a job."""
+    _set_paused(name, True)
+
+
+@jobs.command('resume')
+@click.argument('name')
+def resume_job(name):
+    """Schedule a paused job again."""
+    _set_paused(name, False)
+
+
+def _set_paused(name, paused):
+    from app.jobs import sync
+    from app.models import Job
+    sync()
+    row = Job.query.get(name)
+    if row is None:
+        raise click.ClickException('No job named %s.' % name)
+    row.paused = paused
+    db.session.commit()
+
+
+@jobs.command('serve')
+def serve_jobs():
+    """Run the scheduler in this process until interrupted, for deployments
+    that keep jobs out of the web workers."""
+    import time
+    from app.jobs import Scheduler
+    scheduler = Scheduler(app)
+    scheduler.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        scheduler.stop()
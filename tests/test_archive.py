@@ -0,0 +1,106 @@
+import unittest
+from datetime import date, datetime
+from sqlalchemy.schema import CreateTable
+from app import create_app, db
+from app.archive import archive, ledger, lookup
+from app.models import Role, User, Medicine, Purchase, Refund, Storage, PurchaseArchive, RefundArchive, \
+    StorageArchive
+
+OLD = datetime(2020, 1, 5)
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        Medicine.insert_medicine()
+        user = User(email='john@example.com', username='john', password='cat', confirmed=True,
+                    role=Role.query.filter_by(name='Administrator').first())
+        db.session.add(user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def purchase(self, medicine_id, count):
+        self.client.post('/purchase', data={'medicine_id': medicine_id, 'count': count})
+        return Purchase.query.order_by(Purchase.id.desc()).first().id
+
+    def age(self):
+        for model in (Purchase, Refund, Storage):
+            model.query.update({'timestamp': OLD})
+        db.session.commit()
+
+    def account(self):
+        return self.client.post('/account', data={
+            'start_year': 2020, 'start_month': 1, 'start_day': 1,
+            'end_year': 2020, 'end_month': 1, 'end_day': 31}).get_data(as_text=True)
+
+    def test_refunded_purchase_moves_with_its_rows(self):
+        stored = self.purchase(1, 7)
+        self.client.post('/storage', data={'storage_items_id': str(stored)})
+        self.client.post('/return_goods', data={'purchase_id': str(stored)})
+        kept = self.purchase(2, 5)
+        self.client.post('/storage', data={'storage_items_id': str(kept)})
+        self.age()
+        self.client.get('/account')
+        before = self.account()
+
+        moved = archive(30)
+        self.assertEqual((moved['Purchase'], moved['Storage'], moved['Refund']), (1, 1, 1))
+        self.assertEqual([purchase.id for purchase in Purchase.query], [kept])
+        self.assertEqual(PurchaseArchive.query.get(stored).count, 7)
+        self.assertEqual(StorageArchive.query.count(), 1)
+        self.assertEqual(RefundArchive.query.count(), 1)
+        self.assertEqual([row.id for row in ledger(Purchase, date(2020, 1, 1), date(2020, 1, 5))],
+                         [stored, kept])
+        self.assertEqual(lookup(Purchase, [stored, kept])[stored].medicine_id, 1)
+        self.assertEqual(self.account(), before)
+
+        self.assertEqual(sum(archive(30).values()), 0)
+        self.assertEqual(PurchaseArchive.query.count(), 1)
+        self.assertEqual(Purchase.query.count(), 1)
+
+    def test_stored_purchase_stays_refundable(self):
+        stored = self.purchase(1, 7)
+        self.client.post('/storage', data={'storage_items_id': str(stored)})
+        self.age()
+        self.assertEqual(archive(30)['Purchase'], 0)
+        self.client.post('/return_goods', data={'purchase_id': str(stored)})
+        self.assertEqual(Refund.query.count(), 1)
+
+    def test_archived_ids_are_not_handed_out_again(self):
+        refunded = self.purchase(1, 7)
+        self.client.post('/return_goods', data={'purchase_id': str(refunded)})
+        self.age()
+        archive(30)
+        self.assertNotEqual(self.purchase(2, 5), refunded)
+        self.assertEqual(lookup(Purchase, [refunded])[refunded].medicine_id, 1)
+
+    def test_reused_id_does_not_overwrite_the_archive(self):
+        # the ledger tables of a database created before AUTOINCREMENT
+        Purchase.__table__.drop(db.engine)
+        db.session.execute(str(CreateTable(Purchase.__table__).compile(db.engine)).replace(' AUTOINCREMENT', ''))
+        db.session.commit()
+        refunded = self.purchase(1, 7)
+        self.client.post('/return_goods', data={'purchase_id': str(refunded)})
+        self.age()
+        archive(30)
+        reused = self.purchase(2, 5)
+        self.assertEqual(reused, refunded)
+        self.client.post('/return_goods', data={'purchase_id': str(reused)})
+        self.age()
+
+        with self.assertRaises(ValueError):
+            archive(30)
+        archived = PurchaseArchive.query.get(refunded)
+        self.assertEqual((archived.medicine_id, archived.count), (1, 7))
+        self.assertEqual(Purchase.query.get(reused).medicine_id, 2)
@@ -0,0 +1,99 @@
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from app import create_app, db, backup
+from app.models import Role, User, Post
+
+
+class BackupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'data.sqlite')
+        self.app = create_app('testing')
+        self.app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + self.path, FLASKY_BACKUP_WAL=True,
+                               FLASKY_BACKUP_DIR=os.path.join(self.directory, 'backups'))
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email='john@example.com', username='john', password='cat', confirmed=True)
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine().dispose()
+        self.app_context.pop()
+        held = backup._held.pop(self.path, None)
+        if held is not None:
+            held.close()
+        shutil.rmtree(self.directory)
+
+    def write(self, count, body='post'):
+        for n in range(count):
+            db.session.add(Post(body='%s %d' % (body, n), author=self.user))
+            db.session.commit()
+
+    def posts(self, path):
+        connection = sqlite3.connect(path)
+        try:
+            self.assertEqual(connection.execute('PRAGMA integrity_check').fetchone()[0], 'ok')
+            return connection.execute('SELECT count(*), max(id) FROM posts').fetchone()
+        finally:
+            connection.close()
+
+    def test_shipped_segments_restore(self):
+        self.write(20)
+        backup.backup()
+        chain, = backup.chains()
+        self.write(30)
+        self.assertIn('frames shipped', backup.backup())
+        shipped = self.posts(self.path)
+        salt = backup.read_chain(chain)['wal']['salt1']
+        # enough frames for the run to checkpoint and restart the log
+        self.write(300, 'x' * 3000)
+        backup.backup()
+        self.write(10)
+        backup.backup()
+        complete = self.posts(self.path)
+        self.write(5)
+
+        state = backup.read_chain(chain)
+        self.assertEqual(len(state['segments']), 3)
+        self.assertNotEqual(state['wal']['salt1'], salt)
+        target = os.path.join(self.directory, 'restored.sqlite')
+        self.assertEqual(backup.restore(chain, target, check=True), 3)
+        self.assertEqual(self.posts(target), complete)
+        self.assertEqual(backup.restore(chain, target, segments=1), 1)
+        self.assertEqual(self.posts(target), shipped)
+        self.assertEqual(backup.restore(chain, target, segments=0), 0)
+        self.assertEqual(self.posts(target), (20, 20))
+
+    def test_only_complete_commits_are_copied(self):
+        backup.backup()
+        self.write(3)
+        with open(self.path + '-wal', 'rb') as f:
+            log = f.read()
+        position = backup._header(io.BytesIO(log))
+        size = backup.FRAME_HEADER + position['page_size']
+        frames, end = backup._copy_frames(io.BytesIO(log), position, io.BytesIO())
+        self.assertEqual(end['offset'], len(log))
+
+        # a torn last frame drops the whole last commit
+        out = io.BytesIO()
+        copied, torn = backup._copy_frames(io.BytesIO(log[:-10]), position, out)
+        self.assertLess(copied, frames)
+        self.assertEqual(len(out.getvalue()), copied * size)
+        self.assertEqual(torn['offset'], backup.WAL_HEADER + copied * size)
+
+        # so does a frame whose checksum does not match
+        damaged = bytearray(log)
+        damaged[-1] ^= 0xff
+        self.assertEqual(backup._copy_frames(io.BytesIO(bytes(damaged)), position, io.BytesIO())[0], copied)
+
+        # and shipping goes on from where the copy stopped
+        rest, after = backup._copy_frames(io.BytesIO(log), torn, io.BytesIO())
+        self.assertEqual((copied + rest, after['offset']), (frames, len(log)))
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from app import create_app, db
+from app.decorators import read_only
+from app.models import Inventory
+from app.routing import REPLICA
+
+
+class RoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.app = create_app('testing')
+        url = 'sqlite:///' + self.path
+        self.app.config['SQLALCHEMY_DATABASE_URI'] = url
+        self.app.config['SQLALCHEMY_BINDS'] = dict(self.app.config['SQLALCHEMY_BINDS'], **{REPLICA: url})
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add(Inventory(medicine_id=1, medicine_name='a', count=5))
+        db.session.commit()
+        self.primary = db.get_engine(self.app)
+        self.replica = db.get_engine(self.app, bind=REPLICA)
+        self.statements = []
+        for engine in (self.primary, self.replica):
+            event.listen(engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        for engine in (self.primary, self.replica):
+            event.remove(engine, 'before_cursor_execute', self.record)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        for engine in (self.primary, self.replica):
+            engine.dispose()
+        os.remove(self.path)
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append((conn.engine, statement.split()[0].upper()))
+
+    def engines(self, verb):
+        return {engine for engine, statement in self.statements if statement == verb}
+
+    def test_reads_in_read_only_views_use_the_replica(self):
+        @read_only
+        def view():
+            return Inventory.query.get(1).count
+
+        self.assertEqual(view(), 5)
+        self.assertEqual(self.engines('SELECT'), {self.replica})
+
+    def test_reads_elsewhere_use_the_primary(self):
+        db.session.expire_all()
+        self.assertEqual(Inventory.query.get(1).count, 5)
+        self.assertEqual(self.engines('SELECT'), {self.primary})
+
+    def test_writes_in_read_only_views_use_the_primary(self):
+        @read_only
+        def view():
+            db.session.add(Inventory(medicine_id=2, medicine_name='b', count=1))
+            db.session.flush()
+            db.session.execute(Inventory.__table__.update()
+                               .where(Inventory.medicine_id == 1).values(count=4))
+            db.session.commit()
+
+        view()
+        self.assertEqual(self.engines('INSERT'), {self.primary})
+        self.assertEqual(self.engines('UPDATE'), {self.primary})
+        self.assertEqual(Inventory.query.get(1).count, 4)
+
+    def test_replica_connections_are_query_only(self):
+        with self.replica.connect() as connection:
+            with self.assertRaises(OperationalError):
+                connection.exec_driver_sql("UPDATE inventory SET count = 0")
@@ -0,0 +1,102 @@
+import unittest
+from app import create_app, db
+from app.models import Role, User, Medicine, Purchase, Refund, Inventory, Valuation, CostLayer, CostOfGoods, \
+    AllocateOrder, Allocate
+
+
+class ValuationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app('testing')
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        Medicine.insert_medicine()
+        self.user = User(email='john@example.com', username='john', password='cat', confirmed=True,
+                         role=Role.query.filter_by(name='Administrator').first())
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post('/auth/login', data={'email': 'john@example.com', 'password': 'cat'})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def stock(self, medicine_id, count, unit_cost):
+        """Purchase and store goods, returning the purchase id."""
+        self.client.post('/purchase', data={'medicine_id': medicine_id, 'count': count, 'unit_cost': unit_cost})
+        purchase_id = Purchase.query.order_by(Purchase.id.desc()).first().id
+        self.client.post('/storage', data={'storage_items_id': str(purchase_id)})
+        return purchase_id
+
+    def valuation(self, medicine_id):
+        row = Valuation.query.get(medicine_id)
+        return row.quantity, row.fifo_value, row.average_value
+
+    def state(self):
+        db.session.expire_all()
+        return (sorted((row.medicine_id, row.count) for row in Inventory.query),
+                sorted((row.medicine_id, row.quantity, row.fifo_value, row.average_value)
+                       for row in Valuation.query),
+                [(row.id, row.remaining) for row in CostLayer.query.order_by(CostLayer.id)])
+
+    def test_fifo_across_two_layers(self):
+        self.stock(1, 10, '1.00')
+        self.stock(1, 10, '2.00')
+        order, shortages = AllocateOrder.place(1, [(1, 15)], self.user)
+        self.assertEqual(shortages, [])
+        item = order.items[0]
+        self.assertEqual((item.fifo_cost, item.average_cost), (2000, 2250))
+        self.assertEqual([layer.remaining for layer in CostLayer.query.order_by(CostLayer.id)], [0, 5])
+        self.assertEqual(self.valuation(1), (5, 1000, 750))
+        self.assertEqual(CostOfGoods.query.one().fifo_cost, 2000)
+        self.assertEqual(Inventory.query.get(1).count, 5)
+
+    def test_refund_consumes_its_own_layer_first(self):
+        self.stock(1, 10, '1.00')
+        newer = self.stock(1, 10, '3.00')
+        self.assertTrue(Refund.return_purchases([newer], self.user))
+        refund = Refund.query.one()
+        self.assertEqual((refund.fifo_cost, refund.average_cost), (3000, 2000))
+        self.assertEqual([layer.remaining for layer in CostLayer.query.order_by(CostLayer.id)], [10, 0])
+        self.assertEqual(self.valuation(1), (10, 1000, 2000))
+        self.assertEqual(Inventory.query.get(1).count, 10)
+
+    def test_average_cost_after_a_partial_issue(self):
+        self.stock(2, 3, '1.00')
+        self.stock(2, 4, '2.00')
+        self.assertEqual(Valuation.issue([(2, 2)]), [(200, 314)])
+        self.assertEqual(self.valuation(2), (5, 900, 786))
+        # the rest takes exactly what is left, so the values add up
+        self.assertEqual(Valuation.issue([(2, 5)]), [(900, 786)])
+        self.assertEqual(self.valuation(2), (0, 0, 0))
+
+    def test_refund_of_allocated_goods_changes_nothing(self):
+        purchase_id = self.stock(1, 10, '1.00')
+        AllocateOrder.place(1, [(1, 5)], self.user)
+        before = self.state()
+        response = self.client.post('/return_goods', data={'purchase_id': str(purchase_id)})
+        self.assertIn('have already been allocated', response.get_data(as_text=True))
+        # past the form, e.g. allocated after it was checked
+        self.assertFalse(Refund.return_purchases([purchase_id], self.user))
+        self.assertEqual(self.state(), before)
+        self.assertEqual(Refund.query.count(), 0)
+        self.assertFalse(Purchase.query.get(purchase_id).return_goods)
+
+    def test_concurrent_shortage_rolls_back_every_line(self):
+        self.stock(1, 10, '1.00')
+        self.stock(2, 10, '2.00')
+        lines = [(1, 3), (2, 8)]
+        self.assertEqual(AllocateOrder.shortages(lines), [])
+        # another order takes medicine 2 between the form check and placing
+        Inventory.query.filter_by(medicine_id=2).update({'count': 4})
+        db.session.commit()
+        before = self.state()
+        order, shortages = AllocateOrder.place(1, lines, self.user)
+        self.assertIsNone(order)
+        self.assertEqual(shortages, [(2, 8, 4)])
+        self.assertEqual(self.state(), before)
+        self.assertEqual((AllocateOrder.query.count(), Allocate.query.count(), CostOfGoods.query.count()), (0, 0, 0))